@@ -0,0 +1,89 @@
+"""Данные бенчмарков на миллионах строк (explain_bench.py, export_bench.py).
+
+Такие бенчмарки работают только с отдельной БД: её имя задаёт BENCH_DB_NAME
+(сервер и учётные данные — DB_* как у бота), схема приводится к актуальной
+миграциями при запуске. Без BENCH_DB_NAME бенчмарк отказывается запускаться,
+чтобы не завести миллионы строк в БД бота.
+
+Заведение и удаление идут с sueta.bulk_import = 'on', как массовый импорт
+(importer.py): построчные триггеры агрегатов и уведомлений живого дашборда
+молчат. Агрегаты status_daily_counts для строк бенчмарка поэтому не ведутся —
+они создаются и удаляются вместе, а с --keep остаются без агрегатов.
+"""
+import os
+import time
+from datetime import timedelta
+
+BENCH_DB_ENV = "BENCH_DB_NAME"
+
+
+def use_bench_database():
+    """Направляет db.py в БД бенчмарков; вызывается до первого обращения к БД."""
+    name = os.getenv(BENCH_DB_ENV)
+    if not name:
+        raise SystemExit(f"Задайте {BENCH_DB_ENV} — отдельную БД для бенчмарка (DB_NAME бота не используется)")
+    os.environ["DB_NAME"] = name
+    return name
+
+
+class BenchUsers:
+    """Пользователи бенчмарка (id от user_base, командами по team_size) и их статусы."""
+
+    def __init__(self, db, name, user_base, chat_base, users, team_size):
+        self.db = db
+        self.name = name
+        self.user_base = user_base
+        self.chat_base = chat_base
+        self.users = users
+        self.team_size = team_size
+
+    def chat(self, i):
+        """Чат команды i-го пользователя."""
+        return self.chat_base - i // self.team_size
+
+    def seed(self, days, first_day):
+        """Пользователи и их статусы за days дней с first_day — генерируются на стороне сервера."""
+        params = {"base": self.user_base, "chat_base": self.chat_base, "team": self.team_size,
+                  "users": self.users, "days": days, "first_day": first_day, "name": self.name + "_"}
+        with self.db.get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SET LOCAL sueta.bulk_import = 'on'")
+            cur.execute('''
+                INSERT INTO users (user_id, username, chat_id)
+                SELECT %(base)s + i, %(name)s || i, %(chat_base)s - i / %(team)s
+                FROM generate_series(0, %(users)s - 1) AS i
+            ''', params)
+            cur.execute('''
+                INSERT INTO statuses (user_id, chat_id, status_type_id, date)
+                SELECT %(base)s + i, %(chat_base)s - i / %(team)s, 1 + (i + d) %% 6, %(first_day)s::date + d
+                FROM generate_series(0, %(users)s - 1) AS i, generate_series(0, %(days)s - 1) AS d
+            ''', params)
+            cur.execute('ANALYZE users')
+            cur.execute('ANALYZE memberships')
+            cur.execute('ANALYZE statuses')
+
+    def seeded_rows(self, days, first_day):
+        with self.db.get_connection() as conn, conn.cursor() as cur:
+            cur.execute('''
+                SELECT count(*) FROM statuses
+                WHERE user_id >= %s AND user_id < %s AND date BETWEEN %s AND %s
+            ''', (self.user_base, self.user_base + self.users, first_day, first_day + timedelta(days=days - 1)))
+            return cur.fetchone()[0]
+
+    def ensure(self, days, first_day):
+        """Заводит данные, если их нет целиком (с --keep прошлого запуска они уже есть)."""
+        if self.seeded_rows(days, first_day) == self.users * days:
+            return
+        self.cleanup()
+        started = time.perf_counter()
+        self.seed(days, first_day)
+        print(f"{self.users * days} статусов ({self.users} пользователей) заведено за "
+              f"{time.perf_counter() - started:.1f} с")
+
+    def cleanup(self):
+        with self.db.get_connection() as conn, conn.cursor() as cur:
+            cur.execute("SET LOCAL sueta.bulk_import = 'on'")
+            cur.execute('DELETE FROM statuses WHERE user_id >= %s AND user_id < %s',
+                        (self.user_base, self.user_base + self.users))
+            cur.execute('DELETE FROM users WHERE user_id >= %s AND user_id < %s',
+                        (self.user_base, self.user_base + self.users))
+        self.db.invalidate_statuses()
@@ -0,0 +1,165 @@
+"""Самопроверка кеша недельного вида (cache.py) на бэкендах LocalBackend и RedisBackend.
+
+Две реплики — два TTLCache с общим бэкендом поколений — проходят сценарии,
+на которые опирается db.py:
+  * get_or_load: промах вызывает loader, повтор — попадание без loader;
+  * invalidate области на одной реплике сбрасывает её записи и на другой,
+    соседние области не трогает;
+  * invalidate(GLOBAL_SCOPE) сбрасывает все области;
+  * инвалидация во время loader: результат не находится следующим чтением;
+  * счётчики кеша видны в выгрузке метрик (sueta_status_cache).
+Затем меряется время попадания get_or_load (у Redis — один MGET на чтение).
+
+Redis берётся из --redis-url (по умолчанию CACHE_REDIS_URL или
+redis://localhost:6379/0); ключи пишутся под отдельным префиксом и удаляются
+в конце. Нужен пакет redis. Код выхода 0 — проверка прошла, 1 — нет.
+
+Пример:
+    CACHE_REDIS_URL=redis://localhost:6379/0 python benchmarks/cache_bench.py
+    python benchmarks/cache_bench.py --backends local
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache  # noqa: E402
+import metrics  # noqa: E402
+
+
+class Loader:
+    """loader для get_or_load: считает вызовы, может выполнить действие посреди загрузки."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, value, during=None):
+        def load():
+            self.calls += 1
+            if during is not None:
+                during()
+            return value
+        return load
+
+
+# ========== СЦЕНАРИИ ==========
+def check_scenarios(backend):
+    """Возвращает список непрошедших проверок."""
+    replica_a, replica_b = cache.TTLCache(backend=backend), cache.TTLCache(backend=backend)
+    loader = Loader()
+    failures = []
+
+    def expect(name, condition):
+        if not condition:
+            failures.append(name)
+
+    week = ("2025-01-06", "2025-01-12", 0, 30)
+    first = replica_a.get_or_load(-1, week, loader("v1"))
+    again = replica_a.get_or_load(-1, week, loader("v1-reloaded"))
+    expect("промах вызывает loader, повтор берётся из кеша", (first, again, loader.calls) == ("v1", "v1", 1))
+
+    replica_b.get_or_load(-1, week, loader("b1"))
+    replica_b.get_or_load(-2, week, loader("b-other-chat"))
+    calls = loader.calls
+    replica_a.invalidate(-1)
+    expect("инвалидация на одной реплике видна на другой",
+           replica_b.get_or_load(-1, week, loader("b2")) == "b2")
+    expect("инвалидация не трогает соседние области",
+           replica_b.get_or_load(-2, week, loader("b-other-chat-2")) == "b-other-chat")
+    expect("после инвалидации — ровно одна перезагрузка", loader.calls == calls + 1)
+
+    replica_b.invalidate(cache.GLOBAL_SCOPE)
+    expect("инвалидация всех областей видна на другой реплике",
+           replica_a.get_or_load(-2, week, loader("a-after-global")) == "a-after-global")
+
+    # Запись статуса (и инвалидация) пришлась на время чтения из БД
+    stale = replica_a.get_or_load(-3, week, loader("stale", during=lambda: replica_b.invalidate(-3)))
+    expect("результат загрузки во время инвалидации не кешируется как свежий",
+           stale == "stale" and replica_a.get_or_load(-3, week, loader("fresh")) == "fresh")
+
+    stats = replica_a.stats()
+    expect("счётчики попаданий и промахов", stats["hits"] >= 1 and stats["misses"] >= 4)
+    return failures
+
+
+def check_metrics(backend):
+    """Счётчики кеша db.py выгружаются как sueta_status_cache{stat=...}."""
+    import db
+
+    db.status_cache = cache.TTLCache(backend=backend)
+    db.status_cache.get_or_load(-1, "key", lambda: "value")
+    db.status_cache.get_or_load(-1, "key", lambda: "value")
+    lines = [line for line in metrics.render().splitlines() if line.startswith("sueta_status_cache{")]
+    values = {line.split('"')[1]: float(line.rsplit(" ", 1)[1]) for line in lines}
+    ok = values.get("hits") == 1 and values.get("misses") == 1 and values.get("size") == 1
+    return [] if ok else [f"метрики кеша: {values}"]
+
+
+def measure_hits(backend, count):
+    """Время попадания get_or_load, мс: p50 и p95."""
+    ttl_cache = cache.TTLCache(backend=backend)
+    ttl_cache.get_or_load(-1, "week", lambda: "value")
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        ttl_cache.get_or_load(-1, "week", lambda: "reloaded")
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {"p50_ms": round(statistics.median(samples), 3), "p95_ms": round(samples[int(0.95 * (count - 1))], 3)}
+
+
+# ========== БЭКЕНДЫ ==========
+def redis_backend(url):
+    """RedisBackend под одноразовым префиксом и функция, удаляющая его ключи."""
+    backend = cache.RedisBackend.from_url(url, prefix=f"sueta:cache:bench:{uuid.uuid4().hex}:")
+    backend.client.ping()
+
+    def cleanup():
+        keys = list(backend.client.scan_iter(backend.prefix + "*"))
+        if keys:
+            backend.client.delete(*keys)
+    return backend, cleanup
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", choices=("local", "redis"), default=["local", "redis"])
+    parser.add_argument("--redis-url", default=os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0"))
+    parser.add_argument("--hits", type=int, default=2000, help="попаданий для замера времени")
+    parser.add_argument("--output", help="файл для JSON с результатами")
+    args = parser.parse_args()
+
+    results, failed = {}, False
+    for name in args.backends:
+        cleanup = None
+        try:
+            if name == "redis":
+                backend, cleanup = redis_backend(args.redis_url)
+            else:
+                backend = cache.LocalBackend()
+            failures = check_scenarios(backend) + check_metrics(backend)
+            result = {"failures": failures, "hit": measure_hits(backend, args.hits)}
+        except Exception as e:
+            result = {"failures": [f"{type(e).__name__}: {e}"]}
+        finally:
+            if cleanup is not None:
+                cleanup()
+        results[name] = result
+        failed = failed or bool(result["failures"])
+        print(f"{'ПРОВАЛ' if result['failures'] else 'OK    '} {name}: {json.dumps(result, ensure_ascii=False)}")
+
+    print("OK" if not failed else "ПРОВАЛ")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": results, "passed": not failed}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Микро-бенчмарк навигации по календарю: прежний create_calendar против кешированного.
+
+Меряет саму сборку клавиатуры и весь callback calendar_handler (prev/next/today)
+с заглушкой вместо Telegram, чтобы в замер не попадала сеть.
+
+Запуск из корня репозитория: python benchmarks/calendar_bench.py [--iterations N]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+
+import bot  # noqa: E402
+
+
+def legacy_create_calendar(year=None, month=None):
+    """Реализация create_calendar до кеширования (для сравнения)."""
+    now = datetime.now()
+    if year is None: year = now.year
+    if month is None: month = now.month
+
+    prev_month = (month - 1) if month > 1 else 12
+    prev_year = year - 1 if month == 1 else year
+    next_month = (month + 1) if month < 12 else 1
+    next_year = year + 1 if month == 12 else year
+
+    keyboard = [
+        [InlineKeyboardButton(f"{month}/{year}", callback_data="ignore")]
+    ]
+    keyboard.append([InlineKeyboardButton(name, callback_data="ignore") for name in ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")])
+
+    first_weekday = datetime(year, month, 1).weekday()
+    days_in_month = (datetime(year, month % 12 + 1, 1) - timedelta(days=1)).day if month < 12 else 31
+
+    week = []
+    for _ in range(first_weekday):
+        week.append(InlineKeyboardButton(" ", callback_data="ignore"))
+    for day in range(1, days_in_month + 1):
+        week.append(InlineKeyboardButton(str(day), callback_data=f"cal:{year}-{month:02d}-{day:02d}"))
+        if len(week) == 7:
+            keyboard.append(week)
+            week = []
+    while len(week) < 7:
+        week.append(InlineKeyboardButton(" ", callback_data="ignore"))
+    if week:
+        keyboard.append(week)
+
+    keyboard.append([
+        InlineKeyboardButton("◀️", callback_data=f"prev:{prev_year}-{prev_month:02d}"),
+        InlineKeyboardButton("Сегодня", callback_data="today"),
+        InlineKeyboardButton("▶️", callback_data=f"next:{next_year}-{next_month:02d}")
+    ])
+
+    return InlineKeyboardMarkup(keyboard)
+
+
+class _StubQuery:
+    def __init__(self, data):
+        self.data = data
+
+    async def answer(self):
+        pass
+
+    async def edit_message_reply_markup(self, reply_markup=None):
+        pass
+
+
+class _StubUpdate:
+    def __init__(self, data):
+        self.callback_query = _StubQuery(data)
+
+
+# Типичная навигация: листание на год вперёд/назад и возврат к сегодняшнему месяцу
+CALLBACKS = [f"next:2026-{m:02d}" for m in range(1, 13)] + [f"prev:2025-{m:02d}" for m in range(12, 0, -1)] + ["today"]
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    return {
+        "p50_us": round(statistics.median(samples) * 1e6, 1),
+        "p95_us": round(samples[int(len(samples) * 0.95) - 1] * 1e6, 1),
+    }
+
+
+def bench_build(fn, iterations):
+    samples = []
+    for i in range(iterations):
+        year, month = 2025 + (i // 12) % 2, i % 12 + 1
+        started = time.perf_counter()
+        fn(year, month)
+        samples.append(time.perf_counter() - started)
+    return _percentiles(samples)
+
+
+def bench_callback(iterations):
+    async def run():
+        samples = []
+        for i in range(iterations):
+            update = _StubUpdate(CALLBACKS[i % len(CALLBACKS)])
+            started = time.perf_counter()
+            await bot.calendar_handler(update, None)
+            samples.append(time.perf_counter() - started)
+        return samples
+    return _percentiles(asyncio.run(run()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    legacy = bench_build(legacy_create_calendar, args.iterations)
+    cached = bench_build(bot.create_calendar, args.iterations)
+    print(f"create_calendar (до):    {legacy}")
+    print(f"create_calendar (после): {cached}")
+
+    original = bot.create_calendar
+    bot.create_calendar = legacy_create_calendar
+    try:
+        before = bench_callback(args.iterations)
+    finally:
+        bot.create_calendar = original
+    after = bench_callback(args.iterations)
+    print(f"calendar_handler (до):    {before}")
+    print(f"calendar_handler (после): {after}")
+
+
+if __name__ == '__main__':
+    main()
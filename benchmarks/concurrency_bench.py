@@ -0,0 +1,215 @@
+"""Проверка: медленный запрос к БД не останавливает обработку чужих обновлений.
+
+Пока один запрос (SELECT pg_sleep(--slow)) выполняется через repository.run —
+тот же ограниченный пул потоков, через который ходят в БД обработчики, —
+по открытому циклу подаются обновления других пользователей: выбор статуса
+(status_chosen, запись через write-behind буфер) и /status в командных чатах
+(show_status_all). Обновления идут через Application.process_update с
+ConversationHandler'ами бота, БД — локальный PostgreSQL (переменные DB_* как
+у бота), Bot API — фейковый (fake_telegram.py).
+
+Затем --pairs других пользователей присылают /setstatus и сразу за ним
+выбранный статус, не дожидаясь ответа (обе задачи создаются одновременно, Bot
+API отвечает с задержкой --api-latency): второе обновление должно увидеть
+состояние диалога, записанное первым, и попасть в status_chosen («Статус на
+сегодня обновлён»), а не в общий обработчик текста.
+
+Проверка проходит, если все обновления обработаны раньше, чем закончился
+медленный запрос, цикл событий ни разу не просыпался позже, чем на
+--max-lag-ms, и каждую пару обработал диалог /setstatus. С --blocking медленный запрос выполняется прямо в цикле
+событий, как до перехода на repository: так видно, что проверка ловит
+блокировку (ожидаемый результат — ПРОВАЛ).
+
+Код выхода 0 — проверка прошла, 1 — нет. Пользователи заводятся и удаляются
+так же, как в load_bench.py.
+
+Пример:
+    python benchmarks/concurrency_bench.py --users 200 --updates 400 --slow 3
+    python benchmarks/concurrency_bench.py --blocking
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegramServer  # noqa: E402
+from load_bench import BENCH_CHAT_BASE, BENCH_USER_BASE, UpdateFactory, cleanup, process, seed, warm_up  # noqa: E402
+
+
+CHOSEN_REPLY = "✅ Статус на сегодня обновлён!"  # ответ status_chosen
+
+
+def slow_query(seconds):
+    import db
+
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT pg_sleep(%s)', (seconds,))
+
+
+async def watch_loop_lag(stop, interval=0.01):
+    """Наибольшее опоздание пробуждения цикла событий, пока не выставлен stop."""
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+    return worst
+
+
+async def check_same_user_order(args, application, factory, api):
+    """Пары «/setstatus + статус» одного пользователя подряд; сколько из них дошло до status_chosen."""
+    import bot
+
+    api.latency = args.api_latency / 1000
+    before = api.texts[CHOSEN_REPLY]
+    pair_users = [BENCH_USER_BASE + args.users + i for i in range(args.pairs)]
+    tasks = []
+    for uid in pair_users:
+        tasks.append(asyncio.create_task(process(application, factory.message(uid, "/setstatus"))))
+        tasks.append(asyncio.create_task(process(application, factory.message(uid, bot.PRESET_STATUSES[0]))))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    api.latency = 0
+    return api.texts[CHOSEN_REPLY] - before
+
+
+async def run_check(args, application, api):
+    import bot
+    import repository
+
+    factory = UpdateFactory(application.bot)
+    user_ids = [BENCH_USER_BASE + i for i in range(args.users)]
+    # Половина пользователей выбирает статус, остальные смотрят /status своей команды
+    choosers = set(user_ids[::2])
+    await warm_up(application, [factory.message(uid, "/setstatus") for uid in sorted(choosers)])
+    updates = []
+    for i in range(args.updates):
+        uid = user_ids[i % len(user_ids)]
+        if uid in choosers:
+            updates.append(factory.message(uid, bot.PRESET_STATUSES[i % len(bot.PRESET_STATUSES)]))
+        else:
+            chat_id = BENCH_CHAT_BASE - (uid - BENCH_USER_BASE) // args.team_size
+            updates.append(factory.message(uid, "/status", chat_id))
+
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(watch_loop_lag(stop))
+    slow_started = time.perf_counter()
+    if args.blocking:
+        # Как раньше: синхронный psycopg2 прямо в обработчике
+        async def blocking():
+            slow_query(args.slow)
+        slow_task = asyncio.create_task(blocking())
+    else:
+        slow_task = asyncio.create_task(repository.run(slow_query, args.slow))
+    slow_task.add_done_callback(lambda _: setattr(slow_task, "finished_at", time.perf_counter()))
+    await asyncio.sleep(0.05)  # запрос уже выполняется
+
+    latencies, errors = [], 0
+
+    async def one(update, arrival):
+        nonlocal errors
+        try:
+            await process(application, update)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - arrival)
+
+    started = time.perf_counter()
+    tasks = []
+    for i, update in enumerate(updates):
+        arrival = started + i / args.rate
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(update, arrival)))
+    await asyncio.gather(*tasks)
+    updates_done = time.perf_counter()
+    await slow_task
+    stop.set()
+    max_lag = await lag_task
+
+    ordered_pairs = await check_same_user_order(args, application, factory, api)
+
+    samples = sorted(latencies)
+    result = {
+        "mode": "blocking" if args.blocking else "repository.run",
+        "updates": len(updates),
+        "errors": errors,
+        "slow_query_s": round(slow_task.finished_at - slow_started, 3),
+        "updates_done_s": round(updates_done - slow_started, 3),
+        "p50_ms": round(statistics.median(samples) * 1000, 2),
+        "p95_ms": round(samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))] * 1000, 2),
+        "max_ms": round(samples[-1] * 1000, 2),
+        "max_loop_lag_ms": round(max_lag * 1000, 2),
+        "pairs": args.pairs,
+        "pairs_ordered": ordered_pairs,
+    }
+    result["passed"] = (
+        errors == 0
+        and updates_done < slow_task.finished_at
+        and max_lag * 1000 <= args.max_lag_ms
+        and ordered_pairs == args.pairs
+    )
+    return result
+
+
+async def main_async(args):
+    api = FakeTelegramServer().start()
+    os.environ["TELEGRAM_TOKEN"] = "123456:bench"
+    os.environ["TELEGRAM_API_URL"] = api.url
+    os.environ["PERSISTENCE"] = "off"
+
+    import bot
+    import db
+    import repository
+
+    db.init_db()
+    seed(db, args.users + args.pairs, args.team_size)
+    application = bot.build_application()
+    try:
+        await application.initialize()
+        return await run_check(args, application, api)
+    finally:
+        await application.shutdown()
+        if repository.status_journal is not None:
+            await repository.status_journal.close()
+        await repository.status_writer.close()
+        cleanup(db, args.users + args.pairs)
+        repository.shutdown()
+        db.close_pool()
+        api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--team-size", type=int, default=25)
+    parser.add_argument("--updates", type=int, default=400, help="обновлений других пользователей")
+    parser.add_argument("--rate", type=float, default=400, help="обновлений в секунду")
+    parser.add_argument("--slow", type=float, default=3, help="длительность медленного запроса, с")
+    parser.add_argument("--max-lag-ms", type=float, default=100, help="допустимое опоздание цикла событий")
+    parser.add_argument("--pairs", type=int, default=50, help="пользователей с парой обновлений подряд")
+    parser.add_argument("--api-latency", type=float, default=20, help="задержка ответа фейкового Bot API, мс")
+    parser.add_argument("--blocking", action="store_true", help="выполнить медленный запрос в цикле событий")
+    parser.add_argument("--output", help="файл для JSON с результатами")
+    args = parser.parse_args()
+    if args.updates / args.rate >= args.slow:
+        parser.error("обновления должны успеть прийти, пока идёт медленный запрос: уменьшите --updates/--rate")
+
+    result = asyncio.run(main_async(args))
+    print(json.dumps(result, ensure_ascii=False))
+    print("OK" if result["passed"] else "ПРОВАЛ")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": result}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}")
+    sys.exit(0 if result["passed"] else 1)
+
+
+if __name__ == '__main__':
+    main()
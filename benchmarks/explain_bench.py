@@ -0,0 +1,155 @@
+"""Проверка планов: недельный вид и дашборд не читают statuses последовательно.
+
+Заводит --rows статусов (пользователи командами по --team-size человек,
+у каждого статус на каждый из --days дней вокруг сегодняшнего), делает
+ANALYZE и выполняет настоящие функции db — недельный вид чата
+(get_statuses_next_week, кеш сбрасывается перед вызовом), дашборд без
+фильтра и с фильтром по чату, вторую страницу дашборда и участников чата
+(get_active_users). Пул db создаётся с перехватывающим классом соединений
+(db.init_pool(connection_factory=...)), выполненные запросы запоминаются с
+подставленными параметрами и разбираются EXPLAIN (FORMAT JSON).
+
+Проверка не проходит, если в плане хоть одного запроса есть Seq Scan по
+statuses или её секциям. Для остальных таблиц способ чтения только
+выводится. Код выхода 0 — проверка прошла, 1 — нет.
+
+Бенчмарк работает в отдельной БД (BENCH_DB_NAME, см. bench_data.py), заводит
+пользователей с id от BENCH_USER_BASE и удаляет их в конце; с --keep данные
+остаются и следующий запуск берёт их как есть.
+
+Пример (миллион статусов):
+    BENCH_DB_NAME=sueta_bench python benchmarks/explain_bench.py --rows 1000000
+"""
+import argparse
+import json
+import os
+import sys
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import psycopg2.extensions  # noqa: E402
+
+import db  # noqa: E402
+from bench_data import BenchUsers, use_bench_database  # noqa: E402
+
+BENCH_USER_BASE = 9_000_000_000
+BENCH_CHAT_BASE = -1_009_000_000_000
+SEQ_SCANS = ("Seq Scan", "Parallel Seq Scan")
+
+captured = []
+
+
+# ========== ПЕРЕХВАТ ЗАПРОСОВ ==========
+_capturing_cursors = {}
+
+
+def _capturing_cursor(base):
+    if base not in _capturing_cursors:
+        class CapturingCursor(base):
+            def execute(self, query, vars=None):
+                captured.append(self.mogrify(query, vars).decode())
+                return super().execute(query, vars)
+
+        _capturing_cursors[base] = CapturingCursor
+    return _capturing_cursors[base]
+
+
+class CapturingConnection(psycopg2.extensions.connection):
+    """Соединение, запоминающее текст каждого выполненного запроса."""
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = _capturing_cursor(base)
+        return super().cursor(*args, **kwargs)
+
+
+def install_capturing_pool():
+    db.init_pool(connection_factory=CapturingConnection)
+
+
+# ========== ПЛАНЫ ==========
+def scans(plan):
+    """(тип узла, таблица, индекс) всех узлов чтения таблиц в плане."""
+    found = []
+    if "Relation Name" in plan:
+        found.append((plan["Node Type"], plan["Relation Name"], plan.get("Index Name")))
+    for child in plan.get("Plans", ()):
+        found.extend(scans(child))
+    return found
+
+
+def explain(query):
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cur.execute('EXPLAIN (FORMAT JSON) ' + query)
+        return cur.fetchone()[0][0]["Plan"]
+
+
+def check(name, call):
+    """Выполняет call, разбирает планы его запросов; возвращает (отчёт, есть ли Seq Scan по statuses)."""
+    captured.clear()
+    call()
+    queries = [q for q in captured if q.lstrip().upper().startswith("SELECT")]
+    report, bad = [], False
+    for query in queries:
+        for node, relation, index in scans(explain(query)):
+            report.append(f"{node} {relation}" + (f" ({index})" if index else ""))
+            if node in SEQ_SCANS and relation.startswith("statuses"):
+                bad = True
+    print(f"{'ПРОВАЛ' if bad else 'OK    '} {name}: {', '.join(report) or 'нет чтения таблиц'}")
+    return report, bad
+
+
+def weekly_view(chat):
+    """Недельный вид чата, как у /status: через get_statuses_next_week, но мимо кеша."""
+    db.invalidate_statuses(chat)
+    return db.get_statuses_next_week(chat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000, help="сколько статусов завести")
+    parser.add_argument("--days", type=int, default=120, help="за сколько дней статусы (треть — в будущем)")
+    parser.add_argument("--team-size", type=int, default=25)
+    parser.add_argument("--keep", action="store_true", help="не удалять заведённые данные")
+    parser.add_argument("--output", help="файл для JSON с результатами")
+    args = parser.parse_args()
+
+    use_bench_database()
+    db.init_db()
+    bench = BenchUsers(db, "explain", BENCH_USER_BASE, BENCH_CHAT_BASE, max(1, args.rows // args.days), args.team_size)
+    today = date.today()
+    first_day = today - timedelta(days=args.days * 2 // 3)
+    chat = bench.chat(bench.users // 2)
+    report, failed = {}, False
+    try:
+        bench.ensure(args.days, first_day)
+        install_capturing_pool()
+
+        dash_start = today - timedelta(days=7)
+        _, cursor = db.get_dashboard_page(dash_start, today)
+        checks = {
+            "weekly_view": lambda: weekly_view(chat),
+            "dashboard": lambda: db.get_dashboard_page(dash_start, today),
+            "dashboard_page_2": lambda: db.get_dashboard_page(dash_start, today, after=cursor),
+            "dashboard_chat": lambda: db.get_dashboard_page(dash_start, today, chat),
+            "active_users": lambda: db.get_active_users(chat),
+        }
+        for name, call in checks.items():
+            report[name], bad = check(name, call)
+            failed = failed or bad
+    finally:
+        if not args.keep:
+            bench.cleanup()
+        db.close_pool()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": report, "passed": not failed}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
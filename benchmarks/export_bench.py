@@ -0,0 +1,131 @@
+"""Проверка памяти потоковой выгрузки: 5 млн статусов под фиксированным потолком RSS.
+
+Заводит --rows статусов (пользователи командами по --team-size человек, у
+каждого статус на каждый из --days последних дней) и выгружает весь период
+через export.export_to_file — тот же генератор, что у /export в web.py и
+у команды бота, — в приёмник, который только считает байты.
+
+Проверка проходит, если пик RSS процесса за время выгрузки вырос не больше
+чем на --max-rss-mb и выгружены все строки. Код выхода 0 — проверка прошла,
+1 — нет.
+
+Бенчмарк работает в отдельной БД (BENCH_DB_NAME, см. bench_data.py), заводит
+пользователей с id от BENCH_USER_BASE и удаляет их в конце; с --keep данные
+остаются и следующий запуск берёт их как есть.
+
+Пример:
+    BENCH_DB_NAME=sueta_bench python benchmarks/export_bench.py --rows 5000000 --format csv
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import db  # noqa: E402
+import export  # noqa: E402
+from bench_data import BenchUsers, use_bench_database  # noqa: E402
+
+BENCH_USER_BASE = 9_500_000_000
+BENCH_CHAT_BASE = -1_009_500_000_000
+
+
+class CountingSink:
+    """Файл-приёмник: считает байты и строки, ничего не хранит."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.lines = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.lines += data.count(b"\n")
+
+    def seek(self, offset):
+        pass
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak_rss_mb()
+
+
+def peak_rss_mb():
+    # ru_maxrss — в килобайтах на Linux и в байтах на macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def count_rows(first_day, last_day):
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT count(*) FROM statuses WHERE date BETWEEN %s AND %s', (first_day, last_day))
+        return cur.fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5_000_000, help="сколько статусов завести")
+    parser.add_argument("--days", type=int, default=365, help="за сколько последних дней статусы")
+    parser.add_argument("--team-size", type=int, default=25)
+    parser.add_argument("--format", choices=sorted(export.EXPORT_FORMATS), default="csv")
+    parser.add_argument("--max-rss-mb", type=float, default=64, help="допустимый прирост пика RSS")
+    parser.add_argument("--keep", action="store_true", help="не удалять заведённые данные")
+    parser.add_argument("--output", help="файл для JSON с результатами")
+    args = parser.parse_args()
+
+    use_bench_database()
+    db.init_db()
+    bench = BenchUsers(db, "export", BENCH_USER_BASE, BENCH_CHAT_BASE, max(1, args.rows // args.days), args.team_size)
+    last_day = date.today()
+    first_day = last_day - timedelta(days=args.days - 1)
+    try:
+        bench.ensure(args.days, first_day)
+        # В периоде могут быть и чужие статусы — выгрузка должна отдать их все
+        expected = count_rows(first_day, last_day)
+
+        sink = CountingSink()
+        rss_before = current_rss_mb()
+        started = time.perf_counter()
+        export.export_to_file(sink, args.format, first_day, last_day)
+        elapsed = time.perf_counter() - started
+        growth = peak_rss_mb() - rss_before
+    finally:
+        if not args.keep:
+            bench.cleanup()
+        db.close_pool()
+
+    # В CSV есть строка заголовка, в NDJSON — нет
+    exported = sink.lines - (1 if args.format == "csv" else 0)
+    result = {
+        "rows": exported,
+        "expected_rows": expected,
+        "mb": round(sink.bytes / (1024 * 1024), 1),
+        "elapsed_s": round(elapsed, 1),
+        "rows_per_s": round(exported / elapsed) if elapsed else None,
+        "rss_before_mb": round(rss_before, 1),
+        "rss_growth_mb": round(growth, 1),
+        "max_rss_mb": args.max_rss_mb,
+    }
+    result["passed"] = exported == expected and growth <= args.max_rss_mb
+    print(json.dumps(result, ensure_ascii=False))
+    print("OK" if result["passed"] else "ПРОВАЛ")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": result}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}")
+    sys.exit(0 if result["passed"] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Фейковый сервер Telegram Bot API для бенчмарков.
+
+Отвечает на методы, которые вызывает бот (getMe, sendMessage, editMessageText,
+answerCallbackQuery, ...), правдоподобными объектами и считает вызовы. Работает
+в отдельном потоке; бот направляется на него через TELEGRAM_API_URL.
+"""
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Sueta", "username": "sueta_bench_bot"}
+
+
+class FakeTelegramServer:
+    """HTTP-сервер Bot API: base_url = f"{server.url}/bot"."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.texts = Counter()  # тексты sendMessage — по ним видно, какой обработчик ответил
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-telegram", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def _result(self, method, params):
+        with self._lock:
+            self.calls[method] += 1
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "sendDocument", "editMessageText", "editMessageReplyMarkup"):
+            chat_id = int(params.get("chat_id") or 0)
+            message = {
+                "message_id": int(params.get("message_id") or self._next_message_id()),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                "from": BOT_USER,
+            }
+            if "text" in params:
+                message["text"] = params["text"]
+                if method == "sendMessage":
+                    with self._lock:
+                        self.texts[params["text"]] += 1
+            return message
+        # answerCallbackQuery, deleteWebhook, setWebhook и прочие
+        return True
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Заголовки и тело уходят разными write: без TCP_NODELAY keep-alive
+            # упирается в delayed ACK (~40 мс на запрос)
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                elif content_type.startswith("multipart/"):
+                    params = {}  # файлы (sendDocument) не разбираем
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                method = self.path.rsplit("/", 1)[-1]
+                if server.latency:
+                    time.sleep(server.latency)
+                payload = json.dumps({"ok": True, "result": server._result(method, params)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,388 @@
+"""Нагрузочный бенчмарк обработчиков бота и утреннего опроса.
+
+Прогоняет настоящие обработчики (status_chosen, calendar_handler,
+show_status_all, handle_poll_response) и daily_poll_job через
+Application.process_update — с теми же ConversationHandler и ограничением
+CONCURRENT_UPDATES, что и в боевом режиме — против локального PostgreSQL
+(переменные DB_* как у бота) и фейкового Telegram Bot API (fake_telegram.py).
+
+Обновления подаются по открытому циклу с заданной частотой: задержка считается
+от момента «прихода» обновления до конца обработки, поэтому очередь тоже
+попадает в замер. Для каждого сценария выводятся p50/p95/p99, пропускная
+способность, число обращений к БД (execute/commit) и к Bot API на обновление.
+С --output результаты пишутся в JSON, который удобно сравнивать между коммитами.
+
+Бенчмарк заводит пользователей с id от BENCH_USER_BASE и удаляет их в конце.
+
+Пример (5000 человек отвечают на опрос в течение 2 минут):
+    python benchmarks/load_bench.py --users 5000 --window 120 --output before.json
+Быстрый прогон:
+    python benchmarks/load_bench.py --users 500 --window 10 --sample 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import psycopg2  # noqa: E402
+import pytz  # noqa: E402
+import psycopg2.extensions  # noqa: E402
+from psycopg2.extras import execute_values  # noqa: E402
+from telegram import Update  # noqa: E402
+
+from fake_telegram import BOT_USER, FakeTelegramServer  # noqa: E402
+
+BENCH_USER_BASE = 7_000_000_000
+BENCH_CHAT_BASE = -1_007_000_000_000
+SCENARIOS = ("poll", "status_chosen", "calendar", "show_status")
+
+
+# ========== СЧЁТЧИК ОБРАЩЕНИЙ К БД ==========
+class RoundTrips:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def add(self):
+        with self._lock:
+            self.count += 1
+
+
+round_trips = RoundTrips()
+_counting_cursors = {}
+
+
+def _counting_cursor(base):
+    if base not in _counting_cursors:
+        class CountingCursor(base):
+            def execute(self, *args, **kwargs):
+                round_trips.add()
+                return super().execute(*args, **kwargs)
+
+            def executemany(self, *args, **kwargs):
+                round_trips.add()
+                return super().executemany(*args, **kwargs)
+
+        _counting_cursors[base] = CountingCursor
+    return _counting_cursors[base]
+
+
+class CountingConnection(psycopg2.extensions.connection):
+    """Соединение, считающее execute/commit/rollback всех своих курсоров."""
+
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = _counting_cursor(base)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        round_trips.add()
+        return super().commit()
+
+    def rollback(self):
+        round_trips.add()
+        return super().rollback()
+
+
+# ========== ПОДГОТОВКА ==========
+def setup_environment(args, api_url):
+    os.environ["TELEGRAM_TOKEN"] = "123456:bench"
+    os.environ["TELEGRAM_API_URL"] = api_url
+    os.environ["PERSISTENCE"] = "postgres" if args.persistence else "off"
+    os.environ["POLL_RATE"] = str(args.poll_rate)
+    os.environ["POLL_CONCURRENCY"] = str(args.poll_concurrency)
+    if args.concurrent_updates:
+        os.environ["CONCURRENT_UPDATES"] = str(args.concurrent_updates)
+
+
+def install_counting_pool(db):
+    """Подменяет пул db на такой же, но со счётчиком обращений к БД."""
+    db.init_pool(connection_factory=CountingConnection)
+
+
+def seed(db, users, team_size):
+    """Заводит пользователей и статусы команды на неделю (кроме «сегодня» — на него опрос).
+
+    Командам бенчмарка время опроса ставится на текущую минуту, все дни рабочие.
+    Возвращает «сегодня» в часовом поясе команд.
+    """
+    now = datetime.now(pytz.timezone(db.DEFAULT_TIMEZONE))
+    today = now.date()
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cleanup_rows(cur, users)
+        execute_values(cur, '''
+            INSERT INTO chat_settings (chat_id, poll_time, timezone, working_days) VALUES %s
+        ''', [
+            (BENCH_CHAT_BASE - team, now.time().replace(second=0, microsecond=0), db.DEFAULT_TIMEZONE, 0b1111111)
+            for team in range((users + team_size - 1) // team_size)
+        ])
+        execute_values(cur, 'INSERT INTO users (user_id, username, chat_id) VALUES %s', [
+            (BENCH_USER_BASE + i, f"bench_{i}", BENCH_CHAT_BASE - i // team_size) for i in range(users)
+        ], page_size=1000)
+        execute_values(cur, 'INSERT INTO statuses (user_id, chat_id, status_type_id, date) VALUES %s', [
+            (BENCH_USER_BASE + i, BENCH_CHAT_BASE - i // team_size, 1 + (i + d) % 6, today + timedelta(days=d))
+            for i in range(users) for d in range(1, 7)
+        ], page_size=1000)
+    db.invalidate_statuses()
+    return today
+
+
+def cleanup_rows(cur, users):
+    # Статусы — до пользователей: триггер агрегатов списывает их по чатам участия,
+    # которые при каскадном удалении уже могли бы исчезнуть
+    cur.execute('DELETE FROM statuses WHERE user_id >= %s AND user_id < %s', (BENCH_USER_BASE, BENCH_USER_BASE + users))
+    cur.execute('DELETE FROM users WHERE user_id >= %s AND user_id < %s', (BENCH_USER_BASE, BENCH_USER_BASE + users))
+    cur.execute('DELETE FROM poll_ledger WHERE user_id >= %s AND user_id < %s', (BENCH_USER_BASE, BENCH_USER_BASE + users))
+    cur.execute('DELETE FROM chat_settings WHERE chat_id <= %s AND chat_id > %s',
+                (BENCH_CHAT_BASE, BENCH_CHAT_BASE - users))
+
+
+def cleanup(db, users):
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cleanup_rows(cur, users)
+    db.invalidate_statuses()
+
+
+# ========== СИНТЕТИЧЕСКИЕ ОБНОВЛЕНИЯ ==========
+class UpdateFactory:
+    def __init__(self, bot):
+        self.bot = bot
+        self._update_id = 0
+
+    def _next_id(self):
+        self._update_id += 1
+        return self._update_id
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id % 100000}", "username": f"bench_{user_id}"}
+
+    @staticmethod
+    def _chat(chat_id):
+        return {"id": chat_id, "type": "private" if chat_id > 0 else "group"}
+
+    def message(self, user_id, text, chat_id=None):
+        update_id = self._next_id()
+        message = {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": self._chat(chat_id or user_id),
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": update_id, "message": message}, self.bot)
+
+    def callback(self, user_id, data):
+        update_id = self._next_id()
+        return Update.de_json({"update_id": update_id, "callback_query": {
+            "id": str(update_id),
+            "from": self._user(user_id),
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": self._chat(user_id),
+                "from": BOT_USER,
+                "text": "calendar",
+            },
+        }}, self.bot)
+
+
+# ========== ПРОГОН ==========
+async def process(application, update):
+    """Обработка так же, как при polling: через update_processor (лимит CONCURRENT_UPDATES)."""
+    await application.update_processor.process_update(update, application.process_update(update))
+
+
+async def warm_up(application, updates):
+    """Неизмеряемые обновления (например, вход в диалог) — последовательно по пользователю."""
+    await asyncio.gather(*(process(application, u) for u in updates))
+
+
+async def replay(application, updates, rate, api):
+    """Открытый цикл: i-е обновление приходит в момент i / rate. Возвращает метрики сценария."""
+    latencies, errors = [], 0
+    trips_before, api_before = round_trips.count, api.total_calls()
+
+    async def one(update, arrival):
+        nonlocal errors
+        try:
+            await process(application, update)
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - arrival)
+
+    started = time.perf_counter()
+    tasks = []
+    for i, update in enumerate(updates):
+        arrival = started + i / rate
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(update, arrival)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    return summarize(latencies, len(updates), elapsed, errors,
+                     round_trips.count - trips_before, api.total_calls() - api_before, rate)
+
+
+def _percentile(samples, q):
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+
+def summarize(latencies, updates, elapsed, errors, trips, api_calls, rate=None):
+    samples = sorted(latencies) or [0.0]
+    result = {
+        "updates": updates,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(updates / elapsed, 1) if elapsed else None,
+        "p50_ms": round(statistics.median(samples) * 1000, 2),
+        "p95_ms": round(_percentile(samples, 0.95) * 1000, 2),
+        "p99_ms": round(_percentile(samples, 0.99) * 1000, 2),
+        "max_ms": round(samples[-1] * 1000, 2),
+        "db_round_trips_per_update": round(trips / updates, 2) if updates else None,
+        "api_calls_per_update": round(api_calls / updates, 2) if updates else None,
+    }
+    if rate is not None:
+        result["offered_rate_per_s"] = round(rate, 1)
+    return result
+
+
+async def run_scenarios(args, application, api):
+    import bot
+    import db
+
+    factory = UpdateFactory(application.bot)
+    user_ids = [BENCH_USER_BASE + i for i in range(args.users)]
+    sample = user_ids[:min(args.sample, args.users)]
+    results = {}
+
+    if "poll" in args.scenarios:
+        # Рассылка: один вызов daily_poll_job
+        bot.app = application
+        trips_before, api_before = round_trips.count, api.total_calls()
+        started = time.perf_counter()
+        # Время опроса команд — минута запуска; добор на случай смены минуты
+        await bot.daily_poll_job(catchup_minutes=5)
+        elapsed = time.perf_counter() - started
+        sent = api.total_calls() - api_before
+        results["daily_poll_job"] = {
+            "messages": sent,
+            "elapsed_s": round(elapsed, 3),
+            "messages_per_s": round(sent / elapsed, 1) if elapsed else None,
+            "db_round_trips": round_trips.count - trips_before,
+        }
+        # Ответы: все пользователи жмут кнопку в течение window секунд
+        answers = [factory.message(uid, bot.PRESET_STATUSES[uid % len(bot.PRESET_STATUSES)]) for uid in user_ids]
+        results["handle_poll_response"] = await replay(application, answers, len(answers) / args.window, api)
+
+    if "status_chosen" in args.scenarios:
+        await warm_up(application, [factory.message(uid, "/setstatus") for uid in sample])
+        chosen = [factory.message(uid, bot.PRESET_STATUSES[(uid + 1) % len(bot.PRESET_STATUSES)]) for uid in sample]
+        results["status_chosen"] = await replay(application, chosen, args.rate, api)
+
+    if "calendar" in args.scenarios:
+        await warm_up(application, [factory.message(uid, "/calendar") for uid in sample])
+        today = date.today()
+        month = f"{today.year}-{today.month:02d}"
+        navigation = [factory.callback(uid, data) for data in (f"next:{month}", f"prev:{month}", "today")
+                      for uid in sample]
+        results["calendar_handler"] = await replay(application, navigation, args.rate, api)
+        # Выбор периода: начало и конец (второе нажатие предлагает выбрать статус)
+        first = today + timedelta(days=1)
+        picks = [factory.callback(uid, f"cal:{first + timedelta(days=d)}") for d in (0, 3) for uid in sample]
+        results["calendar_handler_select"] = await replay(application, picks, args.rate, api)
+
+    if "show_status" in args.scenarios:
+        # /status в командных чатах: и с холодным, и с прогретым кешем недельного вида
+        db.invalidate_statuses()
+        teams = [(uid, BENCH_CHAT_BASE - (uid - BENCH_USER_BASE) // args.team_size) for uid in sample]
+        results["show_status_all"] = await replay(
+            application, [factory.message(uid, "/status", chat_id) for uid, chat_id in teams], args.rate, api
+        )
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main_async(args):
+    api = FakeTelegramServer(latency=args.api_latency / 1000).start()
+    setup_environment(args, api.url)
+
+    import bot
+    import db
+    import repository
+
+    db.init_db()
+    install_counting_pool(db)
+    seed(db, args.users, args.team_size)
+
+    application = bot.build_application()
+    try:
+        await application.initialize()
+        results = await run_scenarios(args, application, api)
+    finally:
+        await application.shutdown()
+        if repository.status_journal is not None:
+            await repository.status_journal.close()
+        await repository.status_writer.close()
+        cleanup(db, args.users)
+        repository.shutdown()
+        db.close_pool()
+        api.stop()
+
+    return {
+        "revision": git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "params": {k: v for k, v in vars(args).items() if k != "output"},
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5000, help="пользователей (все отвечают на опрос)")
+    parser.add_argument("--window", type=float, default=120, help="за сколько секунд приходят ответы на опрос")
+    parser.add_argument("--sample", type=int, default=1000, help="пользователей в остальных сценариях")
+    parser.add_argument("--rate", type=float, default=200, help="обновлений в секунду в остальных сценариях")
+    parser.add_argument("--team-size", type=int, default=25)
+    parser.add_argument("--api-latency", type=float, default=0, help="задержка ответа фейкового Bot API, мс")
+    parser.add_argument("--poll-rate", type=float, default=1000, help="POLL_RATE для рассылки")
+    parser.add_argument("--poll-concurrency", type=int, default=50, help="POLL_CONCURRENCY для рассылки")
+    parser.add_argument("--concurrent-updates", type=int, default=0, help="CONCURRENT_UPDATES (0 — как у бота)")
+    parser.add_argument("--persistence", action="store_true", help="включить PERSISTENCE=postgres")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--output", help="файл для JSON с результатами")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    for name, metrics in report["results"].items():
+        print(f"{name}: {metrics}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Бенчмарк запросов по одному чату при росте общего числа пользователей.
+
+Заводит пользователей командами по --team-size человек (каждый --multi-team-й
+состоит ещё и в соседней команде) со статусами на неделю и для каждого размера
+из --sizes меряет запросы по случайным чатам: участники (get_active_users),
+недельный вид (_load_statuses, без кеша) и страница дашборда с фильтром по чату.
+С --legacy рядом меряются прежние запросы через users.chat_id.
+
+Время запроса по чату должно зависеть от размера команды, а не от числа
+пользователей во всей базе: p50 в строках таблицы остаётся на месте.
+
+Бенчмарк заводит пользователей с id от BENCH_USER_BASE и удаляет их в конце.
+
+Пример:
+    python benchmarks/membership_bench.py --sizes 1000 10000 50000 --legacy
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg2.extras import execute_values  # noqa: E402
+
+import db  # noqa: E402
+
+BENCH_USER_BASE = 8_000_000_000
+BENCH_CHAT_BASE = -1_008_000_000_000
+DAYS = 7
+
+# Запросы до таблицы memberships (для сравнения)
+LEGACY_QUERIES = {
+    "active_users": '''
+        SELECT user_id, username FROM users WHERE chat_id = %(chat)s AND is_active = TRUE
+    ''',
+    "weekly_view": '''
+        SELECT u.username, s.status_type_id, s.custom_text, s.date
+        FROM users u
+        JOIN statuses s ON s.user_id = u.user_id
+        WHERE u.chat_id = %(chat)s AND s.date BETWEEN %(start)s AND %(end)s
+        ORDER BY s.date, u.username, u.user_id
+        LIMIT 31
+    ''',
+    "dashboard": '''
+        SELECT s.date, COALESCE(u.username, ''), s.status_type_id, s.custom_text, u.user_id
+        FROM statuses s
+        JOIN users u ON s.user_id = u.user_id
+        WHERE s.date BETWEEN %(start)s AND %(end)s AND u.chat_id = %(chat)s
+        ORDER BY s.date DESC, COALESCE(u.username, ''), u.user_id
+        LIMIT 201
+    ''',
+}
+
+
+def chat_of(i, team_size):
+    return BENCH_CHAT_BASE - i // team_size
+
+
+def grow(start, end, team_size, multi_team, today):
+    """Добавляет пользователей start..end-1 с участием в чатах и статусами на неделю."""
+    with db.get_connection() as conn, conn.cursor() as cur:
+        execute_values(cur, 'INSERT INTO users (user_id, username, chat_id) VALUES %s', [
+            (BENCH_USER_BASE + i, f"member_{i}", chat_of(i, team_size)) for i in range(start, end)
+        ], page_size=1000)
+        # Вторая команда — до статусов, чтобы агрегаты сразу посчитались в обоих чатах
+        execute_values(cur, 'INSERT INTO memberships (chat_id, user_id) VALUES %s', [
+            (chat_of(i, team_size) - 1, BENCH_USER_BASE + i) for i in range(start, end) if i % multi_team == 0
+        ], page_size=1000)
+        execute_values(cur, 'INSERT INTO statuses (user_id, chat_id, status_type_id, date) VALUES %s', [
+            (BENCH_USER_BASE + i, chat_of(i, team_size), 1 + (i + d) % 6, today + timedelta(days=d))
+            for i in range(start, end) for d in range(DAYS)
+        ], page_size=1000)
+        cur.execute('ANALYZE users')
+        cur.execute('ANALYZE memberships')
+        cur.execute('ANALYZE statuses')
+
+
+def cleanup(users):
+    with db.get_connection() as conn, conn.cursor() as cur:
+        # Сначала статусы: их триггер списывает агрегаты по ещё существующим участиям
+        cur.execute('DELETE FROM statuses WHERE user_id >= %s AND user_id < %s',
+                    (BENCH_USER_BASE, BENCH_USER_BASE + users))
+        cur.execute('DELETE FROM users WHERE user_id >= %s AND user_id < %s',
+                    (BENCH_USER_BASE, BENCH_USER_BASE + users))
+    db.invalidate_statuses()
+
+
+def _timed(func, chats):
+    samples = []
+    for chat in chats:
+        started = time.perf_counter()
+        func(chat)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples) * 1000, 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))] * 1000, 3),
+    }
+
+
+def _legacy(name, start, end):
+    def run(chat):
+        with db.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(LEGACY_QUERIES[name], {"chat": chat, "start": start, "end": end})
+            cur.fetchall()
+    return run
+
+
+def measure(users, team_size, queries, legacy, today):
+    end = today + timedelta(days=DAYS - 1)
+    teams = (users + team_size - 1) // team_size
+    chats = [BENCH_CHAT_BASE - random.randrange(teams) for _ in range(queries)]
+    result = {
+        "active_users": _timed(db.get_active_users, chats),
+        "weekly_view": _timed(lambda chat: db._load_statuses(chat, today, end, 0, db.STATUS_PAGE_SIZE), chats),
+        "dashboard": _timed(lambda chat: db.get_dashboard_page(today, end, chat), chats),
+    }
+    if legacy:
+        for name in LEGACY_QUERIES:
+            result[f"legacy_{name}"] = _timed(_legacy(name, today, end), chats)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000],
+                        help="общее число пользователей на каждом шаге (по возрастанию)")
+    parser.add_argument("--team-size", type=int, default=50)
+    parser.add_argument("--multi-team", type=int, default=10, help="каждый N-й состоит в двух командах")
+    parser.add_argument("--queries", type=int, default=300, help="запросов каждого вида на шаг")
+    parser.add_argument("--legacy", action="store_true", help="мерить и прежние запросы через users.chat_id")
+    parser.add_argument("--output", help="файл для JSON с результатами")
+    args = parser.parse_args()
+
+    random.seed(1)
+    db.init_db()
+    today = date.today()
+    sizes = sorted(args.sizes)
+    report = {}
+    seeded = 0
+    try:
+        cleanup(sizes[-1])
+        for users in sizes:
+            started = time.perf_counter()
+            grow(seeded, users, args.team_size, args.multi_team, today)
+            seeded = users
+            print(f"{users} пользователей заведено за {time.perf_counter() - started:.1f} с")
+            report[users] = measure(users, args.team_size, args.queries, args.legacy, today)
+            for name, stats in report[users].items():
+                print(f"  {name}: {stats}")
+    finally:
+        cleanup(sizes[-1])
+        db.close_pool()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": report}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
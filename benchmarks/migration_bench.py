@@ -0,0 +1,282 @@
+"""Проверка повторного запуска миграций без общей транзакции.
+
+Миграции с transactional=False не откатываются целиком: после падения на
+середине часть шагов уже применена, а версия в schema_migrations не записана,
+и при следующем старте миграция выполняется с первого шага. Бенчмарк
+проверяет, что это ей не мешает.
+
+Для каждой проверяемой версии и каждого шага k: в отдельной схеме
+(--schema, удаляется в конце) применяются миграции до этой версии, заводятся
+--rows статусов, затем миграция падает сразу после k-го шага (при k, равном
+числу шагов, — после всех шагов, до записи версии). Пока миграция «лежит»,
+бот продолжает писать статусы (в том числе в месяц, на который секций ещё
+нет), после чего миграция запускается ещё раз целиком. После второго запуска
+проверяются схема, число строк и агрегаты status_daily_counts — они должны
+совпасть с тем, что было перед повторным запуском. Для миграции 16 ещё
+проверяется, что ensure_status_partition переносит строки из statuses_default
+без уведомлений и изменения агрегатов.
+
+Данные бота не затрагиваются: все таблицы живут в отдельной схеме (search_path
+соединения). Код выхода 0 — проверка прошла, 1 — нет.
+
+Пример:
+    python benchmarks/migration_bench.py
+    python benchmarks/migration_bench.py --versions 11
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+import migrations  # noqa: E402
+
+CUSTOM_EVERY = 7  # каждый CUSTOM_EVERY-й статус — свой текст, остальные — пресеты
+
+
+class InjectedFailure(Exception):
+    """Падение, подставленное после k-го шага миграции."""
+
+
+def _fail(cur):
+    raise InjectedFailure()
+
+
+# ========== СХЕМА И ДАННЫЕ ==========
+def reset_schema(cur, schema):
+    cur.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+    cur.execute(f'CREATE SCHEMA {schema}')
+    cur.execute(f'SET search_path TO {schema}')
+
+
+def migrate_before(conn, version):
+    migrations.migrate(conn, [m for m in migrations.MIGRATIONS if m.version < version])
+
+
+# Тексты пресетов в порядке id каталога (миграция 8)
+PRESET_LABELS = ['✅ На работе', '🏡 Работаю дома', '🌴 В отпуске', '🤒 Болею', '✈️ В командировке', '🏖️ Выходной']
+
+
+def has_status_text(cur):
+    cur.execute('''
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'statuses' AND column_name = 'status_text'
+    ''')
+    return cur.fetchone() is not None
+
+
+def seed(cur, rows, days):
+    """Пользователи по 10 на чат и их статусы за days дней до сегодня (по одному на день)."""
+    users = max(1, rows // days)
+    cur.execute('''
+        INSERT INTO users (user_id, username, chat_id)
+        SELECT i, 'user_' || i, -1 - i / 10 FROM generate_series(1, %s) AS i
+    ''', (users,))
+    if has_status_text(cur):
+        cur.execute('''
+            INSERT INTO statuses (user_id, chat_id, status_text, date)
+            SELECT i, -1 - i / 10,
+                   CASE WHEN (i + d) %% %(every)s = 0 THEN 'свой статус ' || d
+                        ELSE (%(labels)s::text[])[1 + (i + d) %% 6] END,
+                   current_date - d
+            FROM generate_series(1, %(users)s) AS i, generate_series(0, %(days)s - 1) AS d
+        ''', {"every": CUSTOM_EVERY, "labels": PRESET_LABELS, "users": users, "days": days})
+    else:
+        cur.execute('''
+            INSERT INTO statuses (user_id, chat_id, status_type_id, custom_text, date)
+            SELECT i, -1 - i / 10,
+                   CASE WHEN (i + d) %% %(every)s <> 0 THEN 1 + (i + d) %% 6 END,
+                   CASE WHEN (i + d) %% %(every)s = 0 THEN 'свой статус ' || d END,
+                   current_date - d
+            FROM generate_series(1, %(users)s) AS i, generate_series(0, %(days)s - 1) AS d
+        ''', {"every": CUSTOM_EVERY, "users": users, "days": days})
+
+
+def write_more(cur):
+    """Записи бота между падением и повторным запуском: месяц далеко впереди, правка, удаление."""
+    if has_status_text(cur):
+        cur.execute('''
+            INSERT INTO statuses (user_id, chat_id, status_text, date)
+            SELECT i, -1 - i / 10, 'свой статус впереди', current_date + 200 FROM generate_series(1, 5) AS i
+        ''')
+    else:
+        cur.execute('''
+            INSERT INTO statuses (user_id, chat_id, status_type_id, date)
+            SELECT i, -1 - i / 10, 3, current_date + 200 FROM generate_series(1, 5) AS i
+        ''')
+    cur.execute('UPDATE statuses SET date = date + 1 WHERE user_id = 1 AND date = current_date + 200')
+    cur.execute('DELETE FROM statuses WHERE user_id = 2 AND date = current_date')
+
+
+def snapshot(cur):
+    """То, что миграция не должна менять: строки статусов и агрегаты."""
+    cur.execute('SELECT count(*) FROM statuses')
+    rows = cur.fetchone()[0]
+    cur.execute('''
+        SELECT category, sum(count) FROM status_daily_counts
+        GROUP BY category HAVING sum(count) <> 0 ORDER BY category
+    ''')
+    return {"rows": rows, "daily_counts": dict(cur.fetchall())}
+
+
+# ========== ПРОВЕРКИ СХЕМЫ ==========
+def check_status_catalog(cur):
+    """Схема после миграции 8."""
+    problems = []
+    if has_status_text(cur):
+        problems.append("колонка status_text не удалена")
+    cur.execute('''
+        SELECT convalidated FROM pg_constraint
+        WHERE conrelid = 'statuses'::regclass AND conname = 'statuses_type_or_custom'
+    ''')
+    row = cur.fetchone()
+    if row is None or not row[0]:
+        problems.append("нет проверенного ограничения statuses_type_or_custom")
+    cur.execute('''
+        SELECT i.indisvalid, pg_get_indexdef(i.indexrelid) FROM pg_index i
+        WHERE i.indexrelid = to_regclass('idx_statuses_date')
+    ''')
+    row = cur.fetchone()
+    if row is None or not row[0] or 'status_type_id' not in row[1]:
+        problems.append(f"idx_statuses_date: {row}")
+    cur.execute('SELECT count(*) FROM statuses WHERE (status_type_id IS NULL) = (custom_text IS NULL)')
+    if cur.fetchone()[0]:
+        problems.append("есть строки без кода и без своего текста")
+    return problems
+
+
+def check_partitioned(cur):
+    """Схема после миграции 11."""
+    problems = []
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('statuses')")
+    if cur.fetchone()[0] != 'p':
+        problems.append("statuses не секционирована")
+    cur.execute("SELECT to_regclass('statuses_partitioned'), to_regproc('sync_statuses_partitioned')")
+    leftovers = [name for name in cur.fetchone() if name]
+    if leftovers:
+        problems.append(f"остались {leftovers}")
+    cur.execute('''
+        SELECT tgname FROM pg_trigger WHERE tgrelid = 'statuses'::regclass AND NOT tgisinternal ORDER BY tgname
+    ''')
+    triggers = [row[0] for row in cur.fetchall()]
+    if triggers != ['statuses_daily_counts', 'statuses_daily_counts_truncate', 'statuses_version_bump']:
+        problems.append(f"триггеры statuses: {triggers}")
+    cur.execute("SELECT to_regclass('idx_user_date'), to_regclass('idx_statuses_date')")
+    if not all(cur.fetchone()):
+        problems.append("нет idx_user_date или idx_statuses_date")
+    return problems
+
+
+def check_partition_move(cur):
+    """ensure_status_partition переносит строки из statuses_default без построчных триггеров."""
+    problems = []
+    conn = cur.connection
+    cur.execute("SELECT date_trunc('month', min(date))::date FROM statuses_default")
+    month = cur.fetchone()[0]
+    cur.execute('''
+        SELECT count(*) FROM statuses_default WHERE date >= %s AND date < %s + INTERVAL '1 month'
+    ''', (month, month))
+    to_move = cur.fetchone()[0]
+    before = snapshot(cur)
+    cur.execute('LISTEN status_changes')
+    conn.notifies.clear()
+    cur.execute('SELECT ensure_status_partition(%s)', (month,))
+    created = cur.fetchone()[0]
+    conn.poll()
+    cur.execute(f'SELECT count(*) FROM statuses_p{month:%Y_%m}')
+    moved = cur.fetchone()[0]
+    cur.execute('UNLISTEN status_changes')
+    if not created or moved != to_move:
+        problems.append(f"секция за {month}: создана {created}, перенесено {moved} из {to_move}")
+    if conn.notifies:
+        problems.append(f"перенос отправил {len(conn.notifies)} уведомлений")
+    if snapshot(cur) != before:
+        problems.append("перенос изменил агрегаты")
+    cur.execute("SELECT current_setting('sueta.bulk_import', true)")
+    if cur.fetchone()[0] == 'on':
+        problems.append("sueta.bulk_import остался включён после функции")
+    return problems
+
+
+CHECKS = {
+    8: check_status_catalog,
+    11: check_partitioned,
+    16: check_partition_move,
+}
+
+
+# ========== ПРОГОН ==========
+def run_case(conn, args, migration, fail_after):
+    """Миграция падает после fail_after шагов и запускается снова; возвращает список проблем."""
+    with conn.cursor() as cur:
+        reset_schema(cur, args.schema)
+    migrate_before(conn, migration.version)
+    with conn.cursor() as cur:
+        seed(cur, args.rows, args.days)
+
+    broken = migrations.Migration(migration.version, migration.name,
+                                  migration.steps[:fail_after] + [_fail], transactional=False)
+    try:
+        migrations.migrate(conn, [broken])
+        return ["подставленное падение не сработало"]
+    except InjectedFailure:
+        pass
+    with conn.cursor() as cur:
+        write_more(cur)
+        before = snapshot(cur)
+    try:
+        applied = migrations.migrate(conn, [migration])
+    except Exception as e:
+        return [f"повторный запуск упал: {type(e).__name__}: {e}".strip()]
+    problems = [] if applied == [migration.version] else [f"применены версии {applied}"]
+    with conn.cursor() as cur:
+        after = snapshot(cur)
+        if after != before:
+            problems.append(f"данные изменились: было {before}, стало {after}")
+        problems.extend(CHECKS[migration.version](cur))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--versions", type=int, nargs="+", default=sorted(CHECKS), choices=sorted(CHECKS))
+    parser.add_argument("--rows", type=int, default=3000, help="сколько статусов завести")
+    parser.add_argument("--days", type=int, default=90, help="за сколько последних дней статусы")
+    parser.add_argument("--schema", default="migration_bench", help="схема для прогона (удаляется)")
+    parser.add_argument("--output", help="файл для JSON с результатами")
+    args = parser.parse_args()
+
+    by_version = {m.version: m for m in migrations.MIGRATIONS}
+    results, failed = {}, False
+    conn = db.open_connection()
+    conn.autocommit = True
+    try:
+        for version in args.versions:
+            migration = by_version[version]
+            results[version] = {}
+            for fail_after in range(1, len(migration.steps) + 1):
+                started = time.perf_counter()
+                problems = run_case(conn, args, migration, fail_after)
+                elapsed = time.perf_counter() - started
+                results[version][fail_after] = problems
+                failed = failed or bool(problems)
+                print(f"{'ПРОВАЛ' if problems else 'OK    '} миграция {version}, падение после шага "
+                      f"{fail_after}/{len(migration.steps)} ({elapsed:.1f} с)" + "".join(f"\n    {p}" for p in problems))
+    finally:
+        with conn.cursor() as cur:
+            cur.execute(f'DROP SCHEMA IF EXISTS {args.schema} CASCADE')
+        conn.close()
+
+    print("OK" if not failed else "ПРОВАЛ")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"params": vars(args), "results": results, "passed": not failed}, f, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
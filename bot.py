@@ -1,7 +1,13 @@
+import asyncio
 import logging
 import sys
 import os
+import re
+import socket
 import calendar
+import functools
+import tempfile
+import time
 from datetime import date, datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
@@ -12,9 +18,23 @@ from telegram.ext import (
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import pytz
 
-# Для работы с PostgreSQL
-import psycopg2
-from psycopg2.extras import RealDictCursor
+# Общий слой доступа к PostgreSQL (пул соединений)
+import db
+from db import init_db
+# Асинхронные обёртки: запросы к БД не блокируют цикл событий
+import repository
+import retention
+from sender import BroadcastSender
+import export
+import journal
+from persistence import create_persistence
+import metrics
+from update_order import OrderedUpdateProcessor
+from repository import (
+    add_user, save_status_for_date, save_status_range,
+    delete_user_status_today, delete_user_status_by_date, delete_all_user_statuses,
+    get_statuses_next_week
+)
 
 # Загружаем переменные окружения из .env
 from dotenv import load_dotenv
@@ -22,266 +42,187 @@ load_dotenv()
 
 # Глобальная переменная для доступа к application из планировщика
 app = None
+# Фоновая задача metrics.monitor_event_loop
+_loop_monitor = None
 
 # Настройка логирования
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(levelname)s - %(trace_id)s - %(message)s',
     level=logging.INFO,
     handlers=[logging.StreamHandler(sys.stdout)]
 )
+# trace id обновления в каждой записи лога (TRACE_IDS=1, см. metrics.py)
+metrics.install_log_trace_ids()
 logger = logging.getLogger(__name__)
 
 # Состояния
 CHOOSING, TYPING_REPLY, SELECTING_START_DATE, SELECTING_END_DATE, SELECTING_CLEAR_DATE = range(5)
 
-# Предустановленные статусы (ОБНОВЛЕНО)
+# Предустановленные статусы (ОБНОВЛЕНО) — кнопки клавиатуры; совпадают с каталогом status_types (миграция 8)
 PRESET_STATUSES = ["✅ На работе", "🏡 Работаю дома", "🌴 В отпуске", "🤒 Болею", "✈️ В командировке", "🏖️ Выходной"]
 
 # ========== КАЛЕНДАРЬ ==========
-def create_calendar(year=None, month=None):
-    now = datetime.now()
-    if year is None: year = now.year
-    if month is None: month = now.month
+# callback_data кнопок календаря (остальные кнопки обрабатываются отдельно)
+CALENDAR_CALLBACK_PATTERN = r"^(cal:|prev:|next:|today$|ignore$)"
+
+# Подписи дней недели по локали (ключ кеша календаря)
+WEEKDAY_NAMES = {
+    "ru": ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"),
+}
 
-    prev_month = (month - 1) if month > 1 else 12
-    prev_year = year - 1 if month == 1 else year
-    next_month = (month + 1) if month < 12 else 1
-    next_year = year + 1 if month == 12 else year
+def _ignore_button(text):
+    return InlineKeyboardButton(text, callback_data="ignore")
+
+@functools.lru_cache(maxsize=128)
+def _month_grid(year, month, locale="ru"):
+    """Сетка месяца без подсветки: кортеж рядов кнопок (пересчитывается один раз)."""
+    prev_year, prev_month = (year - 1, 12) if month == 1 else (year, month - 1)
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
 
     keyboard = [
-        [InlineKeyboardButton(f"{month}/{year}", callback_data="ignore")]
+        (_ignore_button(f"{month}/{year}"),),
+        tuple(_ignore_button(name) for name in WEEKDAY_NAMES[locale]),
     ]
-    keyboard.append([
-        InlineKeyboardButton("Пн", callback_data="ignore"),
-        InlineKeyboardButton("Вт", callback_data="ignore"),
-        InlineKeyboardButton("Ср", callback_data="ignore"),
-        InlineKeyboardButton("Чт", callback_data="ignore"),
-        InlineKeyboardButton("Пт", callback_data="ignore"),
-        InlineKeyboardButton("Сб", callback_data="ignore"),
-        InlineKeyboardButton("Вс", callback_data="ignore")
-    ])
-
-    first_weekday = datetime(year, month, 1).weekday()
-    days_in_month = (datetime(year, month % 12 + 1, 1) - timedelta(days=1)).day if month < 12 else 31
-
-    week = []
-    for _ in range(first_weekday):
-        week.append(InlineKeyboardButton(" ", callback_data="ignore"))
+
+    first_weekday, days_in_month = calendar.monthrange(year, month)
+    week = [_ignore_button(" ")] * first_weekday
     for day in range(1, days_in_month + 1):
         week.append(InlineKeyboardButton(str(day), callback_data=f"cal:{year}-{month:02d}-{day:02d}"))
         if len(week) == 7:
-            keyboard.append(week)
+            keyboard.append(tuple(week))
             week = []
-    while len(week) < 7:
-        week.append(InlineKeyboardButton(" ", callback_data="ignore"))
     if week:
-        keyboard.append(week)
+        keyboard.append(tuple(week + [_ignore_button(" ")] * (7 - len(week))))
 
-    keyboard.append([
+    keyboard.append((
         InlineKeyboardButton("◀️", callback_data=f"prev:{prev_year}-{prev_month:02d}"),
-        InlineKeyboardButton("Сегодня", callback_data=f"today"),
+        InlineKeyboardButton("Сегодня", callback_data="today"),
         InlineKeyboardButton("▶️", callback_data=f"next:{next_year}-{next_month:02d}")
-    ])
-
-    return InlineKeyboardMarkup(keyboard)
-
-# ========== РАБОТА С БД ==========
-def get_db_connection():
-    return psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        port=int(os.getenv("DB_PORT")),
-        database=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASS")
+    ))
+    return tuple(keyboard)
+
+@functools.lru_cache(maxsize=128)
+def _calendar_markup(year, month, locale="ru", today_day=None):
+    """Готовая (неизменяемая) клавиатура месяца; today_day — подсветка сегодняшнего дня."""
+    grid = _month_grid(year, month, locale)
+    if today_day is None:
+        return InlineKeyboardMarkup(grid)
+    # Подсветка «сегодня» — замена одной кнопки поверх закешированной сетки
+    callback = f"cal:{year}-{month:02d}-{today_day:02d}"
+    rows = tuple(
+        tuple(
+            InlineKeyboardButton(f"•{today_day}•", callback_data=callback) if button.callback_data == callback else button
+            for button in row
+        )
+        for row in grid
     )
+    return InlineKeyboardMarkup(rows)
 
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id BIGINT PRIMARY KEY,
-            username TEXT,
-            chat_id BIGINT,
-            is_active BOOLEAN DEFAULT TRUE
-        )
-    ''')
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS statuses (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT NOT NULL,
-            chat_id BIGINT,
-            status_text TEXT NOT NULL,
-            date DATE NOT NULL
-        )
-    ''')
-    cur.execute('''
-        CREATE UNIQUE INDEX IF NOT EXISTS idx_user_date ON statuses (user_id, date)
-    ''')
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def add_user(user_id, username, chat_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO users (user_id, username, chat_id)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (user_id) DO NOTHING
-    ''', (user_id, username, chat_id))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def get_active_users(chat_id):
-    """Возвращает активных пользователей для чата."""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    cur.execute('SELECT user_id, username FROM users WHERE chat_id = %s AND is_active = TRUE', (chat_id,))
-    result = cur.fetchall()
-    cur.close()
-    conn.close()
-    return [(row['user_id'], row['username']) for row in result]
-
-def save_status_for_date(user_id, chat_id, status_text, target_date):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO statuses (user_id, chat_id, status_text, date)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (user_id, date)
-        DO UPDATE SET status_text = EXCLUDED.status_text, chat_id = EXCLUDED.chat_id
-    ''', (user_id, chat_id, status_text, target_date))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def save_status_range(user_id, chat_id, status_text, start_date, end_date):
-    current = start_date
-    while current <= end_date:
-        save_status_for_date(user_id, chat_id, status_text, current)
-        current += timedelta(days=1)
-
-def delete_user_status_today(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        DELETE FROM statuses
-        WHERE user_id = %s AND date = CURRENT_DATE
-    ''', (user_id,))
-    deleted = cur.rowcount
-    conn.commit()
-    cur.close()
-    conn.close()
-    return deleted > 0
-
-def delete_user_status_by_date(user_id, target_date):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        DELETE FROM statuses
-        WHERE user_id = %s AND date = %s
-    ''', (user_id, target_date))
-    deleted = cur.rowcount
-    conn.commit()
-    cur.close()
-    conn.close()
-    return deleted > 0
-
-def delete_all_user_statuses(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        DELETE FROM statuses
-        WHERE user_id = %s
-    ''', (user_id,))
-    deleted = cur.rowcount
-    conn.commit()
-    cur.close()
-    conn.close()
-    return deleted
-
-def get_statuses_next_week():
-    """Возвращает статусы команды на неделю вперёд (сегодня + 6 дней)."""
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    today = date.today()
-    next_week = today + timedelta(days=6)
-    cur.execute('''
-        SELECT u.username, s.status_text, s.date
-        FROM statuses s
-        JOIN users u ON s.user_id = u.user_id
-        WHERE s.date BETWEEN %s AND %s
-        ORDER BY s.date, u.username
-    ''', (today, next_week))
-    result = cur.fetchall()
-    cur.close()
-    conn.close()
-    return [(row['username'], row['status_text'], row['date']) for row in result]
+def create_calendar(year=None, month=None, locale="ru", today=None):
+    """Клавиатура-календарь; today — «сегодня» в часовом поясе чата (repository.local_today)."""
+    if today is None: today = db.local_today()
+    if year is None: year = today.year
+    if month is None: month = today.month
+    today_day = today.day if (year, month) == (today.year, today.month) else None
+    return _calendar_markup(year, month, locale, today_day)
 
 # ========== ЕЖЕДНЕВНЫЙ ОПРОС ==========
-async def daily_poll_job():
-    """Отправляет ежедневный опрос всем активным пользователям (кроме выходных и если статус уже установлен)."""
-    global app
+# Реплики бота делят рассылку на WORKER_COUNT шардов по user_id; реплика
+# начинает со своего шарда (WORKER_INDEX), затем забирает не занятые другими.
+# Шард защищён advisory-блокировкой, каждый получатель — строкой poll_ledger.
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Получателей за один заход: при падении процесса без опроса могут остаться
+# только уже закреплённые, но не отправленные (не больше POLL_BATCH)
+POLL_BATCH = int(os.getenv("POLL_BATCH", "200"))
+# Добор пропущенного (после перезапуска или недоступной реплики): раз в 10 минут
+# проверяются все, чьё время опроса наступило не раньше чем столько минут назад
+POLL_CATCHUP_MINUTES = int(os.getenv("POLL_CATCHUP_MINUTES", "180"))
+POLL_LEDGER_DAYS = 30
+# Минута (от эпохи), которую покрыл последний завершённый ежеминутный проход.
+# Пока идёт долгая рассылка, планировщик пропускает запуски (max_instances=1),
+# поэтому окно прохода тянется от неё до текущей минуты и ни одна минута не теряется
+_poll_covered_minute = None
+
+def _poll_window(catchup_minutes):
+    """Сколько минут назад от текущей начинается окно claim_poll_batch."""
+    if catchup_minutes or _poll_covered_minute is None:
+        return catchup_minutes
+    return max(0, min(POLL_CATCHUP_MINUTES, int(time.time() // 60) - _poll_covered_minute - 1))
+
+async def daily_poll_job(catchup_minutes=0):
+    """Отправляет опрос тем, у кого сейчас время опроса в их часовом поясе и рабочий день.
+
+    Запускается каждую минуту; время опроса, часовой пояс и рабочие дни задаются
+    для чата (/polltime, /timezone, /workdays) и при желании для пользователя.
+    Окно прохода — все минуты после предыдущего завершённого прохода, так что
+    рассылка дольше минуты не теряет следующие минуты. С catchup_minutes
+    досылает опрос всем, чьё время наступило за последние catchup_minutes
+    минут, но кому он ещё не уходил.
+    """
+    global app, _poll_covered_minute
     if app is None:
         logger.error("Application not initialized!")
         return
 
     try:
-        today = date.today()
-        # Проверяем, что сегодня не выходной (0=Пн, 6=Вс)
-        if today.weekday() >= 5:  # 5=Сб, 6=Вс
-            logger.info("Сегодня выходной — опрос не отправляется")
-            return
-
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Получаем всех активных пользователей
-        cur.execute('SELECT user_id, chat_id FROM users WHERE is_active = TRUE')
-        users = cur.fetchall()
-        cur.close()
-        conn.close()
+        if catchup_minutes:
+            await repository.purge_poll_ledger(db.local_today() - timedelta(days=POLL_LEDGER_DAYS))
+
+        keyboard = [[status] for status in PRESET_STATUSES] + [["✏️ Написать свой"]]
+        reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
+        sender = BroadcastSender(
+            app.bot,
+            concurrency=int(os.getenv("POLL_CONCURRENCY", "20")),
+            global_rate=float(os.getenv("POLL_RATE", "30"))
+        )
 
-        for user_id, chat_id in users:
+        sent = skipped = failed = retries = 0
+        started = datetime.now()
+        run_minute = int(time.time() // 60)
+        for i in range(WORKER_COUNT):
+            shard = (WORKER_INDEX + i) % WORKER_COUNT
+            lease = db.AdvisoryLease(db.POLL_LOCK_KEY, shard)
+            if not await repository.run(lease.acquire):
+                continue  # шард уже рассылает другая реплика
             try:
-                # Проверяем, есть ли уже статус на сегодня
-                conn_check = get_db_connection()
-                cur_check = conn_check.cursor()
-                cur_check.execute('''
-                    SELECT 1 FROM statuses 
-                    WHERE user_id = %s AND date = %s
-                ''', (user_id, today))
-                status_exists = cur_check.fetchone() is not None
-                cur_check.close()
-                conn_check.close()
-
-                if status_exists:
-                    logger.info(f"Статус пользователя {user_id} на {today} уже установлен — опрос не отправляется")
-                    continue
-
-                # Отправляем опрос
-                keyboard = [[status] for status in PRESET_STATUSES] + [["✏️ Написать свой"]]
-                reply_markup = ReplyKeyboardMarkup(keyboard, one_time_keyboard=False, resize_keyboard=True)
-                await app.bot.send_message(
-                    chat_id=user_id,
-                    text="📆 Как твой статус сегодня?",
-                    reply_markup=reply_markup
-                )
-                logger.info(f"Отправлен опрос пользователю {user_id}")
-                
-            except Exception as e:
-                logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-                
+                skipped += await repository.count_poll_skipped(shard, WORKER_COUNT, _poll_window(catchup_minutes))
+                while True:
+                    user_ids = await repository.claim_poll_batch(
+                        WORKER_ID, shard, WORKER_COUNT, POLL_BATCH, _poll_window(catchup_minutes)
+                    )
+                    if not user_ids:
+                        break
+                    summary = await sender.send_many([
+                        (user_id, {"text": "📆 Как твой статус сегодня?", "reply_markup": reply_markup})
+                        for user_id in user_ids
+                    ])
+                    failed_ids = set(summary.failed_chats)
+                    await repository.finish_poll_batch(
+                        WORKER_ID, [user_id for user_id in user_ids if user_id not in failed_ids], failed_ids
+                    )
+                    sent, failed, retries = sent + summary.sent, failed + summary.failed, retries + summary.retries
+            finally:
+                await repository.run(lease.release)
+        if not catchup_minutes:
+            _poll_covered_minute = run_minute
+
+        if sent or failed or (skipped and not catchup_minutes):
+            logger.info(
+                f"Опрос разослан{' (добор)' if catchup_minutes else ''}: отправлено {sent}, пропущено {skipped}, "
+                f"ошибок {failed}, повторов {retries}, за {(datetime.now() - started).total_seconds():.1f} с"
+            )
+
     except Exception as e:
         logger.error(f"Ошибка в daily_poll_job: {e}")
+        raise  # metrics.instrument_job учитывает ошибку в sueta_job_errors_total
 
 # ========== ОБРАБОТЧИКИ ==========
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat_id = update.effective_chat.id
-    add_user(user.id, user.username or user.first_name, chat_id)
+    await add_user(user.id, user.username or user.first_name, chat_id)
 
     keyboard = [
         ["/start", "/setstatus"],
@@ -296,29 +237,83 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "🔹 /setstatus — статус на сегодня\n"
         "🔹 /calendar — статус на период\n"
         "🔹 /status — показать статусы команды на неделю\n"  # ← ОБНОВЛЕНО
+        "🔹 /stats — сколько людей в офисе, дома, в отпуске по дням\n"
         "🔹 /clearstatus — удалить статус на сегодня\n"
         "🔹 /clearbydate — удалить статус на дату (через календарь)\n"
-        "🔹 /clearall — удалить все статусы",
+        "🔹 /clearall — удалить все статусы\n"
+        "🔹 /export — выгрузить статусы команды за месяц (CSV)\n"
+        "🔹 /polltime, /timezone, /workdays — время опроса, часовой пояс и рабочие дни",
         reply_markup=reply_markup
     )
 
+# Лимит Telegram на длину сообщения (в UTF-16 code units)
+MESSAGE_LIMIT = 4096
+# Максимальная длина имени и статуса в строке /status: вместе с заголовками
+# страница из db.STATUS_PAGE_SIZE строк гарантированно укладывается в MESSAGE_LIMIT
+USERNAME_LIMIT = 32
+STATUS_TEXT_LIMIT = 80
+
+def _utf16_len(text):
+    return len(text.encode("utf-16-le")) // 2
+
+def _clip(text, limit):
+    """Обрезает текст до limit UTF-16 code units (так считает длину Telegram)."""
+    text = str(text)
+    if _utf16_len(text) <= limit:
+        return text
+    chars, used = [], 0
+    for ch in text:
+        width = 2 if ord(ch) > 0xFFFF else 1
+        if used + width > limit - 1:
+            break
+        chars.append(ch)
+        used += width
+    return "".join(chars) + "…"
+
+def format_status_page(statuses, page):
+    """Собирает текст одной страницы /status."""
+    title = "📅 Статусы команды на неделю:" if page == 0 else f"📅 Статусы команды на неделю (стр. {page + 1}):"
+    lines = [title, ""]
+    current_date = None
+    for username, status, date_val in statuses:
+        if current_date != date_val:
+            current_date = date_val
+            lines.append(f"\n🗓️ {current_date}:")
+        lines.append(f"  👤 {_clip(username, USERNAME_LIMIT)}: {_clip(status, STATUS_TEXT_LIMIT)}")
+    msg = "\n".join(lines)
+    return msg if _utf16_len(msg) <= MESSAGE_LIMIT else _clip(msg, MESSAGE_LIMIT)
+
+def status_page_markup(page, has_next):
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"status_page:{page - 1}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Далее ▶️", callback_data=f"status_page:{page + 1}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
 async def show_status_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    statuses = get_statuses_next_week()  # ← ИЗМЕНЕНО: неделя вперёд
+    statuses, has_next = await get_statuses_next_week(update.effective_chat.id)
     if not statuses:
         await update.message.reply_text("Нет запланированных статусов на ближайшую неделю.")
     else:
-        msg = "📅 Статусы команды на неделю:\n\n"  # ← ОБНОВЛЕНО
-        current_date = None
-        for username, status, date_val in statuses:
-            if current_date != date_val:
-                current_date = date_val
-                msg += f"\n🗓️ {current_date}:\n"
-            msg += f"  👤 {username}: {status}\n"
-        await update.message.reply_text(msg)
+        await update.message.reply_text(format_status_page(statuses, 0), reply_markup=status_page_markup(0, has_next))
+
+async def status_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подгружает следующую/предыдущую страницу /status по кнопке."""
+    query = update.callback_query
+    await query.answer()
+    page = int(query.data.split(":", 1)[1])
+    statuses, has_next = await get_statuses_next_week(
+        query.message.chat.id, offset=page * db.STATUS_PAGE_SIZE
+    )
+    if not statuses:
+        await query.edit_message_text("Нет запланированных статусов на ближайшую неделю.")
+        return
+    await query.edit_message_text(format_status_page(statuses, page), reply_markup=status_page_markup(page, has_next))
 
 async def clear_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if delete_user_status_today(user_id):
+    if await delete_user_status_today(user_id):
         await update.message.reply_text("🗑️ Ваш статус на сегодня удалён.")
     else:
         await update.message.reply_text("ℹ️ У вас нет статуса на сегодня.")
@@ -327,12 +322,78 @@ async def clear_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def clear_by_date_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     context.user_data["mode"] = "clear"  # Устанавливаем режим удаления
-    await update.message.reply_text("Выбери дату для удаления статуса:", reply_markup=create_calendar())
+    today = await repository.local_today(update.effective_chat.id)
+    await update.message.reply_text("Выбери дату для удаления статуса:", reply_markup=create_calendar(today=today))
     return SELECTING_CLEAR_DATE
 
+def format_attendance(days, start_date, end_date):
+    """Текст /stats: число людей по категориям за каждый день и итог за период."""
+    def counts_line(counts):
+        return " · ".join(
+            f"{label.split(' ', 1)[0]} {counts[category]}"
+            for category, label in db.STATUS_CATEGORIES.items() if counts.get(category)
+        )
+
+    legend = ", ".join(db.STATUS_CATEGORIES.values())
+    lines = [f"📊 Статистика команды с {start_date} по {end_date}:", f"({legend})", ""]
+    totals = {}
+    for date_val, counts in days:
+        lines.append(f"🗓️ {date_val}: {counts_line(counts)}")
+        for category, count in counts.items():
+            totals[category] = totals.get(category, 0) + count
+    lines.append("")
+    lines.append(f"Итого (человеко-дней): {counts_line(totals)}")
+    return _clip("\n".join(lines), MESSAGE_LIMIT)
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats [с] [по] — сколько людей на работе/дома/в отпуске/... по дням (по умолчанию текущая неделя)."""
+    args = context.args or []
+    try:
+        today = await repository.local_today(update.effective_chat.id)
+        week_start = today - timedelta(days=today.weekday())
+        start_date = date.fromisoformat(args[0]) if len(args) > 0 else week_start
+        end_date = date.fromisoformat(args[1]) if len(args) > 1 else start_date + timedelta(days=6)
+    except ValueError:
+        await update.message.reply_text("Формат: /stats 2024-01-01 2024-01-31")
+        return
+    if end_date < start_date:
+        await update.message.reply_text("❌ Дата окончания не может быть раньше начала.")
+        return
+    days = await repository.get_attendance(start_date, end_date, update.effective_chat.id)
+    if not days:
+        await update.message.reply_text(f"Нет статусов с {start_date} по {end_date}.")
+        return
+    await update.message.reply_text(format_attendance(days, start_date, end_date))
+
+async def export_statuses(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [с] [по] [csv|ndjson] — выгрузка статусов команды файлом (по умолчанию текущий месяц)."""
+    args = list(context.args or [])
+    fmt = args.pop() if args and args[-1] in export.EXPORT_FORMATS else "csv"
+    try:
+        today = await repository.local_today(update.effective_chat.id)
+        start_date = date.fromisoformat(args[0]) if len(args) > 0 else today.replace(day=1)
+        end_date = date.fromisoformat(args[1]) if len(args) > 1 else today
+    except ValueError:
+        await update.message.reply_text("Формат: /export 2024-01-01 2024-01-31 [csv|ndjson]")
+        return
+    if end_date < start_date:
+        await update.message.reply_text("❌ Дата окончания не может быть раньше начала.")
+        return
+
+    # Файл держим в памяти, пока он небольшой, затем он уходит на диск
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as fileobj:
+        size = await repository.run(
+            export.export_to_file, fileobj, fmt, start_date, end_date, update.effective_chat.id
+        )
+        await update.message.reply_document(
+            document=fileobj,
+            filename=f"statuses_{start_date}_{end_date}.{fmt}",
+            caption=f"📤 Статусы команды с {start_date} по {end_date} ({size // 1024} КБ)"
+        )
+
 async def clear_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    deleted_count = delete_all_user_statuses(user_id)
+    deleted_count = await delete_all_user_statuses(user_id)
     if deleted_count > 0:
         await update.message.reply_text(f"🗑️ Все ваши статусы удалены ({deleted_count} записей).")
     else:
@@ -349,8 +410,8 @@ async def status_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if text == "✏️ Написать свой":
         await update.message.reply_text("Напиши свой статус:", reply_markup=ReplyKeyboardMarkup([["Отмена"]], resize_keyboard=True))
         return TYPING_REPLY
-    if text in PRESET_STATUSES:
-        save_status_for_date(update.effective_user.id, update.effective_chat.id, text, date.today())
+    if db.is_preset_status(text):
+        await save_status_for_date(update.effective_user.id, update.effective_chat.id, text)
         await update.message.reply_text("✅ Статус на сегодня обновлён!")
         return ConversationHandler.END
     await update.message.reply_text("Пожалуйста, выбери статус из кнопок.")
@@ -360,14 +421,15 @@ async def custom_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text == "Отмена":
         await update.message.reply_text("Отменено.")
         return ConversationHandler.END
-    save_status_for_date(update.effective_user.id, update.effective_chat.id, update.message.text, date.today())
+    await save_status_for_date(update.effective_user.id, update.effective_chat.id, update.message.text)
     await update.message.reply_text("✅ Статус на сегодня обновлён!")
     return ConversationHandler.END
 
 # ========== КАЛЕНДАРЬ ==========
 async def calendar_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
-    await update.message.reply_text("Выбери дату начала периода:", reply_markup=create_calendar())
+    today = await repository.local_today(update.effective_chat.id)
+    await update.message.reply_text("Выбери дату начала периода:", reply_markup=create_calendar(today=today))
     return SELECTING_START_DATE
 
 async def calendar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -376,14 +438,14 @@ async def calendar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     if data == "ignore":
         return
+    today = await repository.local_today(update.effective_chat.id)
     if data == "today":
-        today = date.today()
-        await query.edit_message_reply_markup(reply_markup=create_calendar(today.year, today.month))
+        await query.edit_message_reply_markup(reply_markup=create_calendar(today.year, today.month, today=today))
         return
     if data.startswith("prev:") or data.startswith("next:"):
         _, ym = data.split(":")
         year, month = map(int, ym.split("-"))
-        await query.edit_message_reply_markup(reply_markup=create_calendar(year, month))
+        await query.edit_message_reply_markup(reply_markup=create_calendar(year, month, today=today))
         return
     if data.startswith("cal:"):
         _, date_str = data.split(":", 1)
@@ -392,7 +454,7 @@ async def calendar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Режим удаления статуса
         if context.user_data.get("mode") == "clear":
             user_id = query.from_user.id
-            if delete_user_status_by_date(user_id, selected_date):
+            if await delete_user_status_by_date(user_id, selected_date):
                 await query.edit_message_text(f"🗑️ Ваш статус на {selected_date} удалён.")
             else:
                 await query.edit_message_text(f"ℹ️ У вас нет статуса на {selected_date}.")
@@ -402,13 +464,13 @@ async def calendar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Режим установки периода (старый код)
         if context.user_data.get("start_date") is None:
             context.user_data["start_date"] = selected_date
-            await query.edit_message_text(f"Начало: {selected_date}\nТеперь выбери дату окончания:", reply_markup=create_calendar(selected_date.year, selected_date.month))
+            await query.edit_message_text(f"Начало: {selected_date}\nТеперь выбери дату окончания:", reply_markup=create_calendar(selected_date.year, selected_date.month, today=today))
             return SELECTING_END_DATE
         else:
             start_date = context.user_data["start_date"]
             end_date = selected_date
             if end_date < start_date:
-                await query.edit_message_text("❌ Дата окончания не может быть раньше начала.\nВыбери дату окончания снова:", reply_markup=create_calendar(start_date.year, start_date.month))
+                await query.edit_message_text("❌ Дата окончания не может быть раньше начала.\nВыбери дату окончания снова:", reply_markup=create_calendar(start_date.year, start_date.month, today=today))
                 return SELECTING_END_DATE
             context.user_data["end_date"] = end_date
             keyboard = [[status] for status in PRESET_STATUSES] + [["✏️ Написать свой"]]
@@ -426,7 +488,7 @@ async def status_for_period(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return TYPING_REPLY
     start_date = context.user_data["start_date"]
     end_date = context.user_data["end_date"]
-    save_status_range(update.effective_user.id, update.effective_chat.id, text, start_date, end_date)
+    await save_status_range(update.effective_user.id, update.effective_chat.id, text, start_date, end_date)
     await update.message.reply_text(f"✅ Статус обновлён с {start_date} по {end_date}!")
     context.user_data.clear()
     return ConversationHandler.END
@@ -438,7 +500,7 @@ async def custom_status_period(update: Update, context: ContextTypes.DEFAULT_TYP
         return ConversationHandler.END
     start_date = context.user_data["start_date"]
     end_date = context.user_data["end_date"]
-    save_status_range(update.effective_user.id, update.effective_chat.id, update.message.text, start_date, end_date)
+    await save_status_range(update.effective_user.id, update.effective_chat.id, update.message.text, start_date, end_date)
     await update.message.reply_text(f"✅ Статус обновлён с {start_date} по {end_date}!")
     context.user_data.clear()
     return ConversationHandler.END
@@ -458,14 +520,14 @@ async def handle_poll_response(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Если ожидаем кастомный статус
     if context.user_data.get("awaiting_custom_status"):
-        save_status_for_date(user_id, chat_id, text, date.today())
+        await save_status_for_date(user_id, chat_id, text)
         await update.message.reply_text("✅ Статус на сегодня сохранён!")
         context.user_data.pop("awaiting_custom_status", None)
         return
     
     # Обработка стандартных статусов
-    if text in PRESET_STATUSES:
-        save_status_for_date(user_id, chat_id, text, date.today())
+    if db.is_preset_status(text):
+        await save_status_for_date(user_id, chat_id, text)
         await update.message.reply_text("✅ Статус на сегодня сохранён!")
         return
     
@@ -488,20 +550,175 @@ async def handle_poll_response(update: Update, context: ContextTypes.DEFAULT_TYP
         reply_markup=reply_markup
     )
 
+# ========== НАСТРОЙКИ ОПРОСА ==========
+# В группе команды меняют настройки чата (для всей команды), в личке — личные
+# настройки пользователя поверх настроек его чата («сброс» — снова как у чата).
+DAY_NUMBERS = {name.lower(): i for i, name in enumerate(WEEKDAY_NAMES["ru"])}
+
+def _parse_day(token):
+    if token.isdigit() and 1 <= int(token) <= 7:
+        return int(token) - 1
+    if token in DAY_NUMBERS:
+        return DAY_NUMBERS[token]
+    raise ValueError(f"Неизвестный день: {token}")
+
+def parse_workdays(text):
+    """«пн-пт», «пн,ср,пт» или «1-5» -> битовая маска (бит 0 — понедельник)."""
+    mask = 0
+    for token in re.split(r"[,\s]+", text.strip().lower()):
+        if not token:
+            continue
+        first, _, last = token.partition("-")
+        first = _parse_day(first)
+        last = _parse_day(last) if last else first
+        if last < first:
+            raise ValueError(f"Некорректный диапазон: {token}")
+        for day in range(first, last + 1):
+            mask |= 1 << day
+    if not mask:
+        raise ValueError("Не указаны дни")
+    return mask
+
+def format_workdays(mask):
+    names = WEEKDAY_NAMES["ru"]
+    days = [day for day in range(7) if mask & (1 << day)]
+    if not days:
+        return "никогда"
+    parts, start = [], days[0]
+    for prev, day in zip(days, days[1:] + [None]):
+        if day is None or day != prev + 1:
+            parts.append(names[start] if start == prev else f"{names[start]}–{names[prev]}")
+            start = day
+    return ", ".join(parts)
+
+def format_poll_settings(settings):
+    text = (
+        f"⏰ Опрос в {settings['poll_time']:%H:%M} ({settings['timezone']}), "
+        f"дни: {format_workdays(settings['working_days'])}"
+    )
+    if settings.get("overrides"):
+        text += "\n(личные настройки: " + ", ".join(settings["overrides"]) + "; «сброс» — как у чата)"
+    return text
+
+def _parse_poll_time(text):
+    return datetime.strptime(text, "%H:%M").time()
+
+def _parse_timezone(text):
+    try:
+        return pytz.timezone(text).zone
+    except pytz.UnknownTimeZoneError:
+        raise ValueError(f"Неизвестный часовой пояс: {text}") from None
+
+async def _poll_setting_command(update, context, name, parse, usage):
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    private = update.effective_chat.type == "private"
+    raw = " ".join(context.args or []).strip()
+    if raw:
+        try:
+            value = None if private and raw.lower() == "сброс" else parse(raw)
+            if private:
+                await repository.set_user_setting(user_id, chat_id, name, value)
+            else:
+                await repository.set_chat_setting(chat_id, name, value)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}\nФормат: {usage}")
+            return
+    if private:
+        settings = await repository.get_user_settings(user_id)
+    else:
+        settings = await repository.get_chat_settings(chat_id)
+    prefix = "✅ Сохранено. " if raw else ""
+    await update.message.reply_text(prefix + format_poll_settings(settings))
+
+async def poll_time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/polltime ЧЧ:ММ — время утреннего опроса (по часовому поясу из /timezone)."""
+    await _poll_setting_command(update, context, "poll_time", _parse_poll_time, "/polltime 09:30")
+
+async def timezone_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/timezone Регион/Город — часовой пояс опроса и «сегодня» для статусов."""
+    await _poll_setting_command(update, context, "timezone", _parse_timezone, "/timezone Europe/Berlin")
+
+async def workdays_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/workdays пн-пт — дни недели, в которые приходит опрос."""
+    await _poll_setting_command(update, context, "working_days", parse_workdays, "/workdays пн-пт или /workdays 1,3,5")
+
 # ========== ЗАПУСК ==========
 async def post_init(application: Application) -> None:
-    global app
+    global app, _loop_monitor
     app = application
     scheduler = AsyncIOScheduler(timezone=pytz.timezone('Europe/Moscow'))
-    scheduler.add_job(daily_poll_job, 'cron', hour=9, minute=0)
+    # Каждую минуту — «корзина» пользователей, у которых сейчас время опроса;
+    # раз в 10 минут — добор пропущенного (после перезапуска или падения реплики)
+    scheduler.add_job(metrics.instrument_job(daily_poll_job), 'cron', minute="*", max_instances=1, coalesce=True)
+    scheduler.add_job(
+        metrics.instrument_job(daily_poll_job, "poll_catchup"), 'interval', minutes=10,
+        kwargs={"catchup_minutes": POLL_CATCHUP_MINUTES}, max_instances=1, coalesce=True
+    )
+    scheduler.add_job(metrics.instrument_job(log_db_stats), 'interval', minutes=5)
+    # Секции statuses на следующие месяцы и политика хранения (см. retention.py)
+    scheduler.add_job(
+        metrics.instrument_job(retention.run_maintenance, "partition_maintenance"), 'cron', hour=3, minute=30
+    )
     scheduler.start()
-    logger.info("Планировщик запущен: ежедневный опрос в 9:00 по Москве")
+    # Записи статусов, оставшиеся в журнале с прошлого запуска, дописываются сразу
+    if repository.status_journal is not None:
+        await repository.status_journal.start()
+    logger.info("Планировщик запущен: опрос по расписанию чатов (проверка каждую минуту)")
+
+    # Метрики Prometheus отдельным HTTP-сервером и контроль задержки цикла событий
+    metrics_port = os.getenv("METRICS_PORT")
+    if metrics_port:
+        metrics.start_http_server(int(metrics_port))
+    _loop_monitor = asyncio.create_task(metrics.monitor_event_loop())
+
+async def post_shutdown(application: Application) -> None:
+    if _loop_monitor is not None:
+        _loop_monitor.cancel()
+    # Дописываем накопленные статусы до остановки пула потоков и соединений
+    if repository.status_journal is not None:
+        await repository.status_journal.close()
+    await repository.status_writer.close()
+    repository.shutdown()
+    db.close_pool()
+
+def log_db_stats():
+    logger.info(f"Пул БД: {db.pool_stats()}; кеш: {db.cache_stats()}")
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ошибки обработчиков: журнал ещё не дописан — просим повторить, остальное в лог."""
+    if isinstance(context.error, journal.ReplayPending):
+        logger.warning(str(context.error))
+        # Состояние диалога не меняется: повторное действие выполнит запись
+        if isinstance(update, Update) and update.effective_message:
+            await update.effective_message.reply_text("⏳ Предыдущие статусы ещё сохраняются, повторите через минуту.")
+        return
+    logger.error(f"Ошибка обработки обновления: {context.error}", exc_info=context.error)
 
-def main():
-    init_db()
+def build_application():
+    """Собирает Application со всеми обработчиками (без запуска)."""
     TOKEN = os.getenv("TELEGRAM_TOKEN")
 
-    application = Application.builder().token(TOKEN).post_init(post_init).build()
+    # Обновления разных пользователей обрабатываются параллельно, пока одно ждёт БД;
+    # одного пользователя — по очереди, как того требуют ConversationHandler'ы
+    concurrent_updates = OrderedUpdateProcessor(int(os.getenv("CONCURRENT_UPDATES", "32")))
+
+    builder = (
+        Application.builder().token(TOKEN)
+        .concurrent_updates(concurrent_updates)
+        .post_init(post_init).post_shutdown(post_shutdown)
+    )
+    # Запросы к Bot API считаются по методам и кодам ответа (в т.ч. 429)
+    builder = builder.request(metrics.InstrumentedRequest(connection_pool_size=256))
+    # Свой сервер Bot API (локальный telegram-bot-api или фейковый из benchmarks/)
+    api_url = os.getenv("TELEGRAM_API_URL")
+    if api_url:
+        builder = builder.base_url(api_url.rstrip("/") + "/bot")
+    # Состояние диалогов и user_data переживает перезапуск (см. persistence.py)
+    persistence = create_persistence()
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
 
     # Обработчик для ручной установки статуса (/setstatus)
     manual_conv_handler = ConversationHandler(
@@ -511,36 +728,51 @@ def main():
             TYPING_REPLY: [MessageHandler(filters.TEXT & ~filters.COMMAND, custom_status)],
         },
         fallbacks=[],
-        per_user=True
+        per_user=True,
+        name="manual_conv_handler",
+        persistent=persistence is not None
     )
 
     # Обработчики периодов и удаления (без изменений)
     period_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("calendar", calendar_start)],
         states={
-            SELECTING_START_DATE: [CallbackQueryHandler(calendar_handler)],
-            SELECTING_END_DATE: [CallbackQueryHandler(calendar_handler)],
+            SELECTING_START_DATE: [CallbackQueryHandler(calendar_handler, pattern=CALENDAR_CALLBACK_PATTERN)],
+            SELECTING_END_DATE: [CallbackQueryHandler(calendar_handler, pattern=CALENDAR_CALLBACK_PATTERN)],
             CHOOSING: [MessageHandler(filters.TEXT & ~filters.COMMAND, status_for_period)],
             TYPING_REPLY: [MessageHandler(filters.TEXT & ~filters.COMMAND, custom_status_period)],
         },
         fallbacks=[],
-        per_user=True
+        per_user=True,
+        name="period_conv_handler",
+        persistent=persistence is not None
     )
 
     clear_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("clearbydate", clear_by_date_start)],
         states={
-            SELECTING_CLEAR_DATE: [CallbackQueryHandler(calendar_handler)],
+            SELECTING_CLEAR_DATE: [CallbackQueryHandler(calendar_handler, pattern=CALENDAR_CALLBACK_PATTERN)],
         },
         fallbacks=[],
-        per_user=True
+        per_user=True,
+        name="clear_conv_handler",
+        persistent=persistence is not None
     )
 
     # Регистрация обработчиков
+    if persistence is not None:
+        # Состояние пользователя перечитывается до всех остальных обработчиков
+        application.add_handler(persistence.refresh_handler(), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("status", show_status_all))
+    application.add_handler(CallbackQueryHandler(status_page_handler, pattern=r"^status_page:\d+$"))
     application.add_handler(CommandHandler("clearstatus", clear_status))
     application.add_handler(CommandHandler("clearall", clear_all))
+    application.add_handler(CommandHandler("export", export_statuses))
+    application.add_handler(CommandHandler("stats", show_stats))
+    application.add_handler(CommandHandler("polltime", poll_time_command))
+    application.add_handler(CommandHandler("timezone", timezone_command))
+    application.add_handler(CommandHandler("workdays", workdays_command))
     
     # ВАЖНО: сначала специфичные обработчики, потом общий
     application.add_handler(manual_conv_handler)
@@ -550,7 +782,37 @@ def main():
     # Общий обработчик для всех текстовых сообщений (включая ответы на опрос)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_poll_response))
 
-    application.run_polling()
+    application.add_error_handler(error_handler)
+
+    _instrument_handlers(application)
+    return application
+
+def _instrument_handlers(application):
+    """Оборачивает callback каждого зарегистрированного обработчика в metrics.instrument_handler."""
+    def wrap(handler):
+        if isinstance(handler, ConversationHandler):
+            for nested in handler.entry_points + handler.fallbacks:
+                wrap(nested)
+            for state_handlers in handler.states.values():
+                for nested in state_handlers:
+                    wrap(nested)
+        elif not getattr(handler.callback, "__wrapped__", None):
+            handler.callback = metrics.instrument_handler(handler.callback)
+
+    for group in application.handlers.values():
+        for handler in group:
+            wrap(handler)
+
+def main():
+    init_db()
+    application = build_application()
+
+    # Режим получения обновлений: polling (по умолчанию) или webhook (см. webhook.py)
+    if os.getenv("BOT_MODE", "polling") == "webhook":
+        import webhook
+        asyncio.run(webhook.serve(application))
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
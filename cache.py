@@ -0,0 +1,146 @@
+"""Кеш чтения (TTL + LRU) для частых запросов с инвалидацией при записи.
+
+Записи кеша привязаны к области (scope), например к чату. Инвалидация не ищет и
+не удаляет ключи по всем репликам, а увеличивает номер поколения области:
+записи со старым поколением просто перестают находиться и вытесняются по LRU/TTL.
+Поколения хранятся в бэкенде — локально (LocalBackend) или в Redis-совместимом
+хранилище (RedisBackend), чтобы несколько реплик бота видели инвалидации друг друга.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Область, инвалидация которой сбрасывает все записи
+GLOBAL_SCOPE = "*"
+
+_MISSING = object()
+
+
+class LocalBackend:
+    """Поколения областей в памяти процесса (одна реплика, тесты)."""
+
+    def __init__(self):
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generations(self, scope):
+        with self._lock:
+            return self._generations.get(GLOBAL_SCOPE, 0), self._generations.get(scope, 0)
+
+    def bump(self, scope):
+        with self._lock:
+            self._generations[scope] = self._generations.get(scope, 0) + 1
+
+
+class RedisBackend:
+    """Поколения областей в Redis: INCR при инвалидации, MGET при чтении."""
+
+    def __init__(self, client, prefix="sueta:cache:gen:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis  # необязательная зависимость
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def generations(self, scope):
+        values = self.client.mget(self.prefix + GLOBAL_SCOPE, self.prefix + str(scope))
+        return tuple(int(v) if v is not None else 0 for v in values)
+
+    def bump(self, scope):
+        self.client.incr(self.prefix + str(scope))
+
+
+class TTLCache:
+    """LRU-кеш ограниченного размера с временем жизни записей."""
+
+    def __init__(self, maxsize=1024, ttl=60.0, backend=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend or LocalBackend()
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def _full_key(self, scope, key):
+        global_gen, scope_gen = self.backend.generations(scope)
+        return (scope, key, global_gen, scope_gen)
+
+    def get(self, scope, key):
+        return self._get(self._full_key(scope, key))
+
+    def _get(self, full_key):
+        with self._lock:
+            entry = self._data.get(full_key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(full_key)
+                    self._stats["hits"] += 1
+                    return value
+                del self._data[full_key]
+                self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+        return _MISSING
+
+    def set(self, scope, key, value):
+        self._store(self._full_key(scope, key), value)
+
+    def _store(self, full_key, value):
+        with self._lock:
+            self._data[full_key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(full_key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def get_or_load(self, scope, key, loader):
+        # Поколение берётся до запроса: если инвалидация случится, пока loader()
+        # читает БД, результат ляжет под старым поколением и не будет найден
+        full_key = self._full_key(scope, key)
+        value = self._get(full_key)
+        if value is _MISSING:
+            value = loader()
+            self._store(full_key, value)
+        return value
+
+    def invalidate(self, scope=GLOBAL_SCOPE):
+        """Сбрасывает записи области (по умолчанию — все записи)."""
+        self.backend.bump(scope)
+        with self._lock:
+            self._stats["invalidations"] += 1
+            # Локально устаревшие записи удаляем сразу, не дожидаясь вытеснения
+            for full_key in [k for k in self._data if scope == GLOBAL_SCOPE or k[0] == scope]:
+                del self._data[full_key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result["size"] = len(self._data)
+        result["maxsize"] = self.maxsize
+        return result
+
+
+def create_cache():
+    """Создаёт кеш по переменным окружения CACHE_MAXSIZE, CACHE_TTL, CACHE_REDIS_URL."""
+    redis_url = os.getenv("CACHE_REDIS_URL")
+    backend = None
+    if redis_url:
+        try:
+            backend = RedisBackend.from_url(redis_url)
+        except ImportError:
+            logger.warning("CACHE_REDIS_URL задан, но пакет redis не установлен — кеш будет локальным")
+    return TTLCache(
+        maxsize=int(os.getenv("CACHE_MAXSIZE", "1024")),
+        ttl=float(os.getenv("CACHE_TTL", "60")),
+        backend=backend
+    )
@@ -0,0 +1,880 @@
+"""Общий слой доступа к PostgreSQL для bot.py и web.py (пул соединений + запросы)."""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, time as dt_time, timedelta
+
+import psycopg2
+import pytz
+from psycopg2.extras import RealDictCursor, execute_values
+
+# Загружаем переменные окружения из .env
+from dotenv import load_dotenv
+load_dotenv()
+
+import cache
+import metrics
+import migrations
+
+logger = logging.getLogger(__name__)
+
+
+# ========== ПУЛ СОЕДИНЕНИЙ ==========
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведённое время."""
+
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений psycopg2.
+
+    В отличие от psycopg2.pool.ThreadedConnectionPool не падает при исчерпании,
+    а ждёт свободное соединение (до timeout секунд) и считает ожидания.
+    Перед выдачей соединение проверяется: закрытые выбрасываются, а простоявшие
+    дольше healthcheck_idle секунд пингуются через SELECT 1.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=10.0, healthcheck_idle=30.0, **conn_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Некорректные размеры пула: min={minconn}, max={maxconn}")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._conn_kwargs = conn_kwargs
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._idle = []  # [(conn, время возврата в пул)]
+        self._in_use = set()
+        self._closed = False
+        self._stats = {
+            "opened": 0,
+            "closed": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time": 0.0,
+            "timeouts": 0,
+            "healthcheck_failures": 0,
+        }
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._conn_kwargs)
+        metrics.DB_CONNECTIONS_OPENED.inc()
+        with self._lock:
+            self._stats["opened"] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._stats["closed"] += 1
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        if self._closed:
+            raise PoolTimeout("Пул закрыт")
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["waits"] += 1
+            acquired = self._slots.acquire(timeout=self.timeout)
+            waited = time.monotonic() - started
+            with self._lock:
+                self._stats["wait_time"] += waited
+                if not acquired:
+                    self._stats["timeouts"] += 1
+            if not acquired:
+                raise PoolTimeout(f"Нет свободных соединений за {self.timeout} с (max={self.maxconn})")
+        try:
+            conn = None
+            while conn is None:
+                with self._lock:
+                    idle = self._idle.pop() if self._idle else None
+                if idle is None:
+                    conn = self._connect()
+                elif self._is_healthy(*idle):
+                    conn = idle[0]
+                else:
+                    with self._lock:
+                        self._stats["healthcheck_failures"] += 1
+                    self._discard(idle[0])
+            with self._lock:
+                self._in_use.add(conn)
+                self._stats["checkouts"] += 1
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, close=False):
+        with self._lock:
+            if conn not in self._in_use:
+                return
+            self._in_use.discard(conn)
+        try:
+            if not close and not conn.closed:
+                if conn.status != psycopg2.extensions.STATUS_READY:
+                    conn.rollback()
+                with self._lock:
+                    if not self._closed:
+                        self._idle.append((conn, time.monotonic()))
+                        return
+            self._discard(conn)
+        except psycopg2.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result["in_use"] = len(self._in_use)
+            result["idle"] = len(self._idle)
+        result["min"] = self.minconn
+        result["max"] = self.maxconn
+        result["wait_time"] = round(result["wait_time"], 6)
+        return result
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _create_pool(connection_factory=None):
+    return ConnectionPool(
+        minconn=int(os.getenv("DB_POOL_MIN", "1")),
+        maxconn=int(os.getenv("DB_POOL_MAX", "10")),
+        timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        healthcheck_idle=float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30")),
+        connection_factory=connection_factory,
+        **connection_params()
+    )
+
+
+def get_pool():
+    """Возвращает общий пул процесса, создавая его при первом обращении."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _create_pool()
+    return _pool
+
+
+def init_pool(connection_factory=None):
+    """Создаёт общий пул процесса заново, закрыв прежний.
+
+    connection_factory — подкласс psycopg2.extensions.connection для всех
+    соединений пула (бенчмарки считают и перехватывают через него запросы).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = _create_pool(connection_factory)
+    return _pool
+
+
+def connection_params():
+    """Параметры подключения к PostgreSQL из окружения."""
+    return {
+        "host": os.getenv("DB_HOST"),
+        "port": int(os.getenv("DB_PORT")),
+        "database": os.getenv("DB_NAME"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASS"),
+        # Недоступный сервер не должен вешать поток на минуты (см. journal.py)
+        "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "5")),
+    }
+
+
+def open_connection():
+    """Отдельное соединение вне пула — для долгоживущего LISTEN (см. live.py)."""
+    conn = psycopg2.connect(**connection_params())
+    metrics.DB_CONNECTIONS_OPENED.inc()
+    return conn
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+def pool_stats():
+    """Статистика пула для мониторинга (in_use, waits, wait_time и т.д.)."""
+    return get_pool().stats()
+
+
+@contextmanager
+def get_connection():
+    """Берёт соединение из пула; коммитит при успехе, откатывает при ошибке."""
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+# ========== СХЕМА ==========
+def init_db():
+    """Приводит схему к актуальной версии (см. migrations.py) и загружает каталог статусов."""
+    with get_connection() as conn:
+        migrations.migrate(conn)
+    load_status_types()
+
+
+# ========== КАТАЛОГ СТАТУСОВ ==========
+# Пресеты хранятся в statuses.status_type_id (SMALLINT), свой текст — в custom_text.
+# Каталог маленький и меняется только миграциями, поэтому держим его в словарях.
+STATUS_TYPE_IDS = {}     # label -> id
+STATUS_TYPE_LABELS = {}  # id -> label
+_status_types_lock = threading.Lock()
+
+
+def load_status_types(force=False):
+    """Загружает каталог status_types (один раз за процесс, если не force)."""
+    if STATUS_TYPE_IDS and not force:
+        return
+    with _status_types_lock:
+        if STATUS_TYPE_IDS and not force:
+            return
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute('SELECT id, label FROM status_types ORDER BY id')
+            rows = cur.fetchall()
+        STATUS_TYPE_LABELS.clear()
+        STATUS_TYPE_LABELS.update(rows)
+        STATUS_TYPE_IDS.clear()
+        STATUS_TYPE_IDS.update((label, type_id) for type_id, label in rows)
+
+
+def is_preset_status(text):
+    """True, если text — один из пресетов каталога."""
+    load_status_types()
+    return text in STATUS_TYPE_IDS
+
+
+def split_status(text):
+    """Текст статуса -> (status_type_id, custom_text): заполнено ровно одно из полей."""
+    load_status_types()
+    type_id = STATUS_TYPE_IDS.get(text)
+    return (type_id, None) if type_id is not None else (None, text)
+
+
+def status_label(type_id, custom_text):
+    """Обратное к split_status: текст статуса для вывода."""
+    return STATUS_TYPE_LABELS[type_id] if type_id is not None else custom_text
+
+
+# ========== ПОЛЬЗОВАТЕЛИ ==========
+@metrics.timed_query
+def add_user(user_id, username, chat_id):
+    """Регистрирует пользователя (/start) и добавляет его в команду чата.
+
+    Первый чат становится домашним (users.chat_id); /start в другом чате
+    добавляет пользователя и в его команду — статусы видны в обоих.
+    """
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            INSERT INTO users (user_id, username, chat_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE
+            SET username = EXCLUDED.username, chat_id = EXCLUDED.chat_id, is_active = TRUE
+            WHERE users.username IS NULL AND NOT users.is_active
+        ''', (user_id, username, chat_id))
+        activated = cur.rowcount
+        cur.execute('SELECT join_chat(%s, %s)', (user_id, chat_id))
+        joined = cur.fetchone()[0]
+    if activated:
+        # Пользователь мог сменить чат команды — сбрасываем все чаты
+        invalidate_statuses()
+    elif joined:
+        invalidate_statuses(chat_id)
+
+
+@metrics.timed_query
+def get_active_users(chat_id):
+    """Возвращает активных пользователей для чата."""
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute('''
+            SELECT u.user_id, u.username
+            FROM memberships m
+            JOIN users u ON u.user_id = m.user_id
+            WHERE m.chat_id = %s AND u.is_active
+        ''', (chat_id,))
+        result = cur.fetchall()
+    return [(row['user_id'], row['username']) for row in result]
+
+
+# ========== СТАТУСЫ ==========
+# statuses.user_id ссылается на users: статус можно поставить и без /start, поэтому
+# перед записью заводим неактивного пользователя (в опрос он не попадёт).
+ENSURE_USER_SQL = '''
+    WITH ensure_user AS (
+        INSERT INTO users (user_id, chat_id, is_active)
+        VALUES (%s, %s, FALSE)
+        ON CONFLICT (user_id) DO NOTHING
+    ),
+'''
+
+# Запись возвращает число строк и чаты пользователя (memberships) — в них
+# сбрасывается кеш недельного вида. Для только что заведённого пользователя
+# подзапрос ещё не видит участие, поэтому берём переданный чат.
+WRITTEN_SQL = '''
+    SELECT count(*), COALESCE(NULLIF(ARRAY(SELECT chat_id FROM memberships WHERE user_id = %s), '{}'),
+                              ARRAY[%s::bigint])
+    FROM written
+'''
+
+
+def _invalidate_chats(chat_ids):
+    for chat_id in set(chat_ids):
+        if chat_id is not None:
+            invalidate_statuses(chat_id)
+
+
+@metrics.timed_query
+def save_status_for_date(user_id, chat_id, status_text, target_date=None):
+    """Сохраняет статус на дату; target_date=None — «сегодня» в часовом поясе пользователя."""
+    type_id, custom_text = split_status(status_text)
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(ENSURE_USER_SQL + '''
+            written AS (
+                INSERT INTO statuses (user_id, chat_id, status_type_id, custom_text, date)
+                VALUES (%s, %s, %s, %s, COALESCE(%s::date, user_today(%s, %s)))
+                ON CONFLICT (user_id, date)
+                DO UPDATE SET status_type_id = EXCLUDED.status_type_id, custom_text = EXCLUDED.custom_text,
+                              chat_id = EXCLUDED.chat_id
+                RETURNING 1
+            )
+        ''' + WRITTEN_SQL, (user_id, chat_id, user_id, chat_id, type_id, custom_text, target_date, user_id, chat_id,
+                            user_id, chat_id))
+        _, chat_ids = cur.fetchone()
+    _invalidate_chats(chat_ids)
+
+
+@metrics.timed_query
+def save_statuses_batch(rows):
+    """Сохраняет пачку статусов одним INSERT ... ON CONFLICT (см. write_behind.py, journal.py).
+
+    rows — кортежи (user_id, chat_id, status_text, target_date, written_at) в
+    порядке поступления; target_date=None — дата пользователя на момент
+    written_at (None — сейчас). Если на одну пару (user_id, date) пришло
+    несколько строк, побеждает последняя, поэтому повтор пачки ничего не меняет.
+    Возвращает число записанных строк.
+    """
+    if not rows:
+        return 0
+    values = [(seq, user_id, chat_id, *split_status(status_text), target_date, written_at)
+              for seq, (user_id, chat_id, status_text, target_date, written_at) in enumerate(rows)]
+    with get_connection() as conn, conn.cursor() as cur:
+        result = execute_values(cur, '''
+            WITH batch (seq, user_id, chat_id, status_type_id, custom_text, target_date, written_at) AS (VALUES %s),
+            ensure_user AS (
+                INSERT INTO users (user_id, chat_id, is_active)
+                SELECT DISTINCT ON (user_id) user_id, chat_id, FALSE FROM batch
+                ON CONFLICT (user_id) DO NOTHING
+            ),
+            latest AS (
+                SELECT DISTINCT ON (user_id, date) *
+                FROM (
+                    SELECT *, COALESCE(target_date, user_date(user_id, chat_id, COALESCE(written_at, now()))) AS date
+                    FROM batch
+                ) AS dated
+                ORDER BY user_id, date, seq DESC
+            ),
+            written AS (
+                INSERT INTO statuses (user_id, chat_id, status_type_id, custom_text, date)
+                SELECT user_id, chat_id, status_type_id, custom_text, date FROM latest
+                ON CONFLICT (user_id, date)
+                DO UPDATE SET status_type_id = EXCLUDED.status_type_id, custom_text = EXCLUDED.custom_text,
+                              chat_id = EXCLUDED.chat_id
+                RETURNING user_id, chat_id
+            )
+            SELECT (SELECT count(*) FROM written),
+                   ARRAY(SELECT DISTINCT COALESCE(m.chat_id, w.chat_id)
+                         FROM written w LEFT JOIN memberships m USING (user_id))
+        ''', values, template="(%s, %s::bigint, %s::bigint, %s::smallint, %s::text, %s::date, %s::timestamptz)",
+            page_size=len(values), fetch=True)
+    written, chat_ids = result[0]
+    _invalidate_chats(chat_ids)
+    return written
+
+
+@metrics.timed_query
+def save_status_range(user_id, chat_id, status_text, start_date, end_date, skip_weekends=False, holidays=None):
+    """Сохраняет статус на каждый день периода одним INSERT ... SELECT generate_series.
+
+    skip_weekends — пропускать субботу и воскресенье, holidays — даты, которые
+    тоже пропускаются. Возвращает число записанных строк.
+    """
+    type_id, custom_text = split_status(status_text)
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(ENSURE_USER_SQL + '''
+            written AS (
+                INSERT INTO statuses (user_id, chat_id, status_type_id, custom_text, date)
+                SELECT %s, %s, %s, %s, d::date
+                FROM generate_series(%s::date, %s::date, INTERVAL '1 day') AS d
+                WHERE (NOT %s OR EXTRACT(ISODOW FROM d) < 6)
+                  AND NOT (d::date = ANY(%s::date[]))
+                ON CONFLICT (user_id, date)
+                DO UPDATE SET status_type_id = EXCLUDED.status_type_id, custom_text = EXCLUDED.custom_text,
+                              chat_id = EXCLUDED.chat_id
+                RETURNING 1
+            )
+        ''' + WRITTEN_SQL, (user_id, chat_id, user_id, chat_id, type_id, custom_text, start_date, end_date,
+                            skip_weekends, list(holidays or []), user_id, chat_id))
+        written, chat_ids = cur.fetchone()
+    if written:
+        _invalidate_chats(chat_ids)
+    return written
+
+
+def _delete_statuses(user_id, condition, params=()):
+    """Удаляет статусы пользователя по условию; возвращает число удалённых строк."""
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            WITH written AS (
+                DELETE FROM statuses
+                WHERE user_id = %s AND ''' + condition + '''
+                RETURNING 1
+            )
+        ''' + WRITTEN_SQL, (user_id, *params, user_id, None))
+        deleted, chat_ids = cur.fetchone()
+    if deleted:
+        _invalidate_chats(chat_ids)
+    return deleted
+
+
+@metrics.timed_query
+def delete_user_status_today(user_id):
+    return _delete_statuses(user_id, 'date = user_today(%s, NULL)', (user_id,)) > 0
+
+
+@metrics.timed_query
+def delete_user_status_by_date(user_id, target_date):
+    return _delete_statuses(user_id, 'date = %s', (target_date,)) > 0
+
+
+@metrics.timed_query
+def delete_all_user_statuses(user_id):
+    return _delete_statuses(user_id, 'TRUE')
+
+
+# ========== УТРЕННИЙ ОПРОС ==========
+# Ключ advisory-блокировок шардов рассылки (второй ключ — номер шарда)
+POLL_LOCK_KEY = 4242002
+
+
+class AdvisoryLease:
+    """Сессионная advisory-блокировка PostgreSQL на отдельном соединении пула.
+
+    Снимается release() или сама при обрыве соединения — например, если
+    процесс упал посреди рассылки, и шард может подхватить другая реплика.
+    """
+
+    def __init__(self, key, subkey=0):
+        self.key = key
+        self.subkey = subkey
+        self._conn = None
+
+    def acquire(self):
+        """Пытается взять блокировку без ожидания; True — удалось."""
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_try_advisory_lock(%s, %s)', (self.key, self.subkey))
+                acquired = cur.fetchone()[0]
+            conn.commit()
+        except Exception:
+            pool.putconn(conn, close=True)
+            raise
+        if not acquired:
+            pool.putconn(conn)
+            return False
+        self._conn = conn
+        return True
+
+    def release(self):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        broken = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT pg_advisory_unlock(%s, %s)', (self.key, self.subkey))
+            conn.commit()
+        except psycopg2.Error:
+            broken = True
+        finally:
+            get_pool().putconn(conn, close=broken or bool(conn.closed))
+
+
+# Ищем получателей, чьё время опроса наступило, в каждом часовом поясе из
+# настроек: для пояса считается локальная минута суток, день недели и дата,
+# и poll_schedule читается по индексу (timezone, poll_minute) только в этой «корзине».
+POLL_BUCKETS_SQL = '''
+    WITH zones AS (
+        SELECT tz, now() AT TIME ZONE tz AS local_now
+        FROM (
+            SELECT timezone FROM chat_settings
+            UNION SELECT timezone FROM user_settings WHERE timezone IS NOT NULL
+            UNION SELECT %(default_tz)s
+        ) AS z (tz)
+    ),
+    buckets AS MATERIALIZED (
+        SELECT tz, local_now::date AS local_date,
+               (extract(hour FROM local_now) * 60 + extract(minute FROM local_now))::smallint AS minute,
+               (1 << (extract(isodow FROM local_now)::int - 1))::smallint AS day_bit
+        FROM zones
+    )
+'''
+
+
+@metrics.timed_query
+def claim_poll_batch(worker, shard=0, shards=1, limit=200, catchup_minutes=0):
+    """Закрепляет за worker до limit получателей опроса из шарда и возвращает их user_id.
+
+    Получатели — активные пользователи, у которых в их часовом поясе сейчас
+    время опроса (или оно было не раньше catchup_minutes минут назад) в рабочий
+    день, без статуса на свою текущую дату и без строки в poll_ledger. Строка
+    журнала вставляется до отправки, ON CONFLICT гарантирует, что пользователя
+    закрепит только одна реплика.
+    """
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(POLL_BUCKETS_SQL + '''
+            INSERT INTO poll_ledger (poll_date, user_id, claimed_by)
+            SELECT b.local_date, p.user_id, %(worker)s
+            FROM buckets b
+            JOIN poll_schedule p
+              ON p.timezone = b.tz AND p.poll_minute BETWEEN b.minute - %(catchup)s AND b.minute
+            WHERE p.working_days & b.day_bit <> 0
+              AND mod(p.user_id, %(shards)s) = %(shard)s
+              AND NOT EXISTS (SELECT 1 FROM statuses s WHERE s.user_id = p.user_id AND s.date = b.local_date)
+              AND NOT EXISTS (SELECT 1 FROM poll_ledger l WHERE l.poll_date = b.local_date AND l.user_id = p.user_id)
+            ORDER BY p.user_id
+            LIMIT %(limit)s
+            ON CONFLICT (poll_date, user_id) DO NOTHING
+            RETURNING user_id
+        ''', {"default_tz": DEFAULT_TIMEZONE, "worker": worker, "shard": shard, "shards": shards,
+              "limit": limit, "catchup": catchup_minutes})
+        return [row[0] for row in cur.fetchall()]
+
+
+@metrics.timed_query
+def count_poll_skipped(shard=0, shards=1, catchup_minutes=0):
+    """Сколько получателей опроса из шарда пропускается: статус уже есть или опрос уже ушёл.
+
+    Окно то же, что у claim_poll_batch; вызывается до рассылки шарда, иначе
+    в счёт попали бы и только что закреплённые. Неактивных нет в poll_schedule.
+    """
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute(POLL_BUCKETS_SQL + '''
+            SELECT count(*)
+            FROM buckets b
+            JOIN poll_schedule p
+              ON p.timezone = b.tz AND p.poll_minute BETWEEN b.minute - %(catchup)s AND b.minute
+            WHERE p.working_days & b.day_bit <> 0
+              AND mod(p.user_id, %(shards)s) = %(shard)s
+              AND (EXISTS (SELECT 1 FROM statuses s WHERE s.user_id = p.user_id AND s.date = b.local_date)
+                   OR EXISTS (SELECT 1 FROM poll_ledger l WHERE l.poll_date = b.local_date AND l.user_id = p.user_id))
+        ''', {"default_tz": DEFAULT_TIMEZONE, "shard": shard, "shards": shards, "catchup": catchup_minutes})
+        return cur.fetchone()[0]
+
+
+@metrics.timed_query
+def finish_poll_batch(worker, sent_ids, failed_ids=()):
+    """Отмечает в журнале результат отправки получателей, закреплённых за worker."""
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            UPDATE poll_ledger
+            SET result = CASE WHEN user_id = ANY(%s) THEN 'sent' ELSE 'failed' END, finished_at = now()
+            WHERE claimed_by = %s AND result = 'claimed' AND user_id = ANY(%s)
+        ''', (list(sent_ids), worker, list(sent_ids) + list(failed_ids)))
+
+
+def purge_poll_ledger(before_date):
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute('DELETE FROM poll_ledger WHERE poll_date < %s', (before_date,))
+        return cur.rowcount
+
+
+# ========== НАСТРОЙКИ ОПРОСА ==========
+# Значения по умолчанию (совпадают с миграцией 10). working_days — битовая маска:
+# бит 0 — понедельник, ..., бит 6 — воскресенье.
+DEFAULT_POLL_TIME = dt_time(9, 0)
+DEFAULT_TIMEZONE = "Europe/Moscow"
+DEFAULT_WORKING_DAYS = 0b0011111
+POLL_SETTINGS = ("poll_time", "timezone", "working_days")
+
+
+def _check_timezone(cur, timezone_name):
+    """Проверяет, что PostgreSQL знает часовой пояс (иначе сломается расписание)."""
+    try:
+        cur.execute('SAVEPOINT check_tz')
+        cur.execute('SELECT now() AT TIME ZONE %s', (timezone_name,))
+        cur.execute('RELEASE SAVEPOINT check_tz')
+    except psycopg2.DataError as e:
+        cur.execute('ROLLBACK TO SAVEPOINT check_tz')
+        raise ValueError(f"Неизвестный часовой пояс: {timezone_name}") from e
+
+
+def get_chat_settings(chat_id):
+    """Настройки опроса чата: {'poll_time', 'timezone', 'working_days'} (по умолчанию, если не заданы)."""
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute('SELECT poll_time, timezone, working_days FROM chat_settings WHERE chat_id = %s', (chat_id,))
+        row = cur.fetchone()
+    if row is None:
+        return {"poll_time": DEFAULT_POLL_TIME, "timezone": DEFAULT_TIMEZONE, "working_days": DEFAULT_WORKING_DAYS}
+    return dict(row)
+
+
+def get_user_settings(user_id):
+    """Итоговые настройки опроса пользователя и какие из них заданы лично ('overrides')."""
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute('''
+            SELECT COALESCE(us.poll_time, cs.poll_time, %s) AS poll_time,
+                   COALESCE(us.timezone, cs.timezone, %s) AS timezone,
+                   COALESCE(us.working_days, cs.working_days, %s) AS working_days,
+                   us.poll_time IS NOT NULL AS own_poll_time,
+                   us.timezone IS NOT NULL AS own_timezone,
+                   us.working_days IS NOT NULL AS own_working_days
+            FROM (SELECT %s::bigint AS user_id) AS q
+            LEFT JOIN users u ON u.user_id = q.user_id
+            LEFT JOIN chat_settings cs ON cs.chat_id = u.chat_id
+            LEFT JOIN user_settings us ON us.user_id = q.user_id
+        ''', (DEFAULT_POLL_TIME, DEFAULT_TIMEZONE, DEFAULT_WORKING_DAYS, user_id))
+        row = cur.fetchone()
+    settings = {name: row[name] for name in POLL_SETTINGS}
+    settings["overrides"] = [name for name in POLL_SETTINGS if row["own_" + name]]
+    return settings
+
+
+@metrics.timed_query
+def set_chat_setting(chat_id, name, value):
+    """Меняет одну настройку опроса чата; расписание участников пересчитывает триггер."""
+    if name not in POLL_SETTINGS:
+        raise ValueError(f"Неизвестная настройка: {name}")
+    with get_connection() as conn, conn.cursor() as cur:
+        if name == "timezone":
+            _check_timezone(cur, value)
+        cur.execute('''
+            INSERT INTO chat_settings (chat_id, ''' + name + ''') VALUES (%s, %s)
+            ON CONFLICT (chat_id) DO UPDATE SET ''' + name + ''' = EXCLUDED.''' + name + ''', updated_at = now()
+        ''', (chat_id, value))
+    invalidate_statuses(chat_id)
+
+
+@metrics.timed_query
+def set_user_setting(user_id, chat_id, name, value):
+    """Личная настройка опроса пользователя; value=None — снова как у чата команды."""
+    if name not in POLL_SETTINGS:
+        raise ValueError(f"Неизвестная настройка: {name}")
+    with get_connection() as conn, conn.cursor() as cur:
+        if name == "timezone" and value is not None:
+            _check_timezone(cur, value)
+        cur.execute(ENSURE_USER_SQL + '''
+            written AS (
+                INSERT INTO user_settings (user_id, ''' + name + ''') VALUES (%s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET ''' + name + ''' = EXCLUDED.''' + name + ''', updated_at = now()
+                RETURNING 1
+            )
+            SELECT count(*) FROM written
+        ''', (user_id, chat_id, user_id, value))
+
+
+def chat_timezone(chat_id):
+    """Часовой пояс чата (кешируется вместе с недельным видом чата)."""
+    def load():
+        with get_connection() as conn, conn.cursor() as cur:
+            cur.execute('SELECT timezone FROM chat_settings WHERE chat_id = %s', (chat_id,))
+            row = cur.fetchone()
+        return row[0] if row else DEFAULT_TIMEZONE
+    return status_cache.get_or_load(chat_id, "timezone", load)
+
+
+def local_today(chat_id=None):
+    """Текущая дата в часовом поясе чата (без чата — в DEFAULT_TIMEZONE)."""
+    timezone_name = chat_timezone(chat_id) if chat_id is not None else DEFAULT_TIMEZONE
+    return datetime.now(pytz.timezone(timezone_name)).date()
+
+
+# ========== НЕДЕЛЬНЫЙ ВИД ==========
+# Строк на одну страницу /status (см. bot.format_status_page)
+STATUS_PAGE_SIZE = int(os.getenv("STATUS_PAGE_SIZE", "30"))
+
+status_cache = cache.create_cache()
+
+
+def invalidate_statuses(chat_id=None):
+    """Сбрасывает кеш недельного вида чата (без chat_id — всех чатов)."""
+    status_cache.invalidate(cache.GLOBAL_SCOPE if chat_id is None else chat_id)
+
+
+def cache_stats():
+    """Счётчики кеша (hits/misses/evictions/...) для мониторинга."""
+    return status_cache.stats()
+
+
+metrics.STATUS_CACHE.set_function(lambda: {(stat,): value for stat, value in cache_stats().items()})
+
+
+def get_statuses_next_week(chat_id, offset=0, limit=None):
+    """Статусы команды чата на неделю вперёд (сегодня + 6 дней), одна страница.
+
+    Возвращает (список (username, status_text, date), есть ли следующая страница).
+    Страницы кешируются по чату и окну дат до ближайшей записи статуса в чате.
+    """
+    limit = limit or STATUS_PAGE_SIZE
+    today = local_today(chat_id)
+    next_week = today + timedelta(days=6)
+    return status_cache.get_or_load(
+        chat_id, (today, next_week, offset, limit),
+        lambda: _load_statuses(chat_id, today, next_week, offset, limit)
+    )
+
+
+# Время меряется здесь, а не в get_statuses_next_week: попадания в кеш — не запросы к БД
+@metrics.timed_query
+def _load_statuses(chat_id, start_date, end_date, offset, limit):
+    with get_connection() as conn, conn.cursor(cursor_factory=RealDictCursor) as cur:
+        # Берём на одну строку больше, чтобы узнать, есть ли следующая страница
+        cur.execute('''
+            SELECT u.username, s.status_type_id, s.custom_text, s.date
+            FROM memberships m
+            JOIN users u ON u.user_id = m.user_id
+            JOIN statuses s ON s.user_id = m.user_id
+            WHERE m.chat_id = %s AND s.date BETWEEN %s AND %s
+            ORDER BY s.date, u.username, u.user_id
+            LIMIT %s OFFSET %s
+        ''', (chat_id, start_date, end_date, limit + 1, offset))
+        result = cur.fetchall()
+    load_status_types()
+    rows = [(row['username'], status_label(row['status_type_id'], row['custom_text']), row['date'])
+            for row in result[:limit]]
+    return rows, len(result) > limit
+
+
+# ========== СТАТИСТИКА ПОСЕЩАЕМОСТИ ==========
+# Категории статусов (см. status_category в migrations.py) в порядке вывода
+STATUS_CATEGORIES = {
+    "office": "✅ На работе",
+    "remote": "🏡 Дома",
+    "vacation": "🌴 В отпуске",
+    "sick": "🤒 Болеют",
+    "trip": "✈️ В командировке",
+    "day_off": "🏖️ Выходной",
+    "other": "✏️ Другое",
+}
+
+
+@metrics.timed_query
+def get_attendance(start_date, end_date, chat_id=None):
+    """Число людей по категориям за каждый день периода из агрегатов status_daily_counts.
+
+    Возвращает [(date, {category: count})] по возрастанию даты; без chat_id — сумма
+    по всем чатам (участник нескольких команд учитывается в каждой).
+    """
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            SELECT date, category, sum(count)
+            FROM status_daily_counts
+            WHERE date BETWEEN %s AND %s
+              AND (%s::bigint IS NULL OR chat_id = %s)
+            GROUP BY date, category
+            HAVING sum(count) > 0
+            ORDER BY date
+        ''', (start_date, end_date, chat_id, chat_id))
+        rows = cur.fetchall()
+    days = {}
+    for date_val, category, count in rows:
+        days.setdefault(date_val, {})[category] = int(count)
+    return list(days.items())
+
+
+# ========== ДАШБОРД ==========
+@metrics.timed_query
+def get_statuses_version():
+    """Версия данных статусов и время последнего изменения (для ETag/Last-Modified)."""
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute('SELECT version, changed_at FROM statuses_version')
+        return cur.fetchone()
+
+
+@metrics.timed_query
+def get_dashboard_page(start_date, end_date, chat_id=None, after=None, limit=200):
+    """Страница дашборда с keyset-пагинацией.
+
+    Порядок — дата по убыванию, затем имя и user_id. after — курсор
+    (date, username, user_id) последней строки предыдущей страницы.
+    Возвращает (строки (date, username, status_text, category, user_id), курсор следующей страницы или None).
+    """
+    after_date, after_name, after_uid = after or (None, None, None)
+    # С фильтром по чату запрос идёт от участников (PK memberships) к их статусам
+    # по idx_user_date и не зависит от числа пользователей во всей базе
+    members = 'JOIN memberships m ON m.user_id = s.user_id AND m.chat_id = %(chat_id)s' if chat_id is not None else ''
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            SELECT s.date, COALESCE(u.username, '') AS username, s.status_type_id, s.custom_text,
+                   COALESCE(t.category, status_category(s.custom_text)), u.user_id
+            FROM statuses s
+            ''' + members + '''
+            JOIN users u ON s.user_id = u.user_id
+            LEFT JOIN status_types t ON t.id = s.status_type_id
+            WHERE s.date BETWEEN %(start)s AND %(end)s
+              AND (%(after_date)s::date IS NULL
+                   OR s.date < %(after_date)s
+                   OR (s.date = %(after_date)s
+                       AND (COALESCE(u.username, ''), u.user_id) > (%(after_name)s, %(after_uid)s)))
+            ORDER BY s.date DESC, COALESCE(u.username, ''), u.user_id
+            LIMIT %(limit)s
+        ''', {
+            "start": start_date, "end": end_date, "chat_id": chat_id,
+            "after_date": after_date, "after_name": after_name, "after_uid": after_uid,
+            "limit": limit + 1,
+        })
+        result = cur.fetchall()
+    load_status_types()
+    rows = [(row[0], row[1], status_label(row[2], row[3]), row[4], row[5]) for row in result[:limit]]
+    next_cursor = None
+    if len(result) > limit:
+        last = result[limit - 1]
+        next_cursor = (last[0], last[1], last[5])
+    return rows, next_cursor
@@ -0,0 +1,91 @@
+"""Потоковая выгрузка истории статусов в CSV или NDJSON.
+
+Строки читаются из именованного (серверного) курсора порциями по chunk_size и
+сразу превращаются в текст, поэтому расход памяти не зависит от размера периода.
+Используется эндпоинтом /export в web.py и командой /export бота.
+"""
+import csv
+import io
+import json
+
+import db
+import metrics
+
+EXPORT_COLUMNS = ("date", "user_id", "username", "chat_id", "status")
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+}
+
+
+def iter_status_rows(start_date, end_date, chat_id=None, chunk_size=5000):
+    """Строки (date, user_id, username, chat_id, status) за период, по дате и пользователю."""
+    with db.get_connection() as conn:
+        with conn.cursor(name="status_export") as cur:
+            cur.itersize = chunk_size
+            # Фильтр по чату — через участников чата (memberships), как в дашборде
+            members = 'JOIN memberships m ON m.user_id = s.user_id AND m.chat_id = %(chat_id)s' if chat_id is not None else ''
+            cur.execute('''
+                SELECT s.date, s.user_id, u.username, u.chat_id, COALESCE(t.label, s.custom_text)
+                FROM statuses s
+                ''' + members + '''
+                JOIN users u ON s.user_id = u.user_id
+                LEFT JOIN status_types t ON t.id = s.status_type_id
+                WHERE s.date BETWEEN %(start)s AND %(end)s
+                ORDER BY s.date, s.user_id
+            ''', {"start": start_date, "end": end_date, "chat_id": chat_id})
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+
+
+def iter_csv(rows, chunk_rows=1000):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for i, (date_val, user_id, username, chat_id, status) in enumerate(rows, 1):
+        writer.writerow((date_val.isoformat(), user_id, username or "", chat_id or "", status))
+        if i % chunk_rows == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_ndjson(rows, chunk_rows=1000):
+    lines = []
+    for date_val, user_id, username, chat_id, status in rows:
+        lines.append(json.dumps({
+            "date": date_val.isoformat(),
+            "user_id": user_id,
+            "username": username,
+            "chat_id": chat_id,
+            "status": status,
+        }, ensure_ascii=False))
+        if len(lines) >= chunk_rows:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+def generate(fmt, start_date, end_date, chat_id=None):
+    """Итератор текстовых кусков выгрузки в формате fmt ("csv" или "ndjson")."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    rows = iter_status_rows(start_date, end_date, chat_id)
+    return iter_csv(rows) if fmt == "csv" else iter_ndjson(rows)
+
+
+@metrics.timed_query
+def export_to_file(fileobj, fmt, start_date, end_date, chat_id=None):
+    """Пишет выгрузку в бинарный файл (для отправки документом). Возвращает число байт."""
+    size = 0
+    for chunk in generate(fmt, start_date, end_date, chat_id):
+        data = chunk.encode("utf-8")
+        fileobj.write(data)
+        size += len(data)
+    fileobj.seek(0)
+    return size
@@ -0,0 +1,353 @@
+"""Массовый импорт статусов (отпуска, командировки, графики) из CSV или NDJSON.
+
+Строка файла — (user, start, end, status):
+- user — user_id или имя пользователя Telegram (с @ или без); вместо user
+  допускается колонка user_id, так что файл /export загружается обратно;
+- start, end — даты YYYY-MM-DD или ДД.ММ.ГГГГ, end можно не указывать
+  (один день); вместо start допускается колонка date;
+- status — пресет («🌴 В отпуске», «В отпуске» или категория vacation) или свой текст.
+
+Строки проверяются при чтении, корректные уходят через COPY во временную
+таблицу, где сопоставляются с users и разворачиваются в дни
+(generate_series). Затем всё сливается в statuses одним INSERT ... ON CONFLICT.
+Если на один день пользователя приходится несколько строк, побеждает
+последняя. Агрегаты status_daily_counts пересчитываются одной операцией на
+весь импорт, а открытые дашборды получают один сигнал перезагрузки (построчные
+триггеры отключены, см. миграцию 13). На время слияния запись в statuses
+блокируется, чтобы агрегаты не разошлись с конкурентными записями.
+
+Запуск вручную:
+    python importer.py vacations.csv [--chat ID] [--skip-weekends] [--dry-run] [--strict]
+Веб: POST /import (см. web.py).
+"""
+import argparse
+import csv
+import io
+import json
+import logging
+import sys
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+IMPORT_FORMATS = ("csv", "ndjson")
+MAX_RANGE_DAYS = 366
+MAX_STATUS_LENGTH = 500
+# Ошибок в отчёте не больше этого; общее число считается всегда
+MAX_REPORTED_ERRORS = 1000
+BIGINT_MAX = 2 ** 63 - 1
+
+
+class RowError(ValueError):
+    """Ошибка проверки строки импорта."""
+
+
+@dataclass
+class ImportReport:
+    rows: int = 0          # строк с данными в файле
+    valid_rows: int = 0    # строк, прошедших проверку и сопоставление
+    days: int = 0          # записанных статусов (дней)
+    error_count: int = 0
+    errors: list = field(default_factory=list)  # [(номер строки, сообщение)]
+    dry_run: bool = False
+    applied: bool = False
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def to_dict(self):
+        return {
+            "rows": self.rows,
+            "valid_rows": self.valid_rows,
+            "days": self.days,
+            "error_count": self.error_count,
+            "errors": [{"line": line, "error": message} for line, message in self.errors],
+            "dry_run": self.dry_run,
+            "applied": self.applied,
+        }
+
+
+# ========== ЧТЕНИЕ И ПРОВЕРКА ==========
+def detect_format(filename, default="csv"):
+    """Формат по расширению файла: .ndjson/.jsonl — NDJSON, иначе default."""
+    lower = (filename or "").lower()
+    if lower.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    if lower.endswith(".csv"):
+        return "csv"
+    return default
+
+
+def _read_records(stream, fmt, report):
+    """(номер строки, dict) из текстового потока; нечитаемые строки уходят в отчёт."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        columns = set(reader.fieldnames or ())
+        if "status" not in columns or not {"user", "user_id"} & columns or not {"start", "date"} & columns:
+            raise ValueError(f"Нужны колонки user, start (или date), end, status; в файле: {reader.fieldnames}")
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == "ndjson":
+        for line_num, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                report.rows += 1
+                report.error(line_num, f"некорректный JSON: {e}")
+                continue
+            if not isinstance(record, dict):
+                report.rows += 1
+                report.error(line_num, "ожидался JSON-объект")
+                continue
+            yield line_num, record
+    else:
+        raise ValueError(f"Формат должен быть одним из {IMPORT_FORMATS}")
+
+
+def parse_date(value):
+    value = str(value or "").strip()
+    if not value:
+        raise RowError("не указана дата")
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    raise RowError(f"некорректная дата {value!r} (нужно YYYY-MM-DD или ДД.ММ.ГГГГ)")
+
+
+def parse_user(value):
+    """(user_id, None) для числа или (None, имя) для имени пользователя."""
+    value = str(value if value is not None else "").strip()
+    if value.isdigit():
+        user_id = int(value)
+        if user_id > BIGINT_MAX:
+            raise RowError(f"некорректный user_id {value}")
+        return user_id, None
+    name = value.lstrip("@")
+    if not name:
+        raise RowError("не указан пользователь")
+    return None, name
+
+
+def parse_record(record):
+    """Проверяет строку: (user_id, username, start, end, status)."""
+    user = record.get("user")
+    user_id, username = parse_user(user if user not in (None, "") else record.get("user_id"))
+    start = parse_date(record.get("start") or record.get("date"))
+    end = parse_date(record.get("end")) if str(record.get("end") or "").strip() else start
+    if end < start:
+        raise RowError(f"конец периода {end} раньше начала {start}")
+    if (end - start).days + 1 > MAX_RANGE_DAYS:
+        raise RowError(f"период длиннее {MAX_RANGE_DAYS} дней")
+    status = str(record.get("status") or "").strip()
+    if not status:
+        raise RowError("не указан статус")
+    if len(status) > MAX_STATUS_LENGTH:
+        raise RowError(f"статус длиннее {MAX_STATUS_LENGTH} символов")
+    return user_id, username, start, end, status
+
+
+def _status_aliases(cur):
+    """Написания пресетов -> id: полная подпись, подпись без эмодзи, категория."""
+    cur.execute('SELECT id, label, category FROM status_types')
+    aliases = {}
+    for type_id, label, category in cur.fetchall():
+        aliases[label.lower()] = type_id
+        aliases[label.split(" ", 1)[-1].lower()] = type_id
+        aliases[category] = type_id
+    return aliases
+
+
+# ========== ЗАГРУЗКА ==========
+STAGING_SQL = '''
+    CREATE TEMP TABLE status_import (
+        line INTEGER NOT NULL,
+        ref_id BIGINT,
+        ref_name TEXT,
+        start_date DATE NOT NULL,
+        end_date DATE NOT NULL,
+        status_type_id SMALLINT,
+        custom_text TEXT,
+        user_id BIGINT,
+        chat_id BIGINT,
+        matches INTEGER NOT NULL DEFAULT 0
+    ) ON COMMIT DROP
+'''
+
+# Сопоставление с users: по user_id и по имени (без учёта регистра); среди
+# участников чата, если он задан. Одно имя у нескольких пользователей — ошибка строки.
+RESOLVE_SQL = '''
+    UPDATE status_import i
+    SET user_id = u.user_id, chat_id = u.chat_id, matches = 1
+    FROM users u
+    WHERE u.user_id = i.ref_id
+      AND (%(chat_id)s::bigint IS NULL
+           OR EXISTS (SELECT 1 FROM memberships m WHERE m.chat_id = %(chat_id)s AND m.user_id = u.user_id));
+
+    UPDATE status_import i
+    SET user_id = m.user_id, chat_id = m.chat_id, matches = m.matches
+    FROM (
+        SELECT lower(username) AS name, min(user_id) AS user_id, min(chat_id) AS chat_id, count(*) AS matches
+        FROM users u
+        WHERE username IS NOT NULL
+          AND (%(chat_id)s::bigint IS NULL
+               OR EXISTS (SELECT 1 FROM memberships m WHERE m.chat_id = %(chat_id)s AND m.user_id = u.user_id))
+        GROUP BY lower(username)
+    ) m
+    WHERE i.ref_name IS NOT NULL AND m.name = lower(i.ref_name);
+
+    SELECT line, COALESCE(ref_id::text, '@' || ref_name), matches
+    FROM status_import
+    WHERE matches <> 1
+    ORDER BY line;
+'''
+
+EXPAND_SQL = '''
+    CREATE TEMP TABLE status_import_days ON COMMIT DROP AS
+    SELECT DISTINCT ON (i.user_id, d::date)
+           i.user_id, i.chat_id, d::date AS date, i.status_type_id, i.custom_text
+    FROM status_import i
+    CROSS JOIN generate_series(i.start_date, i.end_date, INTERVAL '1 day') AS d
+    WHERE i.matches = 1
+      AND (NOT %(skip_weekends)s OR extract(isodow FROM d) < 6)
+    ORDER BY i.user_id, d::date, i.line DESC
+'''
+
+# Агрегаты: вычитаем заменяемые статусы и добавляем новые (как track_status_counts,
+# но группами). Статус считается в каждом чате пользователя, как в add_status_count. Категорию считаем уже по
+# сгруппированным строкам: различных статусов в импорте единицы, а дней — сотни тысяч.
+COUNTS_SQL = '''
+    INSERT INTO status_daily_counts AS c (chat_id, date, category, count)
+    SELECT chat_id, date, status_row_category(status_type_id, custom_text), {sign} sum(n)
+    FROM (
+        SELECT COALESCE(m.chat_id, s.chat_id, 0) AS chat_id, s.date, s.status_type_id, s.custom_text, count(*) AS n
+        FROM {source} s
+        LEFT JOIN memberships m ON m.user_id = s.user_id
+        GROUP BY 1, 2, 3, 4
+    ) grouped
+    GROUP BY 1, 2, 3
+    ON CONFLICT (chat_id, date, category) DO UPDATE SET count = c.count + EXCLUDED.count
+'''
+
+MERGE_SQL = '''
+    INSERT INTO statuses (user_id, chat_id, status_type_id, custom_text, date)
+    SELECT user_id, chat_id, status_type_id, custom_text, date FROM status_import_days
+    ON CONFLICT (user_id, date)
+    DO UPDATE SET status_type_id = EXCLUDED.status_type_id, custom_text = EXCLUDED.custom_text,
+                  chat_id = EXCLUDED.chat_id
+    WHERE (statuses.status_type_id, statuses.custom_text, statuses.chat_id)
+          IS DISTINCT FROM (EXCLUDED.status_type_id, EXCLUDED.custom_text, EXCLUDED.chat_id)
+'''
+
+
+@metrics.timed_query
+def import_statuses(stream, fmt="csv", chat_id=None, skip_weekends=False, dry_run=False, strict=False):
+    """Импортирует статусы из текстового потока; возвращает ImportReport.
+
+    chat_id — искать пользователей только в этом чате, dry_run — только
+    проверить, strict — не записывать ничего, если есть хоть одна ошибка.
+    """
+    report = ImportReport(dry_run=dry_run)
+    with db.get_connection() as conn, conn.cursor() as cur:
+        aliases = _status_aliases(cur)
+        staged = io.StringIO()
+        writer = csv.writer(staged)
+        for line, record in _read_records(stream, fmt, report):
+            report.rows += 1
+            try:
+                user_id, username, start, end, status = parse_record(record)
+            except RowError as e:
+                report.error(line, str(e))
+                continue
+            type_id = aliases.get(status.lower())
+            writer.writerow([line, user_id, username, start, end, type_id, None if type_id else status])
+        staged.seek(0)
+
+        cur.execute(STAGING_SQL)
+        cur.copy_expert(
+            'COPY status_import (line, ref_id, ref_name, start_date, end_date, status_type_id, custom_text) '
+            'FROM STDIN WITH (FORMAT csv)', staged
+        )
+        cur.execute(RESOLVE_SQL, {"chat_id": chat_id})
+        for line, ref, matches in cur.fetchall():
+            report.error(line, f"пользователь {ref} не найден" if matches == 0
+                         else f"имя {ref} носят {matches} пользователя, укажите user_id")
+        report.errors.sort()
+        cur.execute('SELECT count(*) FROM status_import WHERE matches = 1')
+        report.valid_rows = cur.fetchone()[0]
+
+        cur.execute(EXPAND_SQL, {"skip_weekends": skip_weekends})
+        report.days = cur.rowcount
+        if dry_run or (strict and report.error_count) or not report.days:
+            conn.rollback()
+            return report
+
+        # Построчные триггеры (агрегаты, уведомления) в этой транзакции молчат,
+        # а конкурентные записи статусов ждут конца слияния
+        cur.execute("SET LOCAL sueta.bulk_import = 'on'")
+        cur.execute('LOCK TABLE statuses IN SHARE ROW EXCLUSIVE MODE')
+        cur.execute('ANALYZE status_import_days')
+        cur.execute(COUNTS_SQL.format(sign="-", source='''(
+            SELECT s.* FROM statuses s JOIN status_import_days d USING (user_id, date)
+        )'''))
+        cur.execute(MERGE_SQL)
+        cur.execute(COUNTS_SQL.format(sign="", source="status_import_days"))
+        cur.execute('''
+            SELECT DISTINCT m.chat_id
+            FROM (SELECT DISTINCT user_id FROM status_import_days) d
+            JOIN memberships m USING (user_id)
+        ''')
+        chats = [row[0] for row in cur.fetchall()]
+        cur.execute("SELECT pg_notify('status_changes', %s)", (json.dumps({"op": "reset"}),))
+        report.applied = True
+
+    for chat in chats:
+        db.invalidate_statuses(chat)
+    logger.info(f"Импорт статусов: строк {report.rows}, записано дней {report.days}, ошибок {report.error_count}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Массовый импорт статусов из CSV или NDJSON")
+    parser.add_argument("file", help="файл .csv, .ndjson или - для stdin")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="по умолчанию — по расширению файла")
+    parser.add_argument("--chat", type=int, help="искать пользователей только в этом чате")
+    parser.add_argument("--skip-weekends", action="store_true", help="не ставить статус на субботу и воскресенье")
+    parser.add_argument("--dry-run", action="store_true", help="только проверить файл")
+    parser.add_argument("--strict", action="store_true", help="ничего не записывать при ошибках")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    fmt = args.format or detect_format(args.file)
+    db.init_db()
+    try:
+        if args.file == "-":
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig", newline="")
+            report = import_statuses(stream, fmt, args.chat, args.skip_weekends, args.dry_run, args.strict)
+        else:
+            with open(args.file, encoding="utf-8-sig", newline="") as stream:
+                report = import_statuses(stream, fmt, args.chat, args.skip_weekends, args.dry_run, args.strict)
+    finally:
+        db.close_pool()
+
+    for line, message in report.errors:
+        print(f"строка {line}: {message}")
+    if report.error_count > len(report.errors):
+        print(f"... и ещё {report.error_count - len(report.errors)} ошибок")
+    state = "проверено (dry run)" if report.dry_run else ("записано" if report.applied else "не записано")
+    print(f"Строк: {report.rows}, корректных: {report.valid_rows}, дней: {report.days} — {state}; "
+          f"ошибок: {report.error_count}")
+    sys.exit(1 if report.error_count else 0)
+
+
+if __name__ == '__main__':
+    main()
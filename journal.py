@@ -0,0 +1,336 @@
+"""Локальный журнал записей статусов: подтверждение без ожидания PostgreSQL.
+
+Если PostgreSQL тормозит или недоступен, ответ на утренний опрос не должен
+теряться или вешать обработчик. save_status_for_date (repository.py) при
+заданном STATUS_JOURNAL пишет статус в SQLite-файл (WAL, synchronous=FULL —
+запись переживает и падение процесса, и отключение питания) и сразу
+подтверждает пользователю. Одновременные записи коммитятся одной транзакцией
+(write_behind.py с нулевой задержкой), так что fsync один на пачку.
+
+Фоновая задача дописывает журнал в БД пачками по JOURNAL_REPLAY_BATCH строк
+строго по порядку (db.save_statuses_batch — upsert по (user_id, date), повтор
+пачки ничего не меняет) и только потом удаляет их из журнала. При ошибке
+соединения пачка повторяется с растущей паузой; строку, которую БД отвергла
+(например, нарушение ограничения), журнал откладывает в таблицу failed, чтобы
+она не блокировала остальные. Дата «сегодня» считается на момент нажатия
+(written_at), а не дописывания.
+
+Прямые записи статусов пользователя (период, удаление) сначала ждут, пока его
+записи из журнала дойдут до БД (wait_replayed), иначе старый ответ из журнала
+перезаписал бы более новое действие; не дождавшись за JOURNAL_SYNC_TIMEOUT,
+запись не выполняется (ReplayPending), и бот просит повторить. Отставание видно
+на /health и в метриках sueta_journal_*.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+
+import psycopg2
+
+import db
+import metrics
+import write_behind
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_PATH = os.getenv("STATUS_JOURNAL", "")
+REPLAY_BATCH = int(os.getenv("JOURNAL_REPLAY_BATCH", "500"))
+# Отставание, после которого /health отвечает 503
+LAG_UNHEALTHY = float(os.getenv("JOURNAL_LAG_UNHEALTHY", "60"))
+# Сколько прямая запись статуса ждёт дописывания журнала пользователя
+SYNC_TIMEOUT = float(os.getenv("JOURNAL_SYNC_TIMEOUT", "10"))
+# Сколько при остановке пытаемся дописать журнал (остаток — при следующем запуске)
+DRAIN_TIMEOUT = float(os.getenv("JOURNAL_DRAIN_TIMEOUT", "5"))
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS journal (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        chat_id INTEGER,
+        status_text TEXT NOT NULL,
+        target_date TEXT,
+        written_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS failed (
+        seq INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        chat_id INTEGER,
+        status_text TEXT NOT NULL,
+        target_date TEXT,
+        written_at REAL NOT NULL,
+        error TEXT NOT NULL,
+        failed_at REAL NOT NULL
+    );
+'''
+COLUMNS = "seq, user_id, chat_id, status_text, target_date, written_at"
+
+
+# Ошибки связи с БД: пачку стоит повторить позже
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, db.PoolTimeout, OSError,
+                    asyncio.TimeoutError)
+
+
+class ReplayPending(Exception):
+    """Записи пользователя из журнала не дошли до БД за отведённое время."""
+
+
+def is_permanent_error(error):
+    """Ошибка в самой записи (ограничение БД, некорректные данные): повтор не поможет."""
+    return not isinstance(error, TRANSIENT_ERRORS)
+
+
+class StatusJournal:
+    """Журнал в SQLite; replay — корутина, принимающая строки для db.save_statuses_batch."""
+
+    def __init__(self, path, replay, batch_size=REPLAY_BATCH, synchronous="FULL"):
+        self.path = path
+        self.batch_size = batch_size
+        self.synchronous = synchronous
+        self._replay = replay
+        # Все обращения к SQLite — в одном потоке со своим соединением
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal")
+        self._conn = None
+        self._keys = itertools.count()
+        self._appender = write_behind.WriteBehindBuffer(self._append_rows, max_rows=batch_size, max_delay=0,
+                                                        name="journal")
+        self._task = None
+        self._start_lock = None  # asyncio-примитивы создаются в цикле событий бота
+        self._wakeup = None
+        self._replayed = None
+        self._closing = False
+        self._acked_seq = 0
+        self._last_seq = {}  # user_id -> последняя запись пользователя в журнале
+        self.last_error = None
+        self.last_replay_at = None
+        self._counts = (0, None, 0)  # последние (pending, oldest written_at, failed)
+
+    # ========== SQLite (поток журнала) ==========
+    def _call(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        conn.executescript(SCHEMA)
+        self._conn = conn
+        return conn.execute('SELECT user_id, max(seq) FROM journal GROUP BY user_id').fetchall()
+
+    def _insert(self, rows):
+        cur = self._conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            seqs = []
+            for row in rows:
+                cur.execute('INSERT INTO journal (user_id, chat_id, status_text, target_date, written_at) '
+                            'VALUES (?, ?, ?, ?, ?)', row)
+                seqs.append(cur.lastrowid)
+            cur.execute('COMMIT')
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+        return seqs
+
+    def _read(self, limit):
+        return self._conn.execute(f'SELECT {COLUMNS} FROM journal ORDER BY seq LIMIT ?', (limit,)).fetchall()
+
+    def _ack(self, last_seq):
+        self._conn.execute('DELETE FROM journal WHERE seq <= ?', (last_seq,))
+
+    def _reject(self, entry, error):
+        cur = self._conn.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        cur.execute(f'INSERT OR REPLACE INTO failed ({COLUMNS}, error, failed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (*entry, error, time.time()))
+        cur.execute('DELETE FROM journal WHERE seq = ?', (entry[0],))
+        cur.execute('COMMIT')
+
+    def _stats(self):
+        pending, oldest = self._conn.execute('SELECT count(*), min(written_at) FROM journal').fetchone()
+        failed = self._conn.execute('SELECT count(*) FROM failed').fetchone()[0]
+        return pending, oldest, failed
+
+    def _close_db(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    # ========== ЗАПИСЬ ==========
+    async def start(self):
+        """Открывает журнал и запускает дописывание (в т.ч. оставшегося с прошлого запуска)."""
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._task is None or self._task.done():
+                await self._start()
+
+    async def _start(self):
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        self._replayed = asyncio.Condition()
+        if self._conn is None:
+            for user_id, seq in await self._call(self._open):
+                self._last_seq[user_id] = seq
+            if self._last_seq:
+                logger.info(f"В журнале {self.path} остались записи {len(self._last_seq)} пользователей, дописываем")
+            self.register_metrics()
+        self._wakeup.set()
+        self._task = asyncio.create_task(self._run(), name="journal-replay")
+
+    async def append(self, user_id, chat_id, status_text, target_date=None):
+        """Записывает статус в журнал; возвращается после fsync, не дожидаясь БД."""
+        if self._task is None:
+            await self.start()
+        row = (user_id, chat_id, status_text, target_date.isoformat() if target_date else None, time.time())
+        await self._appender.submit(next(self._keys), row)
+
+    async def _append_rows(self, rows):
+        seqs = await self._call(self._insert, rows)
+        for row, seq in zip(rows, seqs):
+            self._last_seq[row[0]] = seq
+        self._wakeup.set()
+
+    async def wait_replayed(self, user_id, timeout=SYNC_TIMEOUT):
+        """Ждёт, пока записи пользователя из журнала дойдут до БД; False — не дождались за timeout."""
+        seq = self._last_seq.get(user_id)
+        if seq is None or self._replayed is None or seq <= self._acked_seq:
+            return True
+        async with self._replayed:
+            try:
+                await asyncio.wait_for(self._replayed.wait_for(lambda: seq <= self._acked_seq), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Журнал пользователя {user_id} не дописан за {timeout:.0f} с")
+                return False
+        return True
+
+    # ========== ДОПИСЫВАНИЕ В БД ==========
+    async def _run(self):
+        delay = RETRY_DELAY
+        while True:
+            # Сброс до чтения: запись, пришедшая во время чтения, снова разбудит цикл
+            self._wakeup.clear()
+            entries = await self._call(self._read, self.batch_size)
+            if not entries:
+                if self._closing:
+                    return
+                await self._wakeup.wait()
+                continue
+            try:
+                await self._replay_entries(entries)
+            except Exception as e:
+                metrics.JOURNAL_REPLAY_ERRORS.inc(error=type(e).__name__)
+                self.last_error = f"{type(e).__name__}: {e}"
+                if self._closing:
+                    return
+                logger.warning(f"Журнал не дописан в БД ({self.last_error}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+            delay = RETRY_DELAY
+            self.last_error = None
+            self.last_replay_at = time.time()
+            await self._acknowledge(entries)
+
+    async def _replay_entries(self, entries):
+        try:
+            await self._replay([_row(entry) for entry in entries])
+            metrics.JOURNAL_REPLAYED.inc(len(entries))
+            return
+        except Exception as e:
+            if not is_permanent_error(e):
+                raise
+            if len(entries) == 1:
+                await self._reject_entry(entries[0], e)
+                return
+        # Пачку отвергла одна из строк (БД или split_status/разбор даты):
+        # дописываем по одной, по порядку, а негодную откладываем в failed
+        for entry in entries:
+            try:
+                await self._replay([_row(entry)])
+            except Exception as e:
+                if not is_permanent_error(e):
+                    raise
+                await self._reject_entry(entry, e)
+            else:
+                metrics.JOURNAL_REPLAYED.inc()
+            await self._acknowledge([entry])
+
+    async def _reject_entry(self, entry, error):
+        logger.error(f"БД отвергла запись журнала {entry[0]} (пользователь {entry[1]}): {error}")
+        metrics.JOURNAL_REJECTED.inc()
+        await self._call(self._reject, entry, f"{type(error).__name__}: {error}")
+
+    async def _acknowledge(self, entries):
+        last = entries[-1][0]
+        if last <= self._acked_seq:
+            return
+        await self._call(self._ack, last)
+        self._acked_seq = last
+        for entry in entries:
+            if self._last_seq.get(entry[1], 0) <= last:
+                self._last_seq.pop(entry[1], None)
+        async with self._replayed:
+            self._replayed.notify_all()
+
+    # ========== СОСТОЯНИЕ ==========
+    def stats(self):
+        """{'pending', 'lag_seconds', 'failed', ...} — для /health и метрик.
+
+        После close() (и пока журнал не открыт) — последние известные значения.
+        """
+        if self._conn is not None:
+            try:
+                self._counts = self._executor.submit(self._stats).result(timeout=5)
+            except RuntimeError:
+                pass  # журнал закрывается: поток SQLite уже остановлен
+        pending, oldest, failed = self._counts
+        return {
+            "pending": pending,
+            "lag_seconds": round(time.time() - oldest, 3) if oldest else 0.0,
+            "failed": failed,
+            "last_error": self.last_error,
+            "last_replay_at": self.last_replay_at,
+        }
+
+    def health(self):
+        stats = self.stats()
+        # Задача дописывания завершается сама только при close(); иначе она упала
+        crashed = self._task is not None and self._task.done() and not self._closing
+        stats["ok"] = stats["lag_seconds"] < LAG_UNHEALTHY and not crashed
+        return stats
+
+    def register_metrics(self):
+        """Подключает журнал к /health и gauge sueta_journal_*."""
+        metrics.register_health_check("journal", self.health)
+        metrics.JOURNAL_PENDING.set_function(lambda: self.stats()["pending"])
+        metrics.JOURNAL_LAG.set_function(lambda: self.stats()["lag_seconds"])
+
+    async def close(self, timeout=DRAIN_TIMEOUT):
+        """Дописывает принятые записи в журнал и в течение timeout — в БД, затем закрывает файл."""
+        await self._appender.close()
+        self._closing = True
+        if self._task is not None:
+            self._wakeup.set()
+            try:
+                await asyncio.wait_for(asyncio.shield(self._task), timeout)
+            except asyncio.TimeoutError:
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+                logger.warning(f"Журнал {self.path} дописан не полностью, остаток — при следующем запуске")
+            self._task = None
+        await self._call(self._close_db)
+        self._executor.shutdown(wait=True)
+
+
+def _row(entry):
+    """Строка журнала -> строка для db.save_statuses_batch."""
+    _, user_id, chat_id, status_text, target_date, written_at = entry
+    return (user_id, chat_id, status_text, date.fromisoformat(target_date) if target_date else None,
+            datetime.fromtimestamp(written_at, timezone.utc))
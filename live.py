@@ -0,0 +1,244 @@
+"""Живое обновление дашборда: LISTEN/NOTIFY -> Server-Sent Events.
+
+Триггер statuses_notify (миграция 12) на каждую запись statuses отправляет
+pg_notify('status_changes', json). Процесс web.py держит одно соединение с
+LISTEN в фоновом потоке (ChangeFeed) и раскладывает события по очередям
+подписчиков — по одной на каждый открытый /events, так что сотни дашбордов
+обходятся одним соединением с БД.
+
+У событий сквозные id (<поколение>-<номер>). Переподключившийся браузер
+присылает Last-Event-ID и получает пропущенное из последних LIVE_HISTORY
+событий; если столько не сохранилось, если слушатель переподключался к БД (и
+мог пропустить уведомления) или очередь подписчика переполнилась, подписчик
+получает RESET и перезагружает страницу. То же происходит по уведомлению
+{"op": "reset"}, которое массовый импорт (importer.py) шлёт вместо построчных.
+
+Подписчик из цикла событий (режим webhook, см. webhook.py) передаёт loop в
+subscribe() и ждёт событий через wait(), не занимая поток на каждый поток /events.
+"""
+import asyncio
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import uuid
+from collections import deque
+
+import db
+import metrics
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "status_changes"
+HISTORY_SIZE = int(os.getenv("LIVE_HISTORY", "1000"))
+QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", "1000"))
+# Пустой комментарий раз в HEARTBEAT секунд не даёт прокси закрыть поток
+HEARTBEAT = float(os.getenv("LIVE_HEARTBEAT", "15"))
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+
+# Маркер в очереди подписчика: продолжать поток нельзя, страницу нужно перезагрузить
+RESET = object()
+
+
+class Subscription:
+    """Очередь событий одного подписчика; loop — цикл событий асинхронного подписчика."""
+
+    def __init__(self, loop=None):
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._reset = False
+        self._loop = loop
+        self._ready = None  # asyncio.Event создаётся в цикле событий при первом wait()
+
+    def put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            return False
+        self._notify()
+        return True
+
+    def reset(self):
+        self._reset = True
+        if not self.put(RESET):  # будит ожидающий get(); при полной очереди хватит флага
+            self._notify()
+
+    def _notify(self):
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._wake)
+            except RuntimeError:
+                pass  # цикл событий уже закрыт
+
+    def get(self, timeout=HEARTBEAT):
+        """(id, событие), RESET или None, если за timeout ничего не пришло."""
+        try:
+            item = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            item = None
+        return RESET if self._reset else item
+
+    def _wake(self):
+        if self._ready is not None:
+            self._ready.set()
+
+    async def wait(self, timeout=HEARTBEAT):
+        """То же, что get(), для подписчика из цикла событий (subscribe(loop=...))."""
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        try:
+            item = self._queue.get_nowait()
+        except queue.Empty:
+            self._ready.clear()
+            item = None
+            # Повторная проверка после clear(): событие могло прийти между ними
+            if self._queue.empty():
+                try:
+                    await asyncio.wait_for(self._ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+        return RESET if self._reset else item
+
+
+class ChangeFeed:
+    """Общий слушатель канала CHANNEL с раздачей событий подписчикам."""
+
+    def __init__(self, channel=CHANNEL, connect=db.open_connection):
+        self.channel = channel
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = deque(maxlen=HISTORY_SIZE)
+        self._generation = uuid.uuid4().hex[:8]
+        self._seq = 0
+        self._thread = None
+        self._stop = threading.Event()
+        self._listening = threading.Event()
+
+    def start(self, timeout=5.0):
+        """Запускает слушатель и ждёт (до timeout), пока LISTEN вступит в силу."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="live-listener", daemon=True)
+                self._thread.start()
+        self._listening.wait(timeout)
+
+    def stop(self):
+        self._stop.set()
+
+    def subscribe(self, last_event_id=None, loop=None):
+        """Новый подписчик и события после last_event_id (None — нужно перезагрузить страницу)."""
+        self.start()
+        subscription = Subscription(loop)
+        with self._lock:
+            self._subscribers.add(subscription)
+            if not last_event_id:
+                return subscription, []
+            generation, _, seq = last_event_id.partition("-")
+            oldest = self._history[0][0] if self._history else self._seq + 1
+            if generation != self._generation or not seq.isdigit() or int(seq) + 1 < oldest:
+                return subscription, None
+            return subscription, [(self._event_id(n), event) for n, event in self._history if n > int(seq)]
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _event_id(self, seq):
+        return f"{self._generation}-{seq}"
+
+    def publish(self, event):
+        with self._lock:
+            self._seq += 1
+            self._history.append((self._seq, event))
+            item = (self._event_id(self._seq), event)
+            subscribers = list(self._subscribers)
+        dropped = 0
+        for subscription in subscribers:
+            if not subscription.put(item):
+                # Медленный браузер не тормозит остальных: он перезагрузит страницу
+                self.unsubscribe(subscription)
+                subscription.reset()
+                dropped += 1
+        metrics.LIVE_EVENTS.inc(len(subscribers) - dropped, result="delivered")
+        if dropped:
+            metrics.LIVE_EVENTS.inc(dropped, result="dropped")
+
+    def _reset_all(self):
+        # Уведомления, пришедшие без слушателя, потеряны: начинаем новое поколение id
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._subscribers.clear()
+            self._history.clear()
+            self._generation = uuid.uuid4().hex[:8]
+        for subscription in subscribers:
+            subscription.reset()
+
+    def _run(self):
+        delay = RECONNECT_DELAY
+        first = True
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN {self.channel}')
+                if not first:
+                    self._reset_all()
+                self._listening.set()
+                logger.info(f"Слушаем канал {self.channel}")
+                first = False
+                delay = RECONNECT_DELAY
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], HEARTBEAT) == ([], [], []):
+                        # Тишина: проверяем, что соединение живо
+                        with conn.cursor() as cur:
+                            cur.execute('SELECT 1')
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        try:
+                            event = json.loads(notify.payload)
+                        except ValueError:
+                            logger.warning(f"Некорректное уведомление {self.channel}: {notify.payload[:200]}")
+                            continue
+                        if event.get("op") == "reset":
+                            # Массовое изменение (importer.py): построчных событий не будет
+                            self._reset_all()
+                        else:
+                            self.publish(event)
+            except Exception as e:
+                self._listening.clear()
+                first = False
+                logger.warning(f"Слушатель {self.channel} отключился ({e}), повтор через {delay:.0f} с")
+                self._stop.wait(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+
+feed = ChangeFeed()
+metrics.LIVE_SUBSCRIBERS.set_function(feed.subscribers)
+
+
+def format_event(event_id, event, name="status"):
+    """Событие в формате text/event-stream."""
+    data = json.dumps(event, ensure_ascii=False, default=str)
+    return f"id: {event_id}\nevent: {name}\ndata: {data}\n\n"
@@ -0,0 +1,436 @@
+"""Метрики в формате Prometheus и trace id обновлений в логах.
+
+Без внешних зависимостей: счётчики, gauge и гистограммы с метками хранятся в
+памяти процесса и отдаются текстом (text exposition format 0.0.4):
+- web.py — на /metrics рядом с дашбордом;
+- бот — отдельным HTTP-сервером на METRICS_PORT (start_http_server), там же
+  /health — состояние проверок, зарегистрированных register_health_check.
+
+Трассировка: instrument_handler даёт каждому обновлению trace id (TRACE_IDS=1),
+он хранится в contextvar, переносится в потоки БД (repository.run) и
+подставляется в записи логов фильтром TraceIdFilter (%(trace_id)s в формате).
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# ========== ТИПЫ МЕТРИК ==========
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+    def _samples(self):
+        """Строки значений метрики в текстовом формате Prometheus."""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        # Счётчик без меток виден в выгрузке сразу (со значением 0)
+        self._values = {} if labelnames else {(): 0}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Gauge; значение можно задавать set() или функцией (set_function), читаемой при выгрузке."""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """function() -> число или {кортеж значений меток: число}."""
+        self._function = function
+
+    def _samples(self):
+        values = dict(self._values)
+        if self._function is not None:
+            try:
+                result = self._function()
+            except Exception as e:
+                logger.warning(f"Не удалось вычислить {self.name}: {e}")
+                result = {}
+            values.update(result if isinstance(result, dict) else {(): result})
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # key -> [счётчики по бакетам..., sum, count]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, **labels):
+        series = self._series.get(self._key(labels))
+        return series[-1] if series else 0
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, list(series)) for key, series in self._series.items())
+        lines = []
+        for key, series in items:
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-2] + [series[-1]]):
+                labels = _format_labels(self.labelnames, key, [f'le="{_format_value(float(bound))}"'])
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+def render():
+    return REGISTRY.render()
+
+
+# ========== МЕТРИКИ ПРИЛОЖЕНИЯ ==========
+HANDLER_DURATION = histogram("sueta_handler_duration_seconds", "Время обработки обновления", ("handler",))
+HANDLER_ERRORS = counter("sueta_handler_errors_total", "Исключения в обработчиках", ("handler", "error"))
+DB_QUERY_DURATION = histogram("sueta_db_query_duration_seconds", "Время вызова функций db.py", ("query",))
+DB_QUERY_ERRORS = counter("sueta_db_query_errors_total", "Ошибки функций db.py", ("query", "error"))
+DB_CONNECTIONS_OPENED = counter("sueta_db_connections_opened_total", "Открыто соединений с PostgreSQL")
+DB_POOL = gauge("sueta_db_pool", "Состояние пула соединений (db.pool_stats)", ("stat",))
+STATUS_CACHE = gauge("sueta_status_cache", "Кеш недельного вида: попадания, промахи, вытеснения, размер (db.cache_stats)",
+                     ("stat",))
+JOB_DURATION = histogram("sueta_job_duration_seconds", "Время выполнения задач планировщика", ("job",),
+                         buckets=DEFAULT_BUCKETS + (30.0, 60.0, 300.0))
+JOB_ERRORS = counter("sueta_job_errors_total", "Ошибки задач планировщика", ("job", "error"))
+TELEGRAM_REQUESTS = counter("sueta_telegram_requests_total", "Запросы к Bot API", ("method", "code"))
+TELEGRAM_REQUEST_DURATION = histogram("sueta_telegram_request_duration_seconds", "Время запроса к Bot API",
+                                      ("method",))
+TELEGRAM_RETRY_AFTER = counter("sueta_telegram_retry_after_total", "Ответы 429 (flood control) от Bot API")
+MESSAGES_SENT = counter("sueta_messages_sent_total", "Сообщения массовых рассылок", ("result",))
+WRITE_BEHIND_BATCH_SIZE = histogram("sueta_write_behind_batch_size", "Строк в пачке write-behind буфера",
+                                    ("buffer",), buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+WRITE_BEHIND_FLUSH_DURATION = histogram("sueta_write_behind_flush_seconds", "Время сброса пачки write-behind буфера",
+                                        ("buffer",))
+WRITE_BEHIND_COALESCED = counter("sueta_write_behind_coalesced_total",
+                                 "Записи, перекрытые более поздней записью того же ключа", ("buffer",))
+WRITE_BEHIND_ERRORS = counter("sueta_write_behind_errors_total", "Ошибки сброса write-behind буфера",
+                              ("buffer", "error"))
+LIVE_SUBSCRIBERS = gauge("sueta_live_subscribers", "Открытые потоки /events живого дашборда")
+LIVE_EVENTS = counter("sueta_live_events_total", "События статусов, разосланные подписчикам /events", ("result",))
+JOURNAL_PENDING = gauge("sueta_journal_pending", "Записи статусов в локальном журнале, ещё не попавшие в БД")
+JOURNAL_LAG = gauge("sueta_journal_lag_seconds", "Возраст самой старой неотправленной записи журнала")
+JOURNAL_REPLAYED = counter("sueta_journal_replayed_total", "Записи журнала, дописанные в БД")
+JOURNAL_REPLAY_ERRORS = counter("sueta_journal_replay_errors_total", "Неудачные попытки дописать журнал в БД",
+                                ("error",))
+JOURNAL_REJECTED = counter("sueta_journal_rejected_total", "Записи журнала, отклонённые БД (отложены в failed)")
+EVENT_LOOP_LAG = histogram("sueta_event_loop_lag_seconds", "Задержка цикла событий (блокирующий код)",
+                           buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+
+# Порог «медленных» запросов и обработчиков для предупреждений в логе, мс
+SLOW_DB_MS = float(os.getenv("SLOW_DB_MS", "200"))
+SLOW_HANDLER_MS = float(os.getenv("SLOW_HANDLER_MS", "1000"))
+
+
+def _pool_stats():
+    import db
+    if db._pool is None:
+        return {}
+    return {(stat,): value for stat, value in db.pool_stats().items() if isinstance(value, (int, float))}
+
+
+DB_POOL.set_function(_pool_stats)
+
+
+# ========== TRACE ID ==========
+trace_id = contextvars.ContextVar("trace_id", default="-")
+TRACE_IDS = os.getenv("TRACE_IDS", "0") == "1"
+
+
+class TraceIdFilter(logging.Filter):
+    """Добавляет к записи лога атрибут trace_id текущего обновления."""
+
+    def filter(self, record):
+        record.trace_id = trace_id.get()
+        return True
+
+
+def install_log_trace_ids(logger_=None):
+    """Вешает TraceIdFilter на обработчики корневого логгера (для %(trace_id)s в формате)."""
+    for handler in (logger_ or logging.getLogger()).handlers:
+        handler.addFilter(TraceIdFilter())
+
+
+def _update_trace_id(update):
+    update_id = getattr(update, "update_id", None)
+    suffix = uuid.uuid4().hex[:6]
+    return f"{update_id}-{suffix}" if update_id is not None else suffix
+
+
+# ========== ОБЁРТКИ ==========
+def instrument_handler(callback, name=None):
+    """Оборачивает async-обработчик PTB: время, ошибки, trace id, предупреждение о медленных."""
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        token = trace_id.set(_update_trace_id(update)) if TRACE_IDS else None
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            HANDLER_ERRORS.inc(handler=name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_DURATION.observe(elapsed, handler=name)
+            if elapsed * 1000 >= SLOW_HANDLER_MS:
+                logger.warning(f"Медленный обработчик {name}: {elapsed * 1000:.0f} мс")
+            if token is not None:
+                trace_id.reset(token)
+    return wrapper
+
+
+def instrument_job(job, name=None):
+    """Оборачивает задачу планировщика (sync или async); ошибки учитываются и пробрасываются."""
+    name = name or job.__name__
+
+    def observe(started, error=None):
+        JOB_DURATION.observe(time.perf_counter() - started, job=name)
+        if error is not None:
+            JOB_ERRORS.inc(job=name, error=type(error).__name__)
+
+    if asyncio.iscoroutinefunction(job):
+        @functools.wraps(job)
+        async def async_wrapper(*args, **kwargs):
+            token = trace_id.set(f"job:{name}-{uuid.uuid4().hex[:6]}") if TRACE_IDS else None
+            started = time.perf_counter()
+            try:
+                result = await job(*args, **kwargs)
+            except Exception as e:
+                observe(started, e)
+                raise
+            finally:
+                if token is not None:
+                    trace_id.reset(token)
+            observe(started)
+            return result
+        return async_wrapper
+
+    @functools.wraps(job)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = job(*args, **kwargs)
+        except Exception as e:
+            observe(started, e)
+            raise
+        observe(started)
+        return result
+    return wrapper
+
+
+def timed_query(func):
+    """Декоратор функций db.py: гистограмма времени, ошибки и лог медленных вызовов."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            DB_QUERY_ERRORS.inc(query=name, error=type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_QUERY_DURATION.observe(elapsed, query=name)
+            if elapsed * 1000 >= SLOW_DB_MS:
+                logger.warning(f"Медленный запрос {name}: {elapsed * 1000:.0f} мс")
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, считающий запросы к Bot API по методам и кодам ответа (в т.ч. 429)."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        code = "error"
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            return code, payload
+        finally:
+            TELEGRAM_REQUEST_DURATION.observe(time.perf_counter() - started, method=api_method)
+            TELEGRAM_REQUESTS.inc(method=api_method, code=code)
+            if code == 429:
+                TELEGRAM_RETRY_AFTER.inc()
+
+
+# ========== ЗАДЕРЖКА ЦИКЛА СОБЫТИЙ ==========
+async def monitor_event_loop(interval=0.5):
+    """Фоновая задача: насколько позже запланированного просыпается цикл событий.
+
+    Большие значения значат, что какой-то обработчик выполняет блокирующий код
+    (в логах — с trace id, если включены TRACE_IDS и SLOW_HANDLER_MS).
+    """
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+# ========== HEALTH ==========
+HEALTH_CHECKS = {}
+
+
+def register_health_check(name, check):
+    """check() -> dict с ключом 'ok' и подробностями; выводится на /health."""
+    HEALTH_CHECKS[name] = check
+
+
+def health():
+    """(всё ли в порядке, {имя проверки: результат})."""
+    results = {}
+    for name, check in list(HEALTH_CHECKS.items()):
+        try:
+            results[name] = check()
+        except Exception as e:
+            results[name] = {"ok": False, "error": str(e)}
+    return all(result.get("ok") for result in results.values()), results
+
+
+# ========== HTTP ==========
+def start_http_server(port, host="0.0.0.0"):
+    """Отдаёт /metrics и /health отдельным HTTP-сервером в фоновом потоке (для процесса бота)."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.split("?", 1)[0]
+            if path == "/metrics":
+                status, content_type, body = 200, CONTENT_TYPE, render().encode("utf-8")
+            elif path == "/health":
+                ok, results = health()
+                status, content_type = (200 if ok else 503), "application/json"
+                body = json.dumps({"ok": ok, "checks": results}, ensure_ascii=False, default=str).encode("utf-8")
+            else:
+                self.send_error(404)
+                return
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
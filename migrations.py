@@ -0,0 +1,1074 @@
+"""Версионные миграции схемы БД.
+
+Каждая миграция применяется один раз; применённые версии хранятся в таблице
+schema_migrations. Шаг миграции — SQL-строка или функция f(cur). Миграции с
+transactional=False выполняются в autocommit (нужно для CREATE INDEX CONCURRENTLY
+и пакетных обновлений без долгих блокировок).
+
+Запуск вручную: python migrations.py
+"""
+import logging
+from dataclasses import dataclass, field
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock, чтобы две реплики не мигрировали одновременно
+MIGRATIONS_LOCK_KEY = 4242001
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    steps: list = field(default_factory=list)
+    transactional: bool = True
+
+
+MIGRATIONS = [
+    Migration(1, "initial schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            chat_id BIGINT,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS statuses (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT,
+            status_text TEXT NOT NULL,
+            date DATE NOT NULL
+        )
+        ''',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_user_date ON statuses (user_id, date)',
+    ]),
+    # Покрывающие индексы под горячие запросы: недельный вид и дашборд
+    # сканируют statuses по диапазону дат, опрос и get_active_users фильтруют
+    # users по is_active/chat_id.
+    Migration(2, "indexes for hot queries", [
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_statuses_date
+        ON statuses (date) INCLUDE (user_id, status_text)
+        ''',
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_chat_active
+        ON users (chat_id) INCLUDE (username) WHERE is_active
+        ''',
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_active
+        ON users (user_id) INCLUDE (chat_id) WHERE is_active
+        ''',
+    ], transactional=False),
+    # Внешний ключ statuses.user_id -> users. Статусы могли сохраняться без /start,
+    # поэтому сначала заводим для них неактивных пользователей; проверка
+    # существующих строк (VALIDATE) не блокирует запись.
+    Migration(3, "statuses.user_id foreign key", [
+        '''
+        INSERT INTO users (user_id, chat_id, is_active)
+        SELECT DISTINCT ON (s.user_id) s.user_id, s.chat_id, FALSE
+        FROM statuses s
+        WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = s.user_id)
+        ORDER BY s.user_id, s.date DESC
+        ''',
+        '''
+        ALTER TABLE statuses ADD CONSTRAINT statuses_user_id_fkey
+        FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE NOT VALID
+        ''',
+        'ALTER TABLE statuses VALIDATE CONSTRAINT statuses_user_id_fkey',
+    ]),
+    # Недельный вид выбирает участников чата (в том числе неактивных), а затем их
+    # статусы по idx_user_date.
+    Migration(4, "users by chat index", [
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_chat
+        ON users (chat_id) INCLUDE (username)
+        ''',
+    ], transactional=False),
+    # Состояние диалогов и context.user_data бота (см. persistence.py)
+    Migration(5, "conversation state persistence", [
+        '''
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (name, key)
+        )
+        ''',
+    ]),
+    # Счётчик изменений statuses/users для условных GET дашборда (ETag/Last-Modified).
+    # Триггер уровня оператора: одна UPDATE на запрос, а не на каждую строку.
+    Migration(6, "statuses change version", [
+        '''
+        CREATE TABLE IF NOT EXISTS statuses_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL DEFAULT 0,
+            changed_at TIMESTAMPTZ NOT NULL DEFAULT date_trunc('second', now())
+        )
+        ''',
+        'INSERT INTO statuses_version DEFAULT VALUES ON CONFLICT DO NOTHING',
+        '''
+        CREATE OR REPLACE FUNCTION bump_statuses_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE statuses_version SET version = version + 1, changed_at = date_trunc('second', now());
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER statuses_version_bump
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON statuses
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_statuses_version()
+        ''',
+        '''
+        CREATE TRIGGER users_version_bump
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON users
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_statuses_version()
+        ''',
+    ]),
+    # Агрегаты посещаемости по (чат команды, дата, категория статуса), которые
+    # триггеры поддерживают при каждой записи. /stats и сводка дашборда читают
+    # O(дней) строк вместо O(статусов). Чат — users.chat_id, как в недельном виде
+    # (с миграции 14 — каждый чат пользователя из memberships).
+    Migration(7, "daily attendance aggregates", [
+        '''
+        CREATE OR REPLACE FUNCTION status_category(status_text TEXT) RETURNS TEXT AS $$
+            SELECT CASE
+                WHEN status_text LIKE '%На работе%' THEN 'office'
+                WHEN status_text LIKE '%Работаю дома%' THEN 'remote'
+                WHEN status_text LIKE '%В отпуске%' THEN 'vacation'
+                WHEN status_text LIKE '%Болею%' THEN 'sick'
+                WHEN status_text LIKE '%В командировке%' THEN 'trip'
+                WHEN status_text LIKE '%Выходной%' THEN 'day_off'
+                ELSE 'other'
+            END
+        $$ LANGUAGE sql IMMUTABLE
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS status_daily_counts (
+            chat_id BIGINT NOT NULL,
+            date DATE NOT NULL,
+            category TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, date, category)
+        )
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION add_status_count(p_user_id BIGINT, p_fallback_chat BIGINT,
+                                                    p_date DATE, p_category TEXT, p_delta INTEGER)
+        RETURNS void AS $$
+            INSERT INTO status_daily_counts (chat_id, date, category, count)
+            VALUES (COALESCE((SELECT chat_id FROM users WHERE user_id = p_user_id), p_fallback_chat, 0),
+                    p_date, p_category, p_delta)
+            ON CONFLICT (chat_id, date, category)
+            DO UPDATE SET count = status_daily_counts.count + EXCLUDED.count
+        $$ LANGUAGE sql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION track_status_counts() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                TRUNCATE status_daily_counts;
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM add_status_count(OLD.user_id, OLD.chat_id, OLD.date, status_category(OLD.status_text), -1);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM add_status_count(NEW.user_id, NEW.chat_id, NEW.date, status_category(NEW.status_text), 1);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER statuses_daily_counts
+        AFTER INSERT OR UPDATE OR DELETE ON statuses
+        FOR EACH ROW EXECUTE FUNCTION track_status_counts()
+        ''',
+        '''
+        CREATE TRIGGER statuses_daily_counts_truncate
+        AFTER TRUNCATE ON statuses
+        FOR EACH STATEMENT EXECUTE FUNCTION track_status_counts()
+        ''',
+        # Смена чата команды у пользователя переносит его статусы в агрегатах нового чата
+        '''
+        CREATE OR REPLACE FUNCTION move_user_status_counts() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO status_daily_counts AS c (chat_id, date, category, count)
+            SELECT chat, s.date, status_category(s.status_text), sum(delta)
+            FROM statuses s
+            CROSS JOIN (VALUES (COALESCE(OLD.chat_id, 0), -1), (COALESCE(NEW.chat_id, 0), 1)) AS m (chat, delta)
+            WHERE s.user_id = NEW.user_id
+            GROUP BY chat, s.date, status_category(s.status_text)
+            ON CONFLICT (chat_id, date, category) DO UPDATE SET count = c.count + EXCLUDED.count;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER users_move_status_counts
+        AFTER UPDATE OF chat_id ON users
+        FOR EACH ROW WHEN (OLD.chat_id IS DISTINCT FROM NEW.chat_id)
+        EXECUTE FUNCTION move_user_status_counts()
+        ''',
+        '''
+        INSERT INTO status_daily_counts (chat_id, date, category, count)
+        SELECT COALESCE(u.chat_id, s.chat_id, 0), s.date, status_category(s.status_text), count(*)
+        FROM statuses s
+        LEFT JOIN users u ON u.user_id = s.user_id
+        GROUP BY 1, 2, 3
+        ON CONFLICT (chat_id, date, category) DO UPDATE SET count = EXCLUDED.count
+        ''',
+    ]),
+    # Каталог статусов: вместо полного текста с эмодзи в каждой строке храним
+    # SMALLINT-код пресета, свой текст — в отдельной колонке custom_text.
+    # Строки переводятся пакетами по id, каждый пакет — отдельная короткая транзакция.
+    # Миграция идёт без общей транзакции, поэтому каждый шаг можно повторить после
+    # падения на любом из них (проверка — benchmarks/migration_bench.py).
+    Migration(8, "status catalog", [
+        '''
+        CREATE TABLE IF NOT EXISTS status_types (
+            id SMALLINT PRIMARY KEY,
+            label TEXT NOT NULL UNIQUE,
+            category TEXT NOT NULL
+        )
+        ''',
+        '''
+        INSERT INTO status_types (id, label, category) VALUES
+            (1, '✅ На работе', 'office'),
+            (2, '🏡 Работаю дома', 'remote'),
+            (3, '🌴 В отпуске', 'vacation'),
+            (4, '🤒 Болею', 'sick'),
+            (5, '✈️ В командировке', 'trip'),
+            (6, '🏖️ Выходной', 'day_off')
+        ON CONFLICT (id) DO NOTHING
+        ''',
+        '''
+        ALTER TABLE statuses
+            ADD COLUMN IF NOT EXISTS status_type_id SMALLINT REFERENCES status_types (id),
+            ADD COLUMN IF NOT EXISTS custom_text TEXT
+        ''',
+        lambda cur: _status_text_drop_not_null(cur),
+        '''
+        CREATE OR REPLACE FUNCTION status_row_category(p_type_id SMALLINT, p_text TEXT) RETURNS TEXT AS $$
+            SELECT COALESCE((SELECT category FROM status_types WHERE id = p_type_id), status_category(p_text))
+        $$ LANGUAGE sql STABLE
+        ''',
+        # На время перевода строк триггеры агрегатов понимают оба представления
+        # (to_jsonb нужен, чтобы функции пережили удаление status_text)
+        lambda cur: _replace_count_triggers(cur, "COALESCE({row}.custom_text, to_jsonb({row}) ->> 'status_text')"),
+        lambda cur: _backfill_status_types(cur),
+        lambda cur: _drop_status_text(cur),
+        lambda cur: _replace_count_triggers(cur, "{row}.custom_text"),
+        lambda cur: _drop_invalid_index(cur, 'idx_statuses_date'),
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_statuses_date
+        ON statuses (date) INCLUDE (user_id, status_type_id, custom_text)
+        ''',
+        '''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                           WHERE conrelid = 'statuses'::regclass AND conname = 'statuses_type_or_custom') THEN
+                ALTER TABLE statuses ADD CONSTRAINT statuses_type_or_custom
+                CHECK ((status_type_id IS NULL) <> (custom_text IS NULL)) NOT VALID;
+            END IF;
+        END
+        $$
+        ''',
+        'ALTER TABLE statuses VALIDATE CONSTRAINT statuses_type_or_custom',
+    ], transactional=False),
+    # Журнал утреннего опроса: строка заводится до отправки, поэтому несколько
+    # реплик бота (и повторный запуск после падения) не отправят опрос дважды
+    Migration(9, "poll ledger", [
+        '''
+        CREATE TABLE IF NOT EXISTS poll_ledger (
+            poll_date DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            claimed_by TEXT NOT NULL,
+            claimed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            result TEXT NOT NULL DEFAULT 'claimed' CHECK (result IN ('claimed', 'sent', 'failed')),
+            finished_at TIMESTAMPTZ,
+            PRIMARY KEY (poll_date, user_id)
+        )
+        ''',
+    ]),
+    # Расписание опроса по чатам и пользователям. poll_schedule — итоговое время
+    # (минута суток в часовом поясе) для каждого активного пользователя; его
+    # поддерживают триггеры, а планировщик каждую минуту читает по индексу одну «корзину».
+    Migration(10, "poll schedules", [
+        '''
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id BIGINT PRIMARY KEY,
+            poll_time TIME NOT NULL DEFAULT '09:00',
+            timezone TEXT NOT NULL DEFAULT 'Europe/Moscow',
+            working_days SMALLINT NOT NULL DEFAULT 31 CHECK (working_days BETWEEN 0 AND 127),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_settings (
+            user_id BIGINT PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
+            poll_time TIME,
+            timezone TEXT,
+            working_days SMALLINT CHECK (working_days BETWEEN 0 AND 127),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS poll_schedule (
+            user_id BIGINT PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
+            timezone TEXT NOT NULL,
+            poll_minute SMALLINT NOT NULL,
+            working_days SMALLINT NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_poll_schedule_bucket
+        ON poll_schedule (timezone, poll_minute) INCLUDE (working_days)
+        ''',
+        # Итоговые настройки: пользователь > чат команды (users.chat_id) > по умолчанию
+        '''
+        CREATE OR REPLACE FUNCTION refresh_poll_schedule(p_user_ids BIGINT[]) RETURNS void AS $$
+        BEGIN
+            DELETE FROM poll_schedule p
+            USING users u
+            WHERE p.user_id = u.user_id AND u.user_id = ANY(p_user_ids) AND NOT u.is_active;
+
+            INSERT INTO poll_schedule AS p (user_id, timezone, poll_minute, working_days)
+            SELECT u.user_id,
+                   COALESCE(us.timezone, cs.timezone, 'Europe/Moscow'),
+                   (extract(hour FROM t.poll_time) * 60 + extract(minute FROM t.poll_time))::smallint,
+                   COALESCE(us.working_days, cs.working_days, 31)
+            FROM users u
+            LEFT JOIN chat_settings cs ON cs.chat_id = u.chat_id
+            LEFT JOIN user_settings us ON us.user_id = u.user_id
+            CROSS JOIN LATERAL (SELECT COALESCE(us.poll_time, cs.poll_time, '09:00') AS poll_time) t
+            WHERE u.user_id = ANY(p_user_ids) AND u.is_active
+            ON CONFLICT (user_id) DO UPDATE
+            SET timezone = EXCLUDED.timezone, poll_minute = EXCLUDED.poll_minute, working_days = EXCLUDED.working_days
+            WHERE (p.timezone, p.poll_minute, p.working_days)
+                  IS DISTINCT FROM (EXCLUDED.timezone, EXCLUDED.poll_minute, EXCLUDED.working_days);
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION users_refresh_poll_schedule() RETURNS trigger AS $$
+        BEGIN
+            PERFORM refresh_poll_schedule(ARRAY[NEW.user_id]);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION chat_settings_refresh_poll_schedule() RETURNS trigger AS $$
+        DECLARE
+            changed_chat BIGINT := CASE WHEN TG_OP = 'DELETE' THEN OLD.chat_id ELSE NEW.chat_id END;
+        BEGIN
+            PERFORM refresh_poll_schedule(ARRAY(SELECT user_id FROM users WHERE chat_id = changed_chat));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION user_settings_refresh_poll_schedule() RETURNS trigger AS $$
+        BEGIN
+            PERFORM refresh_poll_schedule(ARRAY[CASE WHEN TG_OP = 'DELETE' THEN OLD.user_id ELSE NEW.user_id END]);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER users_poll_schedule
+        AFTER INSERT OR UPDATE OF chat_id, is_active ON users
+        FOR EACH ROW EXECUTE FUNCTION users_refresh_poll_schedule()
+        ''',
+        '''
+        CREATE TRIGGER chat_settings_poll_schedule
+        AFTER INSERT OR UPDATE OR DELETE ON chat_settings
+        FOR EACH ROW EXECUTE FUNCTION chat_settings_refresh_poll_schedule()
+        ''',
+        '''
+        CREATE TRIGGER user_settings_poll_schedule
+        AFTER INSERT OR UPDATE OR DELETE ON user_settings
+        FOR EACH ROW EXECUTE FUNCTION user_settings_refresh_poll_schedule()
+        ''',
+        'SELECT refresh_poll_schedule(ARRAY(SELECT user_id FROM users WHERE is_active))',
+        # «Сегодня» пользователя в его часовом поясе (для записи статусов и журнала опроса)
+        '''
+        CREATE OR REPLACE FUNCTION user_today(p_user_id BIGINT, p_chat_id BIGINT) RETURNS DATE AS $$
+            SELECT (now() AT TIME ZONE COALESCE(
+                (SELECT timezone FROM poll_schedule WHERE user_id = p_user_id),
+                (SELECT timezone FROM user_settings WHERE user_id = p_user_id),
+                (SELECT cs.timezone FROM users u JOIN chat_settings cs ON cs.chat_id = u.chat_id
+                 WHERE u.user_id = p_user_id),
+                (SELECT timezone FROM chat_settings WHERE chat_id = p_chat_id),
+                'Europe/Moscow'
+            ))::date
+        $$ LANGUAGE sql STABLE
+        ''',
+    ]),
+    # Помесячное секционирование statuses по date. Новая таблица заполняется
+    # рядом со старой: изменения зеркалирует триггер, существующие строки
+    # копируются пакетами по id; подмена таблиц — короткая транзакция под
+    # блокировкой. Уникальность (user_id, date) сохраняется: ключ секционирования
+    # входит в индекс. Даты вне созданных секций попадают в statuses_default.
+    # При повторном запуске после падения шаги до подмены пропускаются, если она
+    # уже прошла, а копирование начинается заново (_restart_partitioned_copy).
+    Migration(11, "statuses monthly partitions", [
+        lambda cur: _before_swap(cur, '''
+        CREATE TABLE IF NOT EXISTS statuses_partitioned (
+            id INTEGER NOT NULL DEFAULT nextval('statuses_id_seq'),
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT,
+            date DATE NOT NULL,
+            status_type_id SMALLINT,
+            custom_text TEXT,
+            CONSTRAINT statuses_partitioned_pkey PRIMARY KEY (id, date),
+            CONSTRAINT statuses_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
+            CONSTRAINT statuses_status_type_id_fkey FOREIGN KEY (status_type_id) REFERENCES status_types (id),
+            CONSTRAINT statuses_type_or_custom CHECK ((status_type_id IS NULL) <> (custom_text IS NULL))
+        ) PARTITION BY RANGE (date)
+        '''),
+        lambda cur: _before_swap(cur, _restart_partitioned_copy),
+        lambda cur: _before_swap(cur, '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_user_date_partitioned ON statuses_partitioned (user_id, date)
+        '''),
+        lambda cur: _before_swap(cur, '''
+        CREATE INDEX IF NOT EXISTS idx_statuses_date_partitioned
+        ON statuses_partitioned (date) INCLUDE (user_id, status_type_id, custom_text)
+        '''),
+        lambda cur: _before_swap(cur, 'CREATE TABLE IF NOT EXISTS statuses_default PARTITION OF statuses_partitioned DEFAULT'),
+        lambda cur: _before_swap(cur, _create_status_partitions),
+        lambda cur: _before_swap(cur, '''
+        CREATE OR REPLACE FUNCTION sync_statuses_partitioned() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                DELETE FROM statuses_partitioned WHERE user_id = OLD.user_id AND date = OLD.date;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO statuses_partitioned (id, user_id, chat_id, date, status_type_id, custom_text)
+                VALUES (NEW.id, NEW.user_id, NEW.chat_id, NEW.date, NEW.status_type_id, NEW.custom_text)
+                ON CONFLICT (user_id, date) DO UPDATE
+                SET id = EXCLUDED.id, chat_id = EXCLUDED.chat_id,
+                    status_type_id = EXCLUDED.status_type_id, custom_text = EXCLUDED.custom_text;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        '''),
+        lambda cur: _before_swap(cur, 'DROP TRIGGER IF EXISTS statuses_partition_sync ON statuses'),
+        lambda cur: _before_swap(cur, '''
+        CREATE TRIGGER statuses_partition_sync
+        AFTER INSERT OR UPDATE OR DELETE ON statuses
+        FOR EACH ROW EXECUTE FUNCTION sync_statuses_partitioned()
+        '''),
+        lambda cur: _before_swap(cur, _copy_statuses_to_partitioned),
+        lambda cur: _swap_partitioned_statuses(cur),
+        'DROP FUNCTION IF EXISTS sync_statuses_partitioned()',
+        # Секция месяца (создаётся заранее планировщиком, см. retention.py). Строки
+        # этого месяца из statuses_default переносятся через родителя, чтобы
+        # триггеры агрегатов увидели удаление и вставку.
+        '''
+        CREATE OR REPLACE FUNCTION ensure_status_partition(p_month DATE) RETURNS BOOLEAN AS $$
+        DECLARE
+            v_start DATE := date_trunc('month', p_month)::date;
+            v_end DATE := (date_trunc('month', p_month) + INTERVAL '1 month')::date;
+            v_name TEXT := 'statuses_p' || to_char(p_month, 'YYYY_MM');
+        BEGIN
+            IF to_regclass(v_name) IS NOT NULL THEN
+                RETURN FALSE;
+            END IF;
+            CREATE TEMP TABLE IF NOT EXISTS status_partition_move (LIKE statuses) ON COMMIT DELETE ROWS;
+            WITH moved AS (DELETE FROM statuses WHERE date >= v_start AND date < v_end RETURNING *)
+            INSERT INTO status_partition_move SELECT * FROM moved;
+            EXECUTE format('CREATE TABLE %I PARTITION OF statuses FOR VALUES FROM (%L) TO (%L)',
+                           v_name, v_start, v_end);
+            INSERT INTO statuses SELECT * FROM status_partition_move;
+            TRUNCATE status_partition_move;
+            RETURN TRUE;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+    ], transactional=False),
+    # Уведомления об изменении статусов для живого дашборда (см. live.py): каждая
+    # запись statuses — от бота, импорта или каскадного удаления — отправляет
+    # pg_notify с готовой для отрисовки строкой. Уведомление уходит при COMMIT.
+    Migration(12, "status change notifications", [
+        '''
+        CREATE OR REPLACE FUNCTION notify_status_change() RETURNS trigger AS $$
+        DECLARE
+            v_row statuses;
+            v_username TEXT;
+            v_chat_id BIGINT;
+            v_payload JSONB;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                v_row := OLD;
+            ELSE
+                v_row := NEW;
+            END IF;
+            SELECT username, chat_id INTO v_username, v_chat_id FROM users WHERE user_id = v_row.user_id;
+            v_payload := jsonb_build_object(
+                'op', lower(TG_OP),
+                'user_id', v_row.user_id,
+                'username', COALESCE(v_username, ''),
+                'chat_id', COALESCE(v_chat_id, v_row.chat_id),
+                'date', v_row.date
+            );
+            IF TG_OP <> 'DELETE' THEN
+                -- Размер уведомления ограничен 8000 байт, длинный свой статус обрезаем
+                v_payload := v_payload || jsonb_build_object(
+                    'status', left(COALESCE((SELECT label FROM status_types WHERE id = NEW.status_type_id),
+                                            NEW.custom_text), 500),
+                    'category', status_row_category(NEW.status_type_id, NEW.custom_text)
+                );
+            END IF;
+            IF TG_OP <> 'INSERT' THEN
+                v_payload := v_payload || jsonb_build_object(
+                    'old_date', OLD.date,
+                    'old_category', status_row_category(OLD.status_type_id, OLD.custom_text)
+                );
+            END IF;
+            PERFORM pg_notify('status_changes', v_payload::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE TRIGGER statuses_notify
+        AFTER INSERT OR UPDATE OR DELETE ON statuses
+        FOR EACH ROW EXECUTE FUNCTION notify_status_change()
+        ''',
+    ]),
+    # Массовый импорт (importer.py) пересчитывает агрегаты и оповещает дашборды
+    # одной операцией на пачку, поэтому построчные триггеры в его транзакции
+    # (SET LOCAL sueta.bulk_import = 'on') не срабатывают.
+    Migration(13, "bulk import trigger bypass", [
+        'DROP TRIGGER statuses_daily_counts ON statuses',
+        '''
+        CREATE TRIGGER statuses_daily_counts
+        AFTER INSERT OR UPDATE OR DELETE ON statuses
+        FOR EACH ROW WHEN (current_setting('sueta.bulk_import', true) IS DISTINCT FROM 'on')
+        EXECUTE FUNCTION track_status_counts()
+        ''',
+        'DROP TRIGGER statuses_notify ON statuses',
+        '''
+        CREATE TRIGGER statuses_notify
+        AFTER INSERT OR UPDATE OR DELETE ON statuses
+        FOR EACH ROW WHEN (current_setting('sueta.bulk_import', true) IS DISTINCT FROM 'on')
+        EXECUTE FUNCTION notify_status_change()
+        ''',
+    ]),
+    # Участие в чатах: человек может состоять в нескольких командах. users.chat_id
+    # остаётся «домашним» чатом (от него берутся настройки опроса и часовой пояс),
+    # а состав команды чата — memberships: по PK (chat_id, user_id) читаются
+    # участники чата, по idx_memberships_user — чаты пользователя. Недельный вид,
+    # дашборд и агрегаты status_daily_counts учитывают пользователя в каждом его чате.
+    Migration(14, "chat memberships", [
+        # Пользователи, заведённые во время миграции, иначе остались бы без участия
+        'LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE',
+        '''
+        CREATE TABLE IF NOT EXISTS memberships (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+            joined_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (chat_id, user_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_memberships_user ON memberships (user_id, chat_id)',
+        '''
+        INSERT INTO memberships (chat_id, user_id)
+        SELECT chat_id, user_id FROM users WHERE chat_id IS NOT NULL
+        ON CONFLICT DO NOTHING
+        ''',
+        # Статус считается в каждом чате пользователя; без участия — как раньше,
+        # в чате записи. Для существующих данных агрегаты не меняются: пока у
+        # каждого ровно одно участие — в users.chat_id.
+        '''
+        CREATE OR REPLACE FUNCTION add_status_count(p_user_id BIGINT, p_fallback_chat BIGINT,
+                                                    p_date DATE, p_category TEXT, p_delta INTEGER)
+        RETURNS void AS $$
+            INSERT INTO status_daily_counts AS c (chat_id, date, category, count)
+            SELECT chat, p_date, p_category, p_delta
+            FROM (
+                SELECT chat_id FROM memberships WHERE user_id = p_user_id
+                UNION ALL
+                SELECT COALESCE(p_fallback_chat, 0)
+                WHERE NOT EXISTS (SELECT 1 FROM memberships WHERE user_id = p_user_id)
+            ) AS m (chat)
+            ON CONFLICT (chat_id, date, category) DO UPDATE SET count = c.count + EXCLUDED.count
+        $$ LANGUAGE sql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION shift_member_counts(p_user_id BIGINT, p_chat_id BIGINT, p_delta INTEGER)
+        RETURNS void AS $$
+            INSERT INTO status_daily_counts AS c (chat_id, date, category, count)
+            SELECT p_chat_id, s.date, status_row_category(s.status_type_id, s.custom_text), p_delta * count(*)
+            FROM statuses s
+            WHERE s.user_id = p_user_id
+            GROUP BY 2, 3
+            ON CONFLICT (chat_id, date, category) DO UPDATE SET count = c.count + EXCLUDED.count
+        $$ LANGUAGE sql
+        ''',
+        # Вступление в чат переносит статусы пользователя в агрегаты чата. Блокировка
+        # строки users (FOR UPDATE конфликтует с FOR KEY SHARE проверки внешнего
+        # ключа statuses) дожидается записей статусов пользователя, начатых раньше,
+        # а более поздние уже увидят новое участие.
+        '''
+        CREATE OR REPLACE FUNCTION join_chat(p_user_id BIGINT, p_chat_id BIGINT) RETURNS BOOLEAN AS $$
+        BEGIN
+            PERFORM 1 FROM users WHERE user_id = p_user_id FOR UPDATE;
+            INSERT INTO memberships (chat_id, user_id) VALUES (p_chat_id, p_user_id) ON CONFLICT DO NOTHING;
+            IF NOT FOUND THEN
+                RETURN FALSE;
+            END IF;
+            PERFORM shift_member_counts(p_user_id, p_chat_id, 1);
+            RETURN TRUE;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION leave_chat(p_user_id BIGINT, p_chat_id BIGINT) RETURNS BOOLEAN AS $$
+        BEGIN
+            PERFORM 1 FROM users WHERE user_id = p_user_id FOR UPDATE;
+            DELETE FROM memberships WHERE chat_id = p_chat_id AND user_id = p_user_id;
+            IF NOT FOUND THEN
+                RETURN FALSE;
+            END IF;
+            PERFORM shift_member_counts(p_user_id, p_chat_id, -1);
+            RETURN TRUE;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        # Домашний чат всегда среди чатов пользователя. У нового пользователя
+        # статусов ещё нет (кроме записанных тем же запросом — их посчитает
+        # триггер statuses), поэтому агрегаты не трогаем; смена домашнего чата
+        # переносит участие вместо move_user_status_counts.
+        '''
+        CREATE OR REPLACE FUNCTION users_sync_membership() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                INSERT INTO memberships (chat_id, user_id) VALUES (NEW.chat_id, NEW.user_id)
+                ON CONFLICT DO NOTHING;
+                RETURN NULL;
+            END IF;
+            IF OLD.chat_id IS NOT NULL THEN
+                PERFORM leave_chat(OLD.user_id, OLD.chat_id);
+            END IF;
+            IF NEW.chat_id IS NOT NULL THEN
+                PERFORM join_chat(NEW.user_id, NEW.chat_id);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS users_move_status_counts ON users',
+        'DROP FUNCTION IF EXISTS move_user_status_counts()',
+        '''
+        CREATE TRIGGER users_membership_insert
+        AFTER INSERT ON users
+        FOR EACH ROW WHEN (NEW.chat_id IS NOT NULL)
+        EXECUTE FUNCTION users_sync_membership()
+        ''',
+        '''
+        CREATE TRIGGER users_membership_move
+        AFTER UPDATE OF chat_id ON users
+        FOR EACH ROW WHEN (OLD.chat_id IS DISTINCT FROM NEW.chat_id)
+        EXECUTE FUNCTION users_sync_membership()
+        ''',
+        # Уведомления дашбордам несут все чаты пользователя (фильтр /events по чату)
+        '''
+        CREATE OR REPLACE FUNCTION notify_status_change() RETURNS trigger AS $$
+        DECLARE
+            v_row statuses;
+            v_username TEXT;
+            v_chat_id BIGINT;
+            v_payload JSONB;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                v_row := OLD;
+            ELSE
+                v_row := NEW;
+            END IF;
+            SELECT username, chat_id INTO v_username, v_chat_id FROM users WHERE user_id = v_row.user_id;
+            v_payload := jsonb_build_object(
+                'op', lower(TG_OP),
+                'user_id', v_row.user_id,
+                'username', COALESCE(v_username, ''),
+                'chat_id', COALESCE(v_chat_id, v_row.chat_id),
+                'chats', to_jsonb(ARRAY(SELECT chat_id FROM memberships WHERE user_id = v_row.user_id)),
+                'date', v_row.date
+            );
+            IF TG_OP <> 'DELETE' THEN
+                -- Размер уведомления ограничен 8000 байт, длинный свой статус обрезаем
+                v_payload := v_payload || jsonb_build_object(
+                    'status', left(COALESCE((SELECT label FROM status_types WHERE id = NEW.status_type_id),
+                                            NEW.custom_text), 500),
+                    'category', status_row_category(NEW.status_type_id, NEW.custom_text)
+                );
+            END IF;
+            IF TG_OP <> 'INSERT' THEN
+                v_payload := v_payload || jsonb_build_object(
+                    'old_date', OLD.date,
+                    'old_category', status_row_category(OLD.status_type_id, OLD.custom_text)
+                );
+            END IF;
+            PERFORM pg_notify('status_changes', v_payload::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+    ]),
+    # Дата статуса на момент нажатия, а не записи в БД: журнал (journal.py)
+    # может дописать утренний ответ и после полуночи
+    Migration(15, "user date at timestamp", [
+        '''
+        CREATE OR REPLACE FUNCTION user_date(p_user_id BIGINT, p_chat_id BIGINT, p_at TIMESTAMPTZ) RETURNS DATE AS $$
+            SELECT (p_at AT TIME ZONE COALESCE(
+                (SELECT timezone FROM poll_schedule WHERE user_id = p_user_id),
+                (SELECT timezone FROM user_settings WHERE user_id = p_user_id),
+                (SELECT cs.timezone FROM users u JOIN chat_settings cs ON cs.chat_id = u.chat_id
+                 WHERE u.user_id = p_user_id),
+                (SELECT timezone FROM chat_settings WHERE chat_id = p_chat_id),
+                'Europe/Moscow'
+            ))::date
+        $$ LANGUAGE sql STABLE
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION user_today(p_user_id BIGINT, p_chat_id BIGINT) RETURNS DATE AS $$
+            SELECT user_date(p_user_id, p_chat_id, now())
+        $$ LANGUAGE sql STABLE
+        ''',
+    ]),
+    # Перенос строк месяца из statuses_default в новую секцию (миграция 11) —
+    # это DELETE и INSERT тех же строк: агрегаты не меняются, а уведомления
+    # живого дашборда уходили бы на каждую строку дважды. Построчные триггеры
+    # на время функции выключены так же, как в importer.py; SET у функции
+    # возвращает прежнее значение при выходе из неё.
+    Migration(16, "partition move without row triggers", [
+        '''
+        CREATE OR REPLACE FUNCTION ensure_status_partition(p_month DATE) RETURNS BOOLEAN AS $$
+        DECLARE
+            v_start DATE := date_trunc('month', p_month)::date;
+            v_end DATE := (date_trunc('month', p_month) + INTERVAL '1 month')::date;
+            v_name TEXT := 'statuses_p' || to_char(p_month, 'YYYY_MM');
+        BEGIN
+            IF to_regclass(v_name) IS NOT NULL THEN
+                RETURN FALSE;
+            END IF;
+            CREATE TEMP TABLE IF NOT EXISTS status_partition_move (LIKE statuses) ON COMMIT DELETE ROWS;
+            WITH moved AS (DELETE FROM statuses WHERE date >= v_start AND date < v_end RETURNING *)
+            INSERT INTO status_partition_move SELECT * FROM moved;
+            EXECUTE format('CREATE TABLE %I PARTITION OF statuses FOR VALUES FROM (%L) TO (%L)',
+                           v_name, v_start, v_end);
+            INSERT INTO statuses SELECT * FROM status_partition_move;
+            TRUNCATE status_partition_move;
+            RETURN TRUE;
+        END;
+        $$ LANGUAGE plpgsql
+        SET sueta.bulk_import = 'on'
+        ''',
+    ]),
+]
+
+
+# ========== ШАГИ МИГРАЦИИ 8 (каталог статусов) ==========
+def _replace_count_triggers(cur, text_expr):
+    """Пересоздаёт функции агрегатов status_daily_counts (миграция 7) под каталог статусов."""
+    category = "status_row_category({row}.status_type_id, " + text_expr + ")"
+    old_category = category.format(row="OLD")
+    new_category = category.format(row="NEW")
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION track_status_counts() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                TRUNCATE status_daily_counts;
+                RETURN NULL;
+            END IF;
+            -- Перекодирование строки без смены категории агрегатов не меняет
+            IF TG_OP = 'UPDATE' AND OLD.user_id = NEW.user_id AND OLD.date = NEW.date
+               AND OLD.chat_id IS NOT DISTINCT FROM NEW.chat_id
+               AND ''' + old_category + ''' = ''' + new_category + ''' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM add_status_count(OLD.user_id, OLD.chat_id, OLD.date, ''' + old_category + ''', -1);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM add_status_count(NEW.user_id, NEW.chat_id, NEW.date, ''' + new_category + ''', 1);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION move_user_status_counts() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO status_daily_counts AS c (chat_id, date, category, count)
+            SELECT chat, s.date, ''' + category.format(row="s") + ''', sum(delta)
+            FROM statuses s
+            CROSS JOIN (VALUES (COALESCE(OLD.chat_id, 0), -1), (COALESCE(NEW.chat_id, 0), 1)) AS m (chat, delta)
+            WHERE s.user_id = NEW.user_id
+            GROUP BY 1, 2, 3
+            ON CONFLICT (chat_id, date, category) DO UPDATE SET count = c.count + EXCLUDED.count;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    ''')
+
+
+# Шаг перевода: UPDATE по диапазону id, чтобы не держать блокировки на всю таблицу
+BACKFILL_SQL = '''
+    UPDATE statuses s
+    SET status_type_id = t.id,
+        custom_text = CASE WHEN t.id IS NULL THEN s.status_text END,
+        status_text = NULL
+    FROM statuses src
+    LEFT JOIN status_types t ON t.label = src.status_text
+    WHERE src.id = s.id AND s.status_text IS NOT NULL
+'''
+
+
+def _has_column(cur, table, column):
+    cur.execute('''
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+    ''', (table, column))
+    return cur.fetchone() is not None
+
+
+def _drop_invalid_index(cur, name):
+    """Удаляет индекс, оставшийся невалидным после прерванного CREATE INDEX CONCURRENTLY."""
+    cur.execute('''
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.oid = to_regclass(%s) AND NOT i.indisvalid
+    ''', (name,))
+    if cur.fetchone() is not None:
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+        logger.info(f"Удалён невалидный индекс {name}")
+
+
+def _status_text_drop_not_null(cur):
+    if _has_column(cur, 'statuses', 'status_text'):
+        cur.execute('ALTER TABLE statuses ALTER COLUMN status_text DROP NOT NULL')
+
+
+def _backfill_status_types(cur, batch_size=5000):
+    if not _has_column(cur, 'statuses', 'status_text'):
+        return
+    cur.execute('SELECT min(id), max(id) FROM statuses WHERE status_text IS NOT NULL')
+    low, high = cur.fetchone()
+    if low is None:
+        return
+    for start in range(low, high + 1, batch_size):
+        cur.execute(BACKFILL_SQL + ' AND s.id BETWEEN %s AND %s', (start, start + batch_size - 1))
+    logger.info(f"Статусы переведены на каталог (id {low}..{high})")
+
+
+def _drop_status_text(cur):
+    # Строки, записанные во время перевода старым кодом, доводим под блокировкой
+    # вместе с удалением колонки — это быстрые операции
+    if not _has_column(cur, 'statuses', 'status_text'):
+        return
+    cur.execute('BEGIN')
+    try:
+        cur.execute('LOCK TABLE statuses IN ACCESS EXCLUSIVE MODE')
+        cur.execute(BACKFILL_SQL)
+        cur.execute('ALTER TABLE statuses DROP COLUMN status_text')
+        cur.execute('COMMIT')
+    except Exception:
+        cur.execute('ROLLBACK')
+        raise
+
+
+# ========== ШАГИ МИГРАЦИИ 11 (секционирование statuses) ==========
+# Секции заводятся на каждый месяц с данными и на несколько месяцев вперёд
+PARTITIONS_AHEAD = 3
+
+
+def partition_name(month):
+    """Имя секции statuses за месяц даты month: statuses_p2025_01."""
+    return f"statuses_p{month:%Y_%m}"
+
+
+def next_month(month):
+    """Первое число следующего месяца."""
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _statuses_swapped(cur):
+    """Подмена таблиц уже прошла: statuses — секционированная таблица."""
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('statuses')")
+    return cur.fetchone()[0]
+
+
+def _before_swap(cur, step):
+    """Шаг подготовки к подмене; если подмена уже прошла (повторный запуск), не нужен."""
+    if not _statuses_swapped(cur):
+        _run_step(cur, step)
+
+
+def _restart_partitioned_copy(cur):
+    # После падения копия могла остаться частичной, а зеркалирующий триггер —
+    # писать в statuses_default строки месяцев, секции которых ещё не созданы.
+    # Начинаем заново: без триггера и с пустой копией; при первом запуске — no-op
+    cur.execute('DROP TRIGGER IF EXISTS statuses_partition_sync ON statuses')
+    cur.execute('TRUNCATE statuses_partitioned')
+
+
+def _create_status_partitions(cur):
+    cur.execute('''
+        SELECT DISTINCT date_trunc('month', date)::date FROM statuses
+        UNION
+        SELECT (date_trunc('month', current_date) + make_interval(months => m))::date
+        FROM generate_series(0, %s) AS m
+        ORDER BY 1
+    ''', (PARTITIONS_AHEAD,))
+    months = [row[0] for row in cur.fetchall()]
+    for month in months:
+        cur.execute(
+            f'CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF statuses_partitioned '
+            'FOR VALUES FROM (%s) TO (%s)', (month, next_month(month))
+        )
+    logger.info(f"Создано секций statuses: {len(months)}")
+
+
+# Пакет копирования держит SHARE-блокировку: запись в statuses ждёт окончания
+# пакета (доли секунды), зато копия не разойдётся с зеркалирующим триггером
+COPY_STATUSES_SQL = '''
+    INSERT INTO statuses_partitioned (id, user_id, chat_id, date, status_type_id, custom_text)
+    SELECT id, user_id, chat_id, date, status_type_id, custom_text
+    FROM statuses
+    WHERE id BETWEEN %s AND %s
+    ON CONFLICT (user_id, date) DO NOTHING
+'''
+
+
+def _copy_statuses_to_partitioned(cur, batch_size=2000):
+    cur.execute('SELECT min(id), max(id) FROM statuses')
+    low, high = cur.fetchone()
+    if low is None:
+        return
+    for start in range(low, high + 1, batch_size):
+        cur.execute('BEGIN')
+        try:
+            cur.execute('LOCK TABLE statuses IN SHARE MODE')
+            cur.execute(COPY_STATUSES_SQL, (start, start + batch_size - 1))
+            cur.execute('COMMIT')
+        except Exception:
+            cur.execute('ROLLBACK')
+            raise
+    logger.info(f"Статусы скопированы в секционированную таблицу (id {low}..{high})")
+
+
+def _swap_partitioned_statuses(cur):
+    # Копия уже совпадает со старой таблицей, под блокировкой только переименования.
+    # DROP TABLE снимает внешний ключ и блокирует users — берём users первой, в
+    # том же порядке, что и запись статуса (ENSURE_USER_SQL), иначе взаимоблокировка
+    if _statuses_swapped(cur):
+        return
+    cur.execute('BEGIN')
+    try:
+        cur.execute('LOCK TABLE users, statuses IN ACCESS EXCLUSIVE MODE')
+        cur.execute('ALTER SEQUENCE statuses_id_seq OWNED BY statuses_partitioned.id')
+        cur.execute('DROP TABLE statuses')
+        cur.execute('ALTER TABLE statuses_partitioned RENAME TO statuses')
+        cur.execute('ALTER TABLE statuses RENAME CONSTRAINT statuses_partitioned_pkey TO statuses_pkey')
+        cur.execute('ALTER INDEX idx_user_date_partitioned RENAME TO idx_user_date')
+        cur.execute('ALTER INDEX idx_statuses_date_partitioned RENAME TO idx_statuses_date')
+        cur.execute('''
+            CREATE TRIGGER statuses_version_bump
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON statuses
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_statuses_version()
+        ''')
+        cur.execute('''
+            CREATE TRIGGER statuses_daily_counts
+            AFTER INSERT OR UPDATE OR DELETE ON statuses
+            FOR EACH ROW EXECUTE FUNCTION track_status_counts()
+        ''')
+        cur.execute('''
+            CREATE TRIGGER statuses_daily_counts_truncate
+            AFTER TRUNCATE ON statuses
+            FOR EACH STATEMENT EXECUTE FUNCTION track_status_counts()
+        ''')
+        cur.execute('COMMIT')
+    except Exception:
+        cur.execute('ROLLBACK')
+        raise
+
+
+def _run_step(cur, step):
+    if callable(step):
+        step(cur)
+    else:
+        cur.execute(step)
+
+
+def applied_versions(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    ''')
+    cur.execute('SELECT version FROM schema_migrations')
+    return {row[0] for row in cur.fetchall()}
+
+
+def migrate(conn, migrations=None):
+    """Применяет недостающие миграции по порядку. Возвращает список применённых версий."""
+    migrations = sorted(migrations or MIGRATIONS, key=lambda m: m.version)
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    applied = []
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATIONS_LOCK_KEY,))
+            try:
+                done = applied_versions(cur)
+                for migration in migrations:
+                    if migration.version in done:
+                        continue
+                    logger.info(f"Миграция {migration.version}: {migration.name}")
+                    if migration.transactional:
+                        cur.execute('BEGIN')
+                    try:
+                        for step in migration.steps:
+                            _run_step(cur, step)
+                        cur.execute(
+                            'INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                            (migration.version, migration.name)
+                        )
+                        if migration.transactional:
+                            cur.execute('COMMIT')
+                    except Exception:
+                        if migration.transactional:
+                            cur.execute('ROLLBACK')
+                        raise
+                    applied.append(migration.version)
+            finally:
+                cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_KEY,))
+    finally:
+        conn.autocommit = autocommit
+    return applied
+
+
+if __name__ == '__main__':
+    import db
+    logging.basicConfig(level=logging.INFO)
+    with db.get_connection() as conn:
+        print(f"Применены миграции: {migrate(conn) or 'нет новых'}")
@@ -0,0 +1,439 @@
+"""Постоянное хранение состояния диалогов и user_data между перезапусками и репликами.
+
+StatePersistence — реализация BasePersistence для python-telegram-bot:
+- состояния ConversationHandler и context.user_data (awaiting_custom_status,
+  start_date, mode, ...) сохраняются в PostgreSQL (PostgresStore) или в
+  Redis-совместимом хранилище (RedisStore, PERSISTENCE_REDIS_URL);
+- состояние загружается лениво — user_data и диалоги пользователя в чате
+  читаются одним запросом при первом его обновлении (refresh_handler, группа
+  -1) и дальше живут в памяти, без обращений к хранилищу на каждый callback;
+- пакет записи сопровождается уведомлением со списком пользователей
+  (pg_notify в канал STATE_CHANNEL / PUBLISH в Redis). Остальные реплики
+  забывают загруженное состояние этих пользователей и перечитывают его при
+  следующем обновлении; после переподключения слушателя забывается всё. То,
+  что реплика изменила, но ещё не записала, перечитывание не затирает;
+- изменения не пишутся на каждый callback: PTB сообщает о них раз в
+  update_interval секунд (PERSISTENCE_INTERVAL), а мы объединяем их и
+  записываем одним пакетом (одна транзакция / один pipeline), пропуская
+  неизменившиеся user_data. Интервал — это и окно, в которое другая реплика
+  может прочитать устаревшее состояние, поэтому с несколькими репликами за
+  балансировщиком его держат малым (0.1–1 с).
+
+Внутренние атрибуты PTB, без которых не обойтись, собраны в _PTBState.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import date, datetime
+
+from psycopg2.extras import execute_values
+import telegram
+from telegram import Update
+from telegram.ext import BasePersistence, PersistenceInput, TypeHandler
+
+import db
+import live
+import repository
+
+logger = logging.getLogger(__name__)
+
+# Канал уведомлений об изменённом состоянии (Postgres LISTEN/NOTIFY)
+STATE_CHANNEL = "bot_state_changes"
+# Пользователей в одном уведомлении: payload pg_notify ограничен 8000 байт
+NOTIFY_USERS = 400
+
+
+# ========== СЕРИАЛИЗАЦИЯ ==========
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, date):
+        return {"__date__": value.isoformat()}
+    raise TypeError(f"Тип {type(value).__name__} не сериализуется в JSON")
+
+
+def _decode(obj):
+    if "__date__" in obj:
+        return date.fromisoformat(obj["__date__"])
+    if "__datetime__" in obj:
+        return datetime.fromisoformat(obj["__datetime__"])
+    return obj
+
+
+def dumps(value):
+    return json.dumps(value, default=_encode, ensure_ascii=False)
+
+
+def loads(raw):
+    return json.loads(raw, object_hook=_decode)
+
+
+def _conversation_key(key):
+    return dumps(list(key))
+
+
+def _change_events(origin, user_data, dropped_users, conversations):
+    """Уведомления о пакете записи: кто записал и чьё состояние изменилось."""
+    users = set(user_data) | set(dropped_users)
+    # Ключ диалога — (chat_id, user_id), см. StatePersistence._refresh_update
+    users.update(loads(key)[-1] for _, key in conversations)
+    users = sorted(users)
+    return [
+        dumps({"origin": origin, "users": users[i:i + NOTIFY_USERS]})
+        for i in range(0, len(users), NOTIFY_USERS)
+    ]
+
+
+# ========== ХРАНИЛИЩА ==========
+class PostgresStore:
+    """Хранит состояние в таблицах bot_user_data и bot_conversations (миграция 5)."""
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+
+    def watch(self, loop, on_change):
+        """Вызывает on_change(событие) в цикле loop на записи других процессов; None — забыть всё."""
+        feed = live.ChangeFeed(STATE_CHANNEL)
+        subscription, _ = feed.subscribe(loop=loop)
+        asyncio.run_coroutine_threadsafe(self._consume(feed, subscription, on_change), loop)
+
+    @staticmethod
+    async def _consume(feed, subscription, on_change):
+        while True:
+            item = await subscription.wait()
+            if item is live.RESET:
+                # Слушатель переподключался и мог пропустить уведомления
+                on_change(None)
+                subscription, _ = await repository.run(feed.subscribe, None, asyncio.get_running_loop())
+            elif item is not None:
+                on_change(item[1])
+
+    def load_state(self, user_id, conversation_keys):
+        """(user_data или None, {(name, key): состояние}) пользователя одним запросом."""
+        names = [name for name, _ in conversation_keys]
+        keys = [key for _, key in conversation_keys]
+        with db.get_connection() as conn, conn.cursor() as cur:
+            cur.execute('''
+                SELECT NULL, NULL, data::text FROM bot_user_data WHERE user_id = %s
+                UNION ALL
+                SELECT name, key, state::text FROM bot_conversations
+                WHERE (name, key) IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+            ''', (user_id, names, keys))
+            rows = cur.fetchall()
+        user_data = next((loads(data) for name, _, data in rows if name is None), None)
+        return user_data, {(name, key): loads(state) for name, key, state in rows if name is not None}
+
+    def save(self, user_data, dropped_users, conversations):
+        """Записывает накопленные изменения одной транзакцией."""
+        with db.get_connection() as conn, conn.cursor() as cur:
+            if user_data:
+                execute_values(cur, '''
+                    INSERT INTO bot_user_data (user_id, data) VALUES %s
+                    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                ''', [(user_id, dumps(data)) for user_id, data in user_data.items()])
+            if dropped_users:
+                cur.execute('DELETE FROM bot_user_data WHERE user_id = ANY(%s)', (list(dropped_users),))
+            ended = [(name, key) for (name, key), state in conversations.items() if state is None]
+            active = [(name, key, dumps(state)) for (name, key), state in conversations.items() if state is not None]
+            if active:
+                execute_values(cur, '''
+                    INSERT INTO bot_conversations (name, key, state) VALUES %s
+                    ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state, updated_at = now()
+                ''', active)
+            if ended:
+                execute_values(cur, '''
+                    DELETE FROM bot_conversations c
+                    USING (VALUES %s) AS e (name, key)
+                    WHERE c.name = e.name AND c.key = e.key
+                ''', ended)
+            # Уведомление уходит при COMMIT, вместе с данными
+            for payload in _change_events(self.origin, user_data, dropped_users, conversations):
+                cur.execute('SELECT pg_notify(%s, %s)', (STATE_CHANNEL, payload))
+
+
+class RedisStore:
+    """Хранит состояние в хешах Redis; пакет изменений — один pipeline."""
+
+    def __init__(self, client, prefix="sueta:state:"):
+        self.client = client
+        self.prefix = prefix
+        self.origin = uuid.uuid4().hex
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        import redis  # необязательная зависимость
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def load_state(self, user_id, conversation_keys):
+        pipe = self.client.pipeline()
+        pipe.hget(self.prefix + "user_data", str(user_id))
+        for name, key in conversation_keys:
+            pipe.hget(self.prefix + "conv:" + name, key)
+        raw_user_data, *raw_states = pipe.execute()
+        states = {conv: loads(raw) for conv, raw in zip(conversation_keys, raw_states) if raw is not None}
+        return (loads(raw_user_data) if raw_user_data is not None else None), states
+
+    def watch(self, loop, on_change):
+        threading.Thread(target=self._listen, args=(loop, on_change), name="state-changes", daemon=True).start()
+
+    def _listen(self, loop, on_change):
+        delay = live.RECONNECT_DELAY
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.prefix + "changes")
+                # До подписки изменения могли пройти мимо
+                loop.call_soon_threadsafe(on_change, None)
+                delay = live.RECONNECT_DELAY
+                for message in pubsub.listen():
+                    loop.call_soon_threadsafe(on_change, loads(message["data"]))
+            except Exception as e:
+                logger.warning(f"Подписка на изменения состояния прервалась ({e}), повтор через {delay:.0f} с")
+                time.sleep(delay)
+                delay = min(delay * 2, live.MAX_RECONNECT_DELAY)
+
+    def save(self, user_data, dropped_users, conversations):
+        pipe = self.client.pipeline()
+        for user_id, data in user_data.items():
+            pipe.hset(self.prefix + "user_data", str(user_id), dumps(data))
+        for user_id in dropped_users:
+            pipe.hdel(self.prefix + "user_data", str(user_id))
+        for (name, key), state in conversations.items():
+            if state is None:
+                pipe.hdel(self.prefix + "conv:" + name, key)
+            else:
+                pipe.hset(self.prefix + "conv:" + name, key, dumps(state))
+        for payload in _change_events(self.origin, user_data, dropped_users, conversations):
+            pipe.publish(self.prefix + "changes", payload)
+        pipe.execute()
+
+
+# ========== ВНУТРЕННОСТИ PTB ==========
+# Единственное место, где persistence трогает непубличные атрибуты PTB.
+# Проверено на python-telegram-bot 20.7 (см. requirements.txt); при обновлении
+# PTB сверьте Application._conversation_handler_conversations,
+# Application._user_ids_to_be_updated_in_persistence и TrackingDict
+# (update_no_track, data, _write_access_keys).
+PTB_CHECKED_VERSION = "20.7"
+
+
+class _PTBState:
+    """Доступ к несохранённым изменениям и словарям диалогов Application."""
+
+    def __init__(self, application):
+        self.application = application
+
+    def user_data_pending(self, user_id):
+        """PTB ещё не передал persistence изменения user_data пользователя."""
+        return user_id in self.application._user_ids_to_be_updated_in_persistence  # pylint: disable=protected-access
+
+    def conversations(self, name):
+        """Состояния ConversationHandler'а name (TrackingDict) или None."""
+        return self.application._conversation_handler_conversations.get(name)  # pylint: disable=protected-access
+
+    @staticmethod
+    def conversation_pending(states, key):
+        return key in states._write_access_keys  # pylint: disable=protected-access
+
+    @staticmethod
+    def set_conversation(states, key, state):
+        """Подставляет состояние из хранилища, не помечая его изменённым (None — диалога нет)."""
+        if state is None:
+            states.data.pop(key, None)
+        else:
+            states.update_no_track({key: state})
+
+
+# ========== PERSISTENCE ==========
+class StatePersistence(BasePersistence):
+    """Persistence для user_data и диалогов: загрузка при первом обращении, пакетная запись."""
+
+    def __init__(self, store, update_interval=1):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        if telegram.__version__ != PTB_CHECKED_VERSION:
+            logger.warning(f"persistence проверен на PTB {PTB_CHECKED_VERSION}, установлен {telegram.__version__}")
+        self.store = store
+        self._conversation_names = []
+        self._loaded = {}  # user_id -> чаты, для которых состояние пользователя уже в памяти
+        self._invalidations = 0
+        self._watch_task = None
+        self._stored_user_data = {}  # user_id -> JSON последней прочитанной/записанной версии
+        self._pending_user_data = {}
+        self._pending_dropped = set()
+        self._pending_conversations = {}
+        self._inflight = ({}, set(), {})  # пакет, который сейчас записывается
+        self._flush_task = None
+
+    # --- загрузка ---
+    async def get_user_data(self):
+        # Ничего не грузим заранее: данные пользователя подтягивает refresh_handler
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass  # см. _refresh_update: user_data читается вместе с диалогами
+
+    async def get_conversations(self, name):
+        # Диалоги тоже читаются при первом обновлении пользователя (_refresh_update)
+        self._conversation_names.append(name)
+        return {}
+
+    def refresh_handler(self):
+        """Обработчик группы -1: подгружает состояние пользователя до ConversationHandler'ов."""
+        return TypeHandler(Update, self._refresh_update)
+
+    async def _refresh_update(self, update, context):
+        user, chat = update.effective_user, update.effective_chat
+        if user is None or chat is None or chat.id in self._loaded.get(user.id, ()):
+            return  # состояние в памяти, другие процессы его не меняли
+        if self._watch_task is None:
+            self._watch_task = asyncio.ensure_future(
+                repository.run(self.store.watch, asyncio.get_running_loop(), self._on_change)
+            )
+        await self._watch_task
+
+        # Все диалоги бота — per_chat и per_user: ключ (chat_id, user_id)
+        key = (chat.id, user.id)
+        conversation_keys = [(name, _conversation_key(key)) for name in self._conversation_names]
+        invalidations = self._invalidations
+        user_data, states = await repository.run(self.store.load_state, user.id, conversation_keys)
+
+        ptb = _PTBState(context.application)
+        if not self._user_data_dirty(ptb, user.id):
+            self._stored_user_data[user.id] = dumps(user_data or {})
+            context.user_data.clear()
+            context.user_data.update(user_data or {})
+        for name, stored_key in conversation_keys:
+            handler_states = ptb.conversations(name)
+            if handler_states is None or self._conversation_dirty(ptb, handler_states, name, key, stored_key):
+                continue
+            # Нет в хранилище — диалог завершён (в том числе другой репликой)
+            ptb.set_conversation(handler_states, key, states.get((name, stored_key)))
+        # Пока читали, пришло уведомление — прочитанное могло устареть, перечитаем в следующий раз
+        if self._invalidations == invalidations:
+            self._loaded.setdefault(user.id, set()).add(chat.id)
+
+    def _on_change(self, event):
+        """Уведомление о записи (в цикле событий): забываем состояние затронутых пользователей."""
+        if event is None:
+            self._loaded.clear()
+        elif event.get("origin") == self.store.origin:
+            return  # свои записи: в памяти то же, что в хранилище
+        else:
+            for user_id in event.get("users", ()):
+                self._loaded.pop(user_id, None)
+        self._invalidations += 1
+
+    def _user_data_dirty(self, ptb, user_id):
+        """Есть изменения user_data, ещё не записанные в хранилище: перечитывать нельзя."""
+        return (user_id in self._pending_user_data or user_id in self._pending_dropped
+                or user_id in self._inflight[0] or user_id in self._inflight[1]
+                or ptb.user_data_pending(user_id))
+
+    def _conversation_dirty(self, ptb, handler_states, name, key, stored_key):
+        return ((name, stored_key) in self._pending_conversations or (name, stored_key) in self._inflight[2]
+                or ptb.conversation_pending(handler_states, key))
+
+    # --- запись (накапливаем и пишем одним пакетом) ---
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # PTB вызывает update_* для всех изменений разом через asyncio.gather;
+        # уступаем цикл событий, чтобы собрать их все в один пакет
+        await asyncio.sleep(0)
+        await self._write_pending()
+
+    async def _write_pending(self):
+        user_data, self._pending_user_data = self._pending_user_data, {}
+        dropped, self._pending_dropped = self._pending_dropped, set()
+        conversations, self._pending_conversations = self._pending_conversations, {}
+        if not (user_data or dropped or conversations):
+            return
+        self._inflight = (user_data, dropped, conversations)
+        try:
+            await repository.run(self.store.save, user_data, dropped, conversations)
+        except Exception as e:
+            logger.error(f"Не удалось сохранить состояние диалогов: {e}")
+            # Вернём изменения в очередь, более новые данные имеют приоритет
+            for user_id, data in user_data.items():
+                self._pending_user_data.setdefault(user_id, data)
+            self._pending_dropped |= dropped - set(self._pending_user_data)
+            for key, state in conversations.items():
+                self._pending_conversations.setdefault(key, state)
+        else:
+            for user_id, data in user_data.items():
+                self._stored_user_data[user_id] = dumps(data)
+            for user_id in dropped:
+                self._stored_user_data.pop(user_id, None)
+        finally:
+            self._inflight = ({}, set(), {})
+
+    async def update_user_data(self, user_id, data):
+        self._pending_dropped.discard(user_id)
+        # PTB сообщает о каждом пользователе, получившем обновление; пишем только изменения
+        if user_id not in self._pending_user_data and self._stored_user_data.get(user_id) == dumps(data):
+            return
+        self._pending_user_data[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id):
+        self._pending_user_data.pop(user_id, None)
+        self._pending_dropped.add(user_id)
+        self._schedule_flush()
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, _conversation_key(key))] = new_state
+        self._schedule_flush()
+
+    async def flush(self):
+        if self._flush_task is not None:
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self._write_pending()
+
+    # --- не используется: chat_data, bot_data и callback_data не храним ---
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+
+def create_persistence():
+    """Создаёт persistence по окружению: PERSISTENCE=postgres|redis|off."""
+    backend = os.getenv("PERSISTENCE", "postgres")
+    if backend == "off":
+        return None
+    if backend == "redis":
+        store = RedisStore.from_url(os.getenv("PERSISTENCE_REDIS_URL", "redis://localhost:6379/0"))
+    else:
+        store = PostgresStore()
+    return StatePersistence(store, update_interval=float(os.getenv("PERSISTENCE_INTERVAL", "1")))
@@ -0,0 +1,136 @@
+"""Асинхронный доступ к БД для обработчиков бота.
+
+Функции db.py синхронные (psycopg2), поэтому здесь они выполняются в ограниченном
+пуле потоков и не блокируют цикл событий python-telegram-bot: пока один запрос
+ждёт ответа PostgreSQL, обновления других пользователей продолжают обрабатываться.
+Размер пула потоков совпадает с DB_POOL_MAX, чтобы потоки не простаивали в
+ожидании соединения.
+
+Одиночные статусы «на сегодня» пишутся через write-behind буфер (write_behind.py):
+нажатия за STATUS_FLUSH_MS миллисекунд уходят в БД одним INSERT. Если задан
+STATUS_JOURNAL, они сначала пишутся в локальный журнал (journal.py) и
+подтверждаются, не дожидаясь PostgreSQL; остальные записи статусов
+пользователя (и запись в обход журнала, если он недоступен) ждут, пока его
+журнал дойдёт до БД.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+import journal
+import write_behind
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=int(os.getenv("DB_POOL_MAX", "10")),
+                    thread_name_prefix="db"
+                )
+    return _executor
+
+
+def shutdown():
+    """Дожидается выполняющихся запросов и останавливает пул потоков."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+async def run(func, *args, **kwargs):
+    """Выполняет синхронную функцию доступа к БД в пуле потоков."""
+    loop = asyncio.get_running_loop()
+    # Копия контекста переносит в поток trace id обновления (см. metrics.py)
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), functools.partial(context.run, func, *args, **kwargs))
+
+
+def _async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+add_user = _async(db.add_user)
+get_active_users = _async(db.get_active_users)
+claim_poll_batch = _async(db.claim_poll_batch)
+count_poll_skipped = _async(db.count_poll_skipped)
+finish_poll_batch = _async(db.finish_poll_batch)
+purge_poll_ledger = _async(db.purge_poll_ledger)
+get_statuses_next_week = _async(db.get_statuses_next_week)
+get_attendance = _async(db.get_attendance)
+local_today = _async(db.local_today)
+get_chat_settings = _async(db.get_chat_settings)
+get_user_settings = _async(db.get_user_settings)
+set_chat_setting = _async(db.set_chat_setting)
+set_user_setting = _async(db.set_user_setting)
+
+
+# ========== WRITE-BEHIND ДЛЯ СТАТУСОВ ==========
+status_writer = write_behind.WriteBehindBuffer(
+    _async(db.save_statuses_batch),
+    max_rows=int(os.getenv("STATUS_FLUSH_ROWS", "500")),
+    max_delay=float(os.getenv("STATUS_FLUSH_MS", "50")) / 1000,
+)
+
+
+# ========== ЖУРНАЛ СТАТУСОВ ==========
+status_journal = None
+if journal.JOURNAL_PATH:
+    status_journal = journal.StatusJournal(
+        journal.JOURNAL_PATH, _async(db.save_statuses_batch),
+        synchronous=os.getenv("JOURNAL_SYNCHRONOUS", "FULL"),
+    )
+
+
+async def _wait_journal(user_id):
+    """Ждёт, пока записи пользователя из журнала дойдут до БД; не дождались — ReplayPending."""
+    # Иначе более старый статус из журнала перезаписал бы результат прямой записи
+    if status_journal is not None and not await status_journal.wait_replayed(user_id):
+        raise journal.ReplayPending(f"Статусы пользователя {user_id} ещё дописываются из журнала")
+
+
+async def save_status_for_date(user_id, chat_id, status_text, target_date=None):
+    """Сохраняет статус; возвращается, когда он записан в журнал или (без журнала) в БД."""
+    if status_journal is not None:
+        try:
+            await status_journal.append(user_id, chat_id, status_text, target_date)
+            return
+        except Exception as e:
+            logger.error(f"Журнал статусов недоступен ({e}), пишем в БД напрямую")
+        # Запись в обход журнала — только после его записей этого пользователя
+        await _wait_journal(user_id)
+    await status_writer.submit((user_id, target_date), (user_id, chat_id, status_text, target_date, None))
+
+
+def _after_journal(func):
+    """Прямая запись статусов пользователя (первый аргумент) — после его записей из журнала."""
+    wrapper = _async(func)
+
+    @functools.wraps(func)
+    async def ordered(user_id, *args, **kwargs):
+        await _wait_journal(user_id)
+        return await wrapper(user_id, *args, **kwargs)
+    return ordered
+
+
+save_status_range = _after_journal(db.save_status_range)
+delete_user_status_today = _after_journal(db.delete_user_status_today)
+delete_user_status_by_date = _after_journal(db.delete_user_status_by_date)
+delete_all_user_statuses = _after_journal(db.delete_all_user_statuses)
@@ -0,0 +1,267 @@
+"""Помесячные секции statuses: создание заранее, хранение и архив.
+
+statuses секционирована по date (миграция 11): секция statuses_pYYYY_MM на
+месяц и statuses_default для дат вне секций. Планировщик бота раз в сутки
+вызывает run_maintenance():
+- создаёт секции на текущий и PARTITIONS_AHEAD следующих месяцев;
+- если задан STATUS_RETENTION_MONTHS, убирает секции старше текущего месяца и
+  стольких же предыдущих: STATUS_RETENTION_MODE=archive (по умолчанию) выгружает
+  секцию в STATUS_ARCHIVE_DIR/<секция>.csv.gz и удаляет таблицу, detach — только
+  отсоединяет её (таблица остаётся в БД, но не попадает в запросы).
+
+Агрегаты status_daily_counts при этом не меняются: /stats по-прежнему видит
+историю, а восстановленная секция подключается без повторного подсчёта.
+
+Запуск вручную:
+    python retention.py list
+    python retention.py run --keep-months 12
+    python retention.py archive statuses_p2024_01
+    python retention.py restore archive/statuses_p2024_01.csv.gz
+"""
+import argparse
+import gzip
+import logging
+import os
+import re
+from datetime import date
+
+import db
+import migrations
+from migrations import next_month, partition_name
+
+logger = logging.getLogger(__name__)
+
+RETENTION_MONTHS = int(os.getenv("STATUS_RETENTION_MONTHS", "0"))  # 0 — хранить всё
+RETENTION_MODE = os.getenv("STATUS_RETENTION_MODE", "archive")
+ARCHIVE_DIR = os.getenv("STATUS_ARCHIVE_DIR", "archive")
+PARTITIONS_AHEAD = int(os.getenv("STATUS_PARTITIONS_AHEAD", str(migrations.PARTITIONS_AHEAD)))
+# DETACH/ATTACH ненадолго блокируют statuses; не ждём долгие запросы дольше этого
+LOCK_TIMEOUT = os.getenv("STATUS_PARTITION_LOCK_TIMEOUT", "5s")
+RETENTION_LOCK_KEY = 4242003
+
+RETENTION_MODES = ("archive", "detach")
+STATUS_COLUMNS = "id, user_id, chat_id, date, status_type_id, custom_text"
+PARTITION_RE = re.compile(r"^statuses_p(\d{4})_(\d{2})$")
+
+
+def partition_month(name):
+    """Первое число месяца секции по её имени или None, если имя не секции."""
+    match = PARTITION_RE.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def add_months(month, months):
+    year, index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return date(year, index + 1, 1)
+
+
+# ========== СПИСОК И СОЗДАНИЕ СЕКЦИЙ ==========
+def list_partitions():
+    """Секции statuses и отсоединённые (detach) таблицы: [{name, month, rows, attached}]."""
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cur.execute('''
+            SELECT c.relname, c.relispartition, greatest(c.reltuples, 0)::bigint
+            FROM pg_class c
+            WHERE c.relkind = 'r'
+              AND (c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'statuses'::regclass)
+                   OR c.relname ~ '^statuses_p[0-9]{4}_[0-9]{2}$')
+            ORDER BY c.relname
+        ''')
+        rows = cur.fetchall()
+    return [{"name": name, "month": partition_month(name), "rows": estimate, "attached": attached}
+            for name, attached, estimate in rows]
+
+
+def ensure_partitions(months_ahead=PARTITIONS_AHEAD, today=None):
+    """Создаёт секции на текущий и months_ahead следующих месяцев; возвращает имена новых."""
+    month = (today or date.today()).replace(day=1)
+    created = []
+    for offset in range(months_ahead + 1):
+        target = add_months(month, offset)
+        with db.get_connection() as conn, conn.cursor() as cur:
+            cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+            cur.execute('SELECT ensure_status_partition(%s)', (target,))
+            if cur.fetchone()[0]:
+                created.append(partition_name(target))
+    if created:
+        logger.info(f"Созданы секции statuses: {', '.join(created)}")
+    return created
+
+
+# ========== АРХИВ ==========
+def _bump_statuses_version(cur):
+    # DETACH/ATTACH не вызывают триггеры, а недельный вид и дашборд кешируются по версии
+    cur.execute("UPDATE statuses_version SET version = version + 1, changed_at = date_trunc('second', now())")
+
+
+def detach_partition(name):
+    """Отсоединяет секцию от statuses; таблица остаётся в БД."""
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+        cur.execute(f'ALTER TABLE statuses DETACH PARTITION {name}')
+        _bump_statuses_version(cur)
+    db.invalidate_statuses()
+    logger.info(f"Секция {name} отсоединена")
+
+
+def archive_partition(name, archive_dir=ARCHIVE_DIR):
+    """Выгружает секцию в <archive_dir>/<name>.csv.gz и удаляет таблицу. Возвращает путь."""
+    if partition_month(name) is None:
+        raise ValueError(f"{name} — не секция statuses")
+    attached = {p["name"]: p["attached"] for p in list_partitions()}
+    if name not in attached:
+        raise ValueError(f"Таблицы {name} нет")
+    if attached[name]:
+        detach_partition(name)
+
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    tmp_path = path + ".tmp"
+    # Файл сначала пишется целиком и сбрасывается на диск, и только потом удаляется таблица
+    with db.get_connection() as conn, conn.cursor() as cur:
+        with open(tmp_path, "wb") as raw:
+            with gzip.GzipFile(filename=f"{name}.csv", mode="wb", fileobj=raw) as archive:
+                cur.copy_expert(
+                    f'COPY (SELECT {STATUS_COLUMNS} FROM {name} ORDER BY date, user_id) '
+                    'TO STDOUT WITH (FORMAT csv, HEADER)', archive
+                )
+            raw.flush()
+            os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+
+    with db.get_connection() as conn, conn.cursor() as cur:
+        cur.execute(f'DROP TABLE {name}')
+    logger.info(f"Секция {name} выгружена в {path}")
+    return path
+
+
+def apply_retention(keep_months=RETENTION_MONTHS, mode=RETENTION_MODE, archive_dir=ARCHIVE_DIR, today=None):
+    """Убирает секции старше keep_months месяцев до текущего; возвращает их имена."""
+    if keep_months <= 0:
+        return []
+    if mode not in RETENTION_MODES:
+        raise ValueError(f"Неизвестный режим хранения: {mode} (нужен один из {RETENTION_MODES})")
+    cutoff = add_months((today or date.today()).replace(day=1), -keep_months)
+    removed = []
+    for partition in list_partitions():
+        month = partition["month"]
+        if month is None or month >= cutoff:
+            continue
+        if mode == "archive":
+            # Отсоединённые ранее (в т.ч. прерванный архив) тоже дописываются в файл
+            archive_partition(partition["name"], archive_dir)
+        elif partition["attached"]:
+            detach_partition(partition["name"])
+        else:
+            continue
+        removed.append(partition["name"])
+    return removed
+
+
+def run_maintenance():
+    """Ежесуточное обслуживание секций; на нескольких репликах выполняет одна."""
+    lease = db.AdvisoryLease(RETENTION_LOCK_KEY)
+    if not lease.acquire():
+        logger.info("Обслуживание секций statuses уже выполняет другая реплика")
+        return
+    try:
+        ensure_partitions()
+        removed = apply_retention()
+        if removed:
+            logger.info(f"Хранение statuses ({RETENTION_MODE}, {RETENTION_MONTHS} мес.): {', '.join(removed)}")
+    finally:
+        lease.release()
+
+
+# ========== ВОССТАНОВЛЕНИЕ ==========
+def _attach(cur, name, month):
+    """Подключает таблицу name секцией месяца month (в транзакции вызывающего)."""
+    # Статусы удалённых с тех пор пользователей не пройдут внешний ключ
+    cur.execute(f'DELETE FROM {name} t WHERE NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = t.user_id)')
+    if cur.rowcount:
+        logger.warning(f"{name}: пропущено {cur.rowcount} статусов удалённых пользователей")
+    # Статусы этого месяца, записанные после архивации, лежат в statuses_default:
+    # переносим их через родителя (триггеры агрегатов), при совпадении они новее
+    cur.execute('''
+        CREATE TEMP TABLE status_restore_move ON COMMIT DROP AS
+        WITH moved AS (DELETE FROM statuses WHERE date >= %s AND date < %s RETURNING *)
+        SELECT * FROM moved
+    ''', (month, next_month(month)))
+    cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+    cur.execute(f'ALTER TABLE statuses ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)',
+                (month, next_month(month)))
+    cur.execute('''
+        INSERT INTO statuses SELECT * FROM status_restore_move
+        ON CONFLICT (user_id, date) DO UPDATE
+        SET chat_id = EXCLUDED.chat_id, status_type_id = EXCLUDED.status_type_id, custom_text = EXCLUDED.custom_text
+    ''')
+    _bump_statuses_version(cur)
+
+
+def restore(target):
+    """Возвращает секцию: target — путь к архиву .csv.gz или имя отсоединённой таблицы.
+
+    Секция старше срока хранения уйдёт в архив при следующем обслуживании —
+    на время разбора увеличьте STATUS_RETENTION_MONTHS.
+    """
+    name = os.path.basename(target)
+    if name.endswith(".csv.gz"):
+        name = name[:-len(".csv.gz")]
+    month = partition_month(name)
+    if month is None:
+        raise ValueError(f"Не удалось определить месяц секции по {target}")
+    existing = {p["name"]: p["attached"] for p in list_partitions()}
+    if existing.get(name):
+        raise ValueError(f"Секция {name} уже подключена")
+
+    with db.get_connection() as conn, conn.cursor() as cur:
+        if name not in existing:
+            cur.execute(f'CREATE TABLE {name} (LIKE statuses INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+            with gzip.open(target, "rb") as archive:
+                cur.copy_expert(f'COPY {name} ({STATUS_COLUMNS}) FROM STDIN WITH (FORMAT csv, HEADER)', archive)
+        cur.execute(f'SELECT count(*) FROM {name}')
+        rows = cur.fetchone()[0]
+        _attach(cur, name, month)
+    db.invalidate_statuses()
+    logger.info(f"Секция {name} восстановлена ({rows} строк)")
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Секции, хранение и архив таблицы statuses")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="секции и отсоединённые таблицы")
+    ensure = commands.add_parser("ensure", help="создать секции на текущий и следующие месяцы")
+    ensure.add_argument("--ahead", type=int, default=PARTITIONS_AHEAD)
+    run = commands.add_parser("run", help="применить политику хранения")
+    run.add_argument("--keep-months", type=int, default=RETENTION_MONTHS)
+    run.add_argument("--mode", choices=RETENTION_MODES, default=RETENTION_MODE)
+    run.add_argument("--dir", default=ARCHIVE_DIR)
+    archive = commands.add_parser("archive", help="выгрузить секцию в архив")
+    archive.add_argument("name")
+    archive.add_argument("--dir", default=ARCHIVE_DIR)
+    restore_cmd = commands.add_parser("restore", help="вернуть секцию из архива или отсоединённой таблицы")
+    restore_cmd.add_argument("target")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    db.init_db()
+    try:
+        if args.command == "list":
+            for p in list_partitions():
+                state = "подключена" if p["attached"] else "отсоединена"
+                print(f"{p['name']:<22} {state:<12} ~{p['rows']} строк")
+        elif args.command == "ensure":
+            print(f"Созданы: {ensure_partitions(args.ahead) or 'нет новых'}")
+        elif args.command == "run":
+            print(f"Убраны: {apply_retention(args.keep_months, args.mode, args.dir) or 'нечего убирать'}")
+        elif args.command == "archive":
+            print(archive_partition(args.name, args.dir))
+        elif args.command == "restore":
+            print(f"Восстановлено строк: {restore(args.target)}")
+    finally:
+        db.close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Массовая рассылка сообщений с учётом лимитов Telegram Bot API.
+
+Telegram ограничивает бота ~30 сообщениями в секунду суммарно и ~1 сообщением
+в секунду в один чат. BroadcastSender отправляет сообщения несколькими
+параллельными воркерами, выдерживая оба лимита, а при RetryAfter (429)
+приостанавливает всю рассылку на указанное время и повторяет попытку.
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+from telegram.error import Forbidden, BadRequest, NetworkError, RetryAfter, TimedOut
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SendSummary:
+    sent: int = 0
+    failed: int = 0
+    retries: int = 0
+    elapsed: float = 0.0
+    # Чаты, в которые отправить не удалось (для журнала рассылки)
+    failed_chats: list = field(default_factory=list)
+
+    def fail(self, chat_id):
+        self.failed += 1
+        self.failed_chats.append(chat_id)
+
+
+class RateLimiter:
+    """Равномерно распределяет отправки: общий лимит в секунду и интервал на чат."""
+
+    def __init__(self, global_rate=30.0, per_chat_interval=1.0):
+        self._interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self._per_chat_interval = per_chat_interval
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._chat_next = {}
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Останавливает все отправки на seconds секунд (после RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id):
+        # Слот в конкретном чате резервируем без общей блокировки
+        now = time.monotonic()
+        chat_slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = chat_slot + self._per_chat_interval
+        if chat_slot > now:
+            await asyncio.sleep(chat_slot - now)
+
+        async with self._lock:
+            now = time.monotonic()
+            wait = max(self._next_slot, self._paused_until) - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+                now = time.monotonic()
+            self._next_slot = max(self._next_slot, now) + self._interval
+
+
+class BroadcastSender:
+    """Рассылает сообщения с ограниченным параллелизмом и повторами."""
+
+    def __init__(self, bot, concurrency=20, global_rate=30.0, per_chat_interval=1.0,
+                 max_retries=3, backoff=1.0):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(global_rate, per_chat_interval)
+
+    async def _send_one(self, chat_id, kwargs, summary):
+        attempt = 0
+        while True:
+            await self.limiter.acquire(chat_id)
+            try:
+                await self.bot.send_message(chat_id=chat_id, **kwargs)
+                summary.sent += 1
+                return
+            except RetryAfter as e:
+                # Флуд-контроль действует на весь бот — тормозим всех воркеров
+                self.limiter.pause(e.retry_after)
+                logger.warning(f"Flood control: пауза {e.retry_after} с (чат {chat_id})")
+                if attempt >= self.max_retries:
+                    summary.fail(chat_id)
+                    return
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота или чат недоступен — повтор не поможет
+                summary.fail(chat_id)
+                logger.warning(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+                return
+            except (TimedOut, NetworkError) as e:
+                if attempt >= self.max_retries:
+                    summary.fail(chat_id)
+                    logger.warning(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+                    return
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+            summary.retries += 1
+
+    async def send_many(self, messages):
+        """messages — итерируемое из (chat_id, kwargs для send_message)."""
+        summary = SendSummary()
+        started = time.monotonic()
+        queue = asyncio.Queue()
+        for item in messages:
+            queue.put_nowait(item)
+
+        async def worker():
+            while True:
+                try:
+                    chat_id, kwargs = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await self._send_one(chat_id, kwargs, summary)
+                except Exception as e:
+                    summary.fail(chat_id)
+                    logger.warning(f"Не удалось отправить сообщение в чат {chat_id}: {e}")
+
+        workers = min(self.concurrency, queue.qsize())
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        summary.elapsed = time.monotonic() - started
+        metrics.MESSAGES_SENT.inc(summary.sent, result="sent")
+        metrics.MESSAGES_SENT.inc(summary.failed, result="failed")
+        metrics.MESSAGES_SENT.inc(summary.retries, result="retry")
+        return summary
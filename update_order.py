@@ -0,0 +1,58 @@
+"""Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+ConversationHandler'ы бота и запись user_data рассчитаны на то, что обновления
+одного пользователя обрабатываются по одному: иначе, например, выбор статуса
+после /setstatus или второе нажатие в календаре проверяют состояние диалога
+раньше, чем первое обновление его записало. PTB 20.7 с concurrent_updates
+такого порядка не даёт, поэтому Application получает OrderedUpdateProcessor:
+обновления разных пользователей идут параллельно (до max_concurrent_updates),
+а одного пользователя (или чата, если пользователя нет) — строго друг за
+другом, в порядке поступления. Так же шардирует обновления UpdateDispatcher
+в webhook.py.
+"""
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def update_key(update):
+    """Ключ порядка: пользователь, иначе чат, иначе само обновление."""
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return update.update_id
+    return id(update)
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обновления с одним update_key обрабатываются последовательно, с разными — параллельно."""
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._tails = {}  # ключ -> future, завершающийся после последнего обновления ключа
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        previous = self._tails.get(key)
+        current = asyncio.get_running_loop().create_future()
+        self._tails[key] = current
+        try:
+            if previous is not None:
+                await previous
+            await coroutine
+        finally:
+            if not current.done():
+                current.set_result(None)
+            if self._tails.get(key) is current:
+                del self._tails[key]
+            if asyncio.iscoroutine(coroutine):
+                coroutine.close()  # отменены, не дождавшись очереди; у выполненной — no-op
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
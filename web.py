@@ -1,46 +1,284 @@
-from flask import Flask, render_template
-import psycopg2
+from flask import Flask, Response, render_template, jsonify, request, make_response, url_for, stream_with_context
 from dotenv import load_dotenv
+from datetime import date, datetime, timedelta, timezone
+import base64
+import gzip
+import hashlib
+import hmac
+import io
+import json
 import os
-from datetime import datetime
+
+import db
+import export
+import importer
+import live
+import metrics
+from cache import TTLCache
 
 # Загружаем переменные окружения
 load_dotenv()
 
 app = Flask(__name__)
 
-def get_db_connection():
-    return psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        port=int(os.getenv("DB_PORT")),
-        database=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASS")
+# Короткоживущий кеш готовых страниц: ключ включает версию данных, поэтому
+# после записи статуса страница перерисовывается сразу, а TTL лишь ограничивает память
+render_cache = TTLCache(
+    maxsize=int(os.getenv("RENDER_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("RENDER_CACHE_TTL", "10"))
+)
+
+DASHBOARD_DAYS = 7
+DASHBOARD_PAGE_SIZE = int(os.getenv("DASHBOARD_PAGE_SIZE", "200"))
+# Ответы меньше этого размера не сжимаем
+GZIP_MIN_SIZE = 1024
+# Импорт через веб выключен, пока не задан токен
+IMPORT_TOKEN = os.getenv("IMPORT_TOKEN", "")
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("IMPORT_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+def encode_cursor(cursor):
+    date_val, username, user_id = cursor
+    raw = json.dumps([date_val.isoformat(), username, user_id], ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(value):
+    raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+    date_str, username, user_id = json.loads(raw)
+    return date.fromisoformat(date_str), username, int(user_id)
+
+
+def _parse_filters(args):
+    """Фильтры дашборда из query string: from/to (YYYY-MM-DD), chat, cursor."""
+    chat_id = int(args["chat"]) if args.get("chat") else None
+    # «Сегодня» — в часовом поясе выбранного чата, а не сервера
+    end_date = date.fromisoformat(args["to"]) if args.get("to") else db.local_today(chat_id)
+    start_date = date.fromisoformat(args["from"]) if args.get("from") else end_date - timedelta(days=DASHBOARD_DAYS)
+    cursor = decode_cursor(args["cursor"]) if args.get("cursor") else None
+    return start_date, end_date, chat_id, cursor
+
+
+def _render_dashboard(start_date, end_date, chat_id, cursor, version=None):
+    statuses, next_cursor = db.get_dashboard_page(start_date, end_date, chat_id, cursor, DASHBOARD_PAGE_SIZE)
+    next_url = None
+    if next_cursor:
+        params = {"from": start_date.isoformat(), "to": end_date.isoformat(), "cursor": encode_cursor(next_cursor)}
+        if chat_id is not None:
+            params["chat"] = chat_id
+        next_url = url_for("dashboard", **params)
+    # Сводка из агрегатов: O(дней) строк, не зависит от числа статусов
+    attendance = db.get_attendance(start_date, end_date, chat_id) if cursor is None else []
+    html = render_template(
+        'index.html',
+        statuses=statuses,
+        attendance=attendance,
+        categories=db.STATUS_CATEGORIES,
+        start_date=start_date,
+        end_date=end_date,
+        chat_id=chat_id,
+        next_url=next_url,
+        version=version,
+        now=datetime.now().strftime("%Y-%m-%d %H:%M")
     )
+    return html.encode("utf-8")
+
 
 @app.route('/')
 def dashboard():
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('''
-            SELECT s.date, u.username, s.status_text
-            FROM statuses s
-            JOIN users u ON s.user_id = u.user_id
-            WHERE s.date >= CURRENT_DATE - INTERVAL '7 days'
-            ORDER BY s.date DESC, u.username
-        ''')
-        statuses = cur.fetchall()
-        cur.close()
-        conn.close()
-        
-        return render_template(
-            'index.html',
-            statuses=statuses,
-            now=datetime.now().strftime("%Y-%m-%d %H:%M")
-        )
+        try:
+            filters = _parse_filters(request.args)
+        except (ValueError, TypeError):
+            return "<h1>Некорректные параметры фильтра</h1>", 400
+
+        version, changed_at = db.get_statuses_version()
+        # Страница зависит от данных и фильтров; в них уже подставлено окно по умолчанию,
+        # которое сдвигается в полночь часового пояса чата
+        key = filters
+        etag = f'{version}-{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}'
+
+        if request.if_none_match.contains(etag) or (
+            not request.if_none_match and request.if_modified_since
+            and request.if_modified_since >= changed_at.astimezone(timezone.utc)
+        ):
+            response = make_response("", 304)
+        else:
+            use_gzip = "gzip" in request.accept_encodings
+            body = render_cache.get_or_load(
+                "dashboard", (etag, use_gzip), lambda: _build_body(filters, use_gzip, version)
+            )
+            response = make_response(body)
+            response.content_type = "text/html; charset=utf-8"
+            if use_gzip and body[:2] == b"\x1f\x8b":
+                response.headers["Content-Encoding"] = "gzip"
+
+        response.set_etag(etag)
+        response.last_modified = changed_at
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
     except Exception as e:
         return f"<h1>Ошибка подключения к БД</h1><p>{str(e)}</p>", 500
 
+
+def _build_body(filters, use_gzip, version=None):
+    body = _render_dashboard(*filters, version=version)
+    if use_gzip and len(body) >= GZIP_MIN_SIZE:
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+@app.route('/export')
+def export_statuses():
+    """Потоковая выгрузка статусов: /export?from=YYYY-MM-DD&to=YYYY-MM-DD&format=csv|ndjson&chat=ID."""
+    fmt = request.args.get("format", "csv")
+    try:
+        chat_id = int(request.args["chat"]) if request.args.get("chat") else None
+        today = db.local_today(chat_id)
+        start_date = date.fromisoformat(request.args["from"]) if request.args.get("from") else today.replace(day=1)
+        end_date = date.fromisoformat(request.args["to"]) if request.args.get("to") else today
+    except ValueError:
+        return "Некорректные параметры выгрузки", 400
+    if fmt not in export.EXPORT_FORMATS:
+        return "Формат должен быть csv или ndjson", 400
+
+    filename = f"statuses_{start_date}_{end_date}.{fmt}"
+    return Response(
+        stream_with_context(export.generate(fmt, start_date, end_date, chat_id)),
+        content_type=export.EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.route('/import', methods=['POST'])
+def import_statuses():
+    """Массовый импорт статусов: multipart-поле file (CSV или NDJSON), см. importer.py.
+
+    Параметры (в форме или query string): format, chat, skip_weekends, dry_run,
+    strict. Авторизация — заголовок Authorization: Bearer <IMPORT_TOKEN> или поле token.
+    """
+    if not IMPORT_TOKEN:
+        return "Импорт выключен: не задан IMPORT_TOKEN", 403
+    auth = request.headers.get("Authorization", "")
+    token = auth[len("Bearer "):] if auth.startswith("Bearer ") else request.values.get("token", "")
+    if not hmac.compare_digest(token.encode(), IMPORT_TOKEN.encode()):
+        return "Неверный токен", 403
+    upload = request.files.get("file")
+    if upload is None:
+        return "Нужен файл в поле file", 400
+    fmt = request.values.get("format") or importer.detect_format(upload.filename)
+    if fmt not in importer.IMPORT_FORMATS:
+        return "Формат должен быть csv или ndjson", 400
+    try:
+        chat_id = int(request.values["chat"]) if request.values.get("chat") else None
+    except ValueError:
+        return "Некорректный chat", 400
+    flags = {name: request.values.get(name, "").lower() in ("1", "true", "on", "yes")
+             for name in ("skip_weekends", "dry_run", "strict")}
+    raw = upload.stream
+    if not hasattr(raw, "readable"):
+        # До Python 3.11 у SpooledTemporaryFile нет readable(), без него TextIOWrapper падает
+        raw = raw._file  # pylint: disable=protected-access
+    stream = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+    try:
+        report = importer.import_statuses(stream, fmt, chat_id, **flags)
+    except ValueError as e:  # в т.ч. UnicodeDecodeError
+        return f"Не удалось прочитать файл: {e}", 400
+    return jsonify(report.to_dict()), 200 if report.applied or report.dry_run or not report.error_count else 422
+
+def _event_matches(event, start_date, end_date, chat_id):
+    if chat_id is not None and chat_id not in event.get("chats", [event.get("chat_id")]):
+        return False
+    dates = {event.get("date"), event.get("old_date")}
+    return any(d and start_date.isoformat() <= d <= end_date.isoformat() for d in dates)
+
+
+RESET_CHUNK = "event: reset\ndata: {}\n\n"
+EVENT_STREAM_HEADERS = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # nginx не должен буферизовать поток
+}
+
+
+def open_event_stream(args, last_event_id=None, loop=None):
+    """Подписка для /events: (подписка, пропущенные события или None, фильтры).
+
+    Фильтры те же, что у дашборда; version — версия данных, с которой
+    отрисована страница: если с тех пор статусы менялись, replay=None и поток
+    сразу отправляет reset. ValueError/TypeError — некорректные параметры.
+    """
+    start_date, end_date, chat_id, _ = _parse_filters(args)
+    page_version = int(args["version"]) if args.get("version") else None
+
+    # Подписка до сверки версии: изменения после неё придут событиями
+    subscription, replay = live.feed.subscribe(last_event_id, loop)
+    if replay == [] and not last_event_id and page_version is not None:
+        try:
+            if db.get_statuses_version()[0] != page_version:
+                replay = None
+        except Exception:
+            live.feed.unsubscribe(subscription)
+            raise
+    return subscription, replay, (start_date, end_date, chat_id)
+
+
+def event_stream_prelude(replay, filters):
+    """Начало потока: интервал переподключения и пропущенные события (или reset)."""
+    chunks = [f"retry: {live.RECONNECT_DELAY * 3000:.0f}\n\n"]
+    if replay is None:
+        chunks.append(RESET_CHUNK)
+    else:
+        chunks.extend(live.format_event(event_id, event) for event_id, event in replay
+                      if _event_matches(event, *filters))
+    return chunks
+
+
+def event_stream_chunk(item, filters):
+    """Кусок потока для результата Subscription.get()/wait(): событие, ping, reset или ''."""
+    if item is live.RESET:
+        return RESET_CHUNK
+    if item is None:
+        return ": ping\n\n"
+    return live.format_event(*item) if _event_matches(item[1], *filters) else ""
+
+
+@app.route('/events')
+def status_events():
+    """Поток изменений статусов (Server-Sent Events) для живого дашборда.
+
+    В режиме webhook тот же поток отдаёт WebhookApp без WSGI (см. webhook.py).
+    """
+    try:
+        subscription, replay, filters = open_event_stream(request.args, request.headers.get("Last-Event-ID"))
+    except (ValueError, TypeError):
+        return "Некорректные параметры фильтра", 400
+
+    def stream():
+        try:
+            yield from event_stream_prelude(replay, filters)
+            if replay is None:
+                return
+            while True:
+                chunk = event_stream_chunk(subscription.get(), filters)
+                if chunk:
+                    yield chunk
+                if chunk is RESET_CHUNK:
+                    return
+        finally:
+            live.feed.unsubscribe(subscription)
+
+    return Response(stream(), headers=EVENT_STREAM_HEADERS)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Метрики процесса в формате Prometheus (запросы к БД дашборда, пул и т.д.)."""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/pool')
+def pool():
+    """Статистика пула соединений (для сбора мониторингом)."""
+    return jsonify(db.pool_stats())
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=False)
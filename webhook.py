@@ -0,0 +1,257 @@
+"""Режим webhook: приём обновлений Telegram через ASGI-сервер (uvicorn).
+
+Обновления складываются в ограниченные очереди: одна очередь и один воркер на
+шард, шард выбирается по пользователю. Поэтому обновления разных пользователей
+обрабатываются параллельно, а одного пользователя — строго по порядку. Если
+очередь шарда заполнена дольше WEBHOOK_ENQUEUE_TIMEOUT, отвечаем 503 и Telegram
+повторит доставку позже (backpressure).
+
+Дашборд из web.py можно обслуживать тем же процессом (WEBHOOK_WITH_DASHBOARD=1).
+WSGI-запросы дашборда выполняются в пуле потоков (каждый в своём), а /events
+отдаётся прямо из цикла событий: открытые потоки живого дашборда не занимают
+потоки и не задерживают остальные страницы.
+
+Проверка без Telegram: запустить бота с BOT_MODE=webhook и отправить записанное
+обновление, например:
+    curl -X POST -H 'Content-Type: application/json' \\
+         -H 'X-Telegram-Bot-Api-Secret-Token: <WEBHOOK_SECRET>' \\
+         --data @update.json http://localhost:8443/telegram
+"""
+import asyncio
+import json
+import logging
+import os
+from urllib.parse import parse_qsl
+
+from telegram import Update
+
+from update_order import update_key
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDispatcher:
+    """Распределяет обновления по шардам с сохранением порядка для пользователя."""
+
+    def __init__(self, application, workers=8, queue_size=1000, enqueue_timeout=5.0):
+        self.application = application
+        self.enqueue_timeout = enqueue_timeout
+        per_shard = max(1, queue_size // workers)
+        self._queues = [asyncio.Queue(maxsize=per_shard) for _ in range(workers)]
+        self._tasks = []
+
+    shard_key = staticmethod(update_key)
+
+    async def submit(self, update):
+        """Ставит обновление в очередь шарда. False — очередь переполнена."""
+        queue = self._queues[self.shard_key(update) % len(self._queues)]
+        try:
+            await asyncio.wait_for(queue.put(update), timeout=self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def queue_sizes(self):
+        return [queue.qsize() for queue in self._queues]
+
+    async def _worker(self, queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                queue.task_done()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def stop(self):
+        # Дорабатываем уже принятые обновления, затем останавливаем воркеров
+        for queue in self._queues:
+            await queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+class WebhookApp:
+    """Минимальное ASGI-приложение: POST {path} — обновления, events_path — SSE, остальное — дашборд."""
+
+    def __init__(self, dispatcher, bot, path="/telegram", secret_token=None, fallback=None, events_path=None):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.fallback = fallback
+        self.events_path = events_path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == self.path:
+            await self._handle_update(scope, receive, send)
+        elif scope["type"] == "http" and self.events_path and scope["path"] == self.events_path:
+            await self._handle_events(scope, receive, send)
+        elif self.fallback is not None:
+            await self.fallback(scope, receive, send)
+        elif scope["type"] == "http":
+            await self._respond(send, 404, b"Not Found")
+
+    @staticmethod
+    async def _respond(send, status, body=b""):
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def _handle_update(self, scope, receive, send):
+        if scope["method"] != "POST":
+            await self._respond(send, 405, b"Method Not Allowed")
+            return
+        if self.secret_token:
+            headers = dict(scope["headers"])
+            if headers.get(b"x-telegram-bot-api-secret-token", b"").decode() != self.secret_token:
+                await self._respond(send, 403, b"Forbidden")
+                return
+
+        body = b""
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+        try:
+            update = Update.de_json(json.loads(body), self.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning(f"Некорректное обновление в webhook: {e}")
+            await self._respond(send, 400, b"Bad Request")
+            return
+
+        if await self.dispatcher.submit(update):
+            await self._respond(send, 200, b"OK")
+        else:
+            logger.warning("Очередь обновлений переполнена — отвечаем 503")
+            await self._respond(send, 503, b"Busy")
+
+    async def _handle_events(self, scope, receive, send):
+        """/events живого дашборда (web.status_events) без WSGI-потока на каждого подписчика."""
+        import live
+        import web
+
+        if scope["method"] != "GET":
+            await self._respond(send, 405, b"Method Not Allowed")
+            return
+        args = dict(parse_qsl(scope["query_string"].decode("latin1")))
+        last_event_id = dict(scope["headers"]).get(b"last-event-id", b"").decode("latin1") or None
+        loop = asyncio.get_running_loop()
+        try:
+            # Подписка ждёт LISTEN и сверяет версию с БД — не в цикле событий
+            subscription, replay, filters = await loop.run_in_executor(
+                None, web.open_event_stream, args, last_event_id, loop
+            )
+        except (ValueError, TypeError):
+            await self._respond(send, 400, "Некорректные параметры фильтра".encode())
+            return
+
+        disconnected = asyncio.ensure_future(self._wait_disconnect(receive))
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(name.lower().encode(), value.encode())
+                            for name, value in web.EVENT_STREAM_HEADERS.items()],
+            })
+            for chunk in web.event_stream_prelude(replay, filters):
+                await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+            chunk = web.RESET_CHUNK if replay is None else ""
+            while chunk is not web.RESET_CHUNK and not disconnected.done():
+                chunk = web.event_stream_chunk(await subscription.wait(), filters)
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            disconnected.cancel()
+            live.feed.unsubscribe(subscription)
+
+    @staticmethod
+    async def _wait_disconnect(receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+
+def threaded_wsgi_to_asgi(wsgi_app):
+    """WsgiToAsgi, выполняющий каждый запрос в пуле потоков, а не в одном общем потоке.
+
+    asgiref по умолчанию (thread_sensitive) выполняет все WSGI-вызовы в одном
+    потоке, и долгая выгрузка /export задержала бы все остальные страницы.
+    """
+    from asgiref.sync import sync_to_async
+    from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+    class Instance(WsgiToAsgiInstance):
+        run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__["run_wsgi_app"].func, thread_sensitive=False)
+
+    class Adapter(WsgiToAsgi):
+        async def __call__(self, scope, receive, send):
+            await Instance(self.wsgi_application)(scope, receive, send)
+
+    return Adapter(wsgi_app)
+
+
+async def serve(application):
+    """Запускает бота в режиме webhook и обслуживает HTTP до остановки процесса.
+
+    Повторяет жизненный цикл run_polling: initialize → post_init → start, а при
+    остановке stop → shutdown → post_shutdown.
+    """
+    import uvicorn
+
+    path = os.getenv("WEBHOOK_PATH", "/telegram")
+    secret_token = os.getenv("WEBHOOK_SECRET") or None
+    dispatcher = UpdateDispatcher(
+        application,
+        workers=int(os.getenv("WEBHOOK_WORKERS", "8")),
+        queue_size=int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")),
+        enqueue_timeout=float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "5"))
+    )
+
+    fallback = events_path = None
+    if os.getenv("WEBHOOK_WITH_DASHBOARD") == "1":
+        from web import app as dashboard_app
+        fallback = threaded_wsgi_to_asgi(dashboard_app)
+        events_path = "/events"
+
+    asgi_app = WebhookApp(dispatcher, application.bot, path, secret_token, fallback, events_path)
+    server = uvicorn.Server(uvicorn.Config(
+        asgi_app,
+        host=os.getenv("WEBHOOK_HOST", "0.0.0.0"),
+        port=int(os.getenv("WEBHOOK_PORT", "8443")),
+        lifespan="off",
+        log_level="info"
+    ))
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    dispatcher.start()
+    webhook_url = os.getenv("WEBHOOK_URL")
+    if webhook_url:
+        await application.bot.set_webhook(
+            url=webhook_url.rstrip("/") + path,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Webhook зарегистрирован: {webhook_url.rstrip('/')}{path}")
+    try:
+        await server.serve()
+    finally:
+        await dispatcher.stop()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,131 @@
+"""Write-behind буфер: объединяет одиночные записи в пачки.
+
+В 9:00 тысячи пользователей за секунды нажимают кнопку опроса, и каждое нажатие
+раньше было отдельным соединением и COMMIT. Буфер собирает записи и сбрасывает
+их одним вызовом flush(rows) раз в max_delay секунд или при накоплении
+max_rows строк. Для одного ключа (пользователь, дата) в пачку попадает только
+последняя запись.
+
+Гарантии: submit() возвращается только после успешного сброса пачки, так что
+пользователь видит подтверждение лишь для записанного статуса; при ошибке
+исключение получает каждый ожидающий. close() дописывает всё накопленное.
+Сбросы идут строго по очереди, поэтому более поздняя запись не обгонит раннюю.
+"""
+import asyncio
+import logging
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Буфер записей; flush — корутина, принимающая список строк в порядке поступления."""
+
+    def __init__(self, flush, max_rows=500, max_delay=0.05, name="statuses"):
+        if max_rows < 1 or max_delay < 0:
+            raise ValueError(f"Некорректные параметры буфера: max_rows={max_rows}, max_delay={max_delay}")
+        self._flush = flush
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.name = name
+        self._pending = {}  # ключ -> [строка, [futures]]
+        self._wakeup = None
+        self._full = None
+        self._task = None
+        self._closing = False
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run(), name=f"write-behind-{self.name}")
+
+    async def submit(self, key, row):
+        """Ставит строку в очередь и ждёт, пока её пачка будет записана."""
+        if self._closing:
+            raise RuntimeError(f"Буфер {self.name} закрыт")
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = [row, [future]]
+        else:
+            # Последняя запись побеждает; подтверждение получат все, кто ждал ключ
+            entry[0] = row
+            entry[1].append(future)
+            metrics.WRITE_BEHIND_COALESCED.inc(buffer=self.name)
+        self._wakeup.set()
+        if len(self._pending) >= self.max_rows:
+            self._full.set()
+        return await future
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                if self._closing:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            if not self._closing and len(self._pending) < self.max_rows:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush_pending()
+            if len(self._pending) < self.max_rows:
+                self._full.clear()
+
+    async def _flush_pending(self):
+        keys = list(self._pending)[:self.max_rows]
+        batch = [self._pending.pop(key) for key in keys]
+        rows = [row for row, _ in batch]
+        started = time.perf_counter()
+        try:
+            await self._flush(rows)
+        except Exception as e:
+            metrics.WRITE_BEHIND_ERRORS.inc(buffer=self.name, error=type(e).__name__)
+            if len(batch) == 1:
+                _resolve(batch[0][1], error=e)
+                return
+            # Ошибка одной строки (например, CHECK) не должна отменять всю пачку
+            logger.warning(f"Сброс пачки {self.name} из {len(batch)} строк не удался ({e}), пишем по одной")
+            for row, futures in batch:
+                try:
+                    await self._flush([row])
+                except Exception as row_error:
+                    _resolve(futures, error=row_error)
+                else:
+                    _resolve(futures)
+            return
+        finally:
+            metrics.WRITE_BEHIND_FLUSH_DURATION.observe(time.perf_counter() - started, buffer=self.name)
+            metrics.WRITE_BEHIND_BATCH_SIZE.observe(len(batch), buffer=self.name)
+        for _, futures in batch:
+            _resolve(futures)
+
+    def pending(self):
+        """Число ключей, ожидающих записи."""
+        return len(self._pending)
+
+    async def close(self):
+        """Дописывает накопленные строки и останавливает фоновую задачу."""
+        self._closing = True
+        if self._task is None:
+            return
+        self._wakeup.set()
+        self._full.set()
+        await self._task
+        self._task = None
+
+
+def _resolve(futures, error=None):
+    for future in futures:
+        if future.done():
+            continue
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)